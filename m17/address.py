@@ -1,12 +1,18 @@
 import sys
 import string
+import operator
 import unittest
-
-import bitstruct
+import collections
 
 from .misc import _x
+try:
+    import numpy
+except ImportError:
+    numpy = None #only needed for the bulk encode_many/decode_many
+
 callsign_alphabet = " " + string.ascii_uppercase + string.digits + "-/." 
 #"." is TBD
+max_callsign_len = 9 #40**9 is the largest that fits in 48 bits
 # print("Alphabet: %s"%(callsign_alphabet))
 # print("len(Alphabet): %d"%(len(callsign_alphabet)))
 
@@ -17,6 +23,10 @@ class test_address(unittest.TestCase):
         self.ref = Address(callsign="XLX307 D")
     def test_string_compare(self):
         self.assertEqual(self.me, "W2FBI")
+    def test_string_compare_canonical(self):
+        self.assertEqual(Address(callsign="W2FBI "), "W2FBI ")
+        self.assertEqual(self.me, "w2fbi  ")
+        self.assertNotEqual(self.me, "W2F_BI")
     def test_num_compare(self):
         self.assertEqual(self.me, 23178783)
     def test_compare(self):
@@ -27,6 +37,68 @@ class test_address(unittest.TestCase):
         self.assertNotEqual(self.me,me2)
     def test_bytes(self):
         self.assertEqual(bytes(self.me), b'\x00\x00\x01a\xae\x1f')
+    def test_hashable(self):
+        d = {self.me: 1}
+        self.assertEqual(d[Address(addr=23178783)], 1)
+        self.assertIn(Address(callsign="XLX307 D"), {self.ref})
+    def test_hash_matches_string(self):
+        self.assertEqual(hash(self.me), hash("W2FBI"))
+        self.assertIn("W2FBI", {self.me})
+        self.assertIn(self.me, {"W2FBI"})
+        self.assertEqual({"XLX307 D": 1}[self.ref], 1)
+    def test_immutable(self):
+        with self.assertRaises(AttributeError):
+            self.me.addr = 5
+        with self.assertRaises(AttributeError):
+            self.me.whatever = 5
+    def test_interned(self):
+        self.assertIs(Address(callsign="W2FBI"), Address(addr=23178783))
+    def test_intern_eviction(self):
+        old_max = Address.intern_max
+        try:
+            Address.intern_max = 2
+            a = Address(callsign="AAA")
+            Address(callsign="BBB")
+            Address(callsign="CCC")
+            self.assertLessEqual(len(Address._interned), 2)
+            self.assertIsNot(Address(callsign="AAA"), a)
+            self.assertEqual(Address(callsign="AAA"), a)
+        finally:
+            Address.intern_max = old_max
+    def test_pickle(self):
+        import pickle
+        self.assertIs(pickle.loads(pickle.dumps(self.me)), self.me)
+
+@unittest.skipIf(numpy is None, "bulk encoding needs numpy")
+class test_address_bulk(unittest.TestCase):
+    calls = ["W2FBI", "xlx307 d", "SP5WWP", "", "M17-M17 A", "AB C", "N0CALL/P", "ZZZZZZZZZ"]
+    def test_encode_many(self):
+        addrs, bad = Address.encode_many(self.calls)
+        self.assertFalse(bad.any())
+        self.assertEqual(list(addrs), [Address.encode(c) for c in self.calls])
+    def test_decode_many(self):
+        addrs = [Address.encode(c) for c in self.calls]
+        calls, bad = Address.decode_many(addrs)
+        self.assertFalse(bad.any())
+        self.assertEqual(list(calls), [Address.decode(a) for a in addrs])
+    def test_encode_many_bad_rows(self):
+        addrs, bad = Address.encode_many(["W2FBI", "W2F_BI", "ABCDEFGHIJ", "Ü", "SP5WWP"])
+        self.assertEqual(list(bad), [False, True, True, True, False])
+        self.assertEqual(addrs[0], 23178783)
+        self.assertEqual(addrs[1], 0)
+    def test_encode_many_empty(self):
+        addrs, bad = Address.encode_many([])
+        self.assertEqual((addrs.shape, bad.shape), ((0,), (0,)))
+    def test_encode_many_nul(self):
+        addrs, bad = Address.encode_many(["A\x00B", "AB\x00", "\x00", "AB"])
+        self.assertEqual(list(bad), [True, True, True, False])
+        self.assertRaises(Exception, Address.encode, "A\x00B")
+        _, bad = Address.encode_many(numpy.array(["A\x00B", "AB"]))
+        self.assertEqual(list(bad), [True, False])
+    def test_decode_many_bad_rows(self):
+        calls, bad = Address.decode_many([23178783, 40**9, 2**48-1])
+        self.assertEqual(list(bad), [False, True, True])
+        self.assertEqual(list(calls), ["W2FBI", "", ""])
 
 class Address:
     """
@@ -61,20 +133,73 @@ class Address:
     >>> Address(callsign="W2FBI") == Address(addr=23178783)
     True
 
+    Addresses are immutable and hashable, so they work as dict keys and
+    in sets, and hash the same as their (canonical) callsign string, to go
+    along with == working against strings:
+    >>> len({Address(callsign="W2FBI"), Address(addr=23178783), Address(callsign="SP5WWP")})
+    2
+    >>> "W2FBI" in {Address(callsign="W2FBI")}
+    True
+    >>> {"W2FBI": "me"}[Address(callsign="W2FBI")]
+    'me'
+
+    Plain int addresses don't hash the same though, so don't mix ints and
+    Addresses as keys of one dict.
+
+    The callsign is always the canonical decoded one:
+    >>> Address(callsign="w2fbi ").callsign
+    'W2FBI'
+
 
 
     """
-    def __init__(self, **kwargs):
-        for k,v in kwargs.items():
-            if k in ["addr","callsign"]:
-                setattr(self,k,v)
-        self.callsign = self.callsign.upper() if hasattr(self,"callsign") else self.decode(self.addr)
-        self.addr = self.addr if hasattr(self,"addr") else self.encode(self.callsign)
+    __slots__ = ("addr", "callsign")
+    #Addresses are interned: asking for one we've seen recently hands back
+    #the same (immutable) object instead of decoding it all over again.
+    #Least recently used ones get evicted past intern_max.
+    intern_max = 4096
+    _interned = collections.OrderedDict()
+
+    def __new__(cls, addr=None, callsign=None):
+        if addr is None:
+            if callsign is None:
+                raise(Exception("Address needs either addr or callsign"))
+            addr = cls.encode(callsign)
+        addr = operator.index(addr)
+        interned = cls._interned
+        self = interned.get(addr)
+        if self is not None:
+            try:
+                interned.move_to_end(addr)
+            except KeyError:
+                pass #evicted by another thread in the meantime, no harm done
+            return self
+        self = object.__new__(cls)
+        object.__setattr__(self, "addr", addr)
+        object.__setattr__(self, "callsign", cls.decode(addr))
+        interned[addr] = self
+        while len(interned) > cls.intern_max:
+            interned.popitem(last=False)
+        return self
+
+    def __setattr__(self, name, value):
+        raise(AttributeError("Address is immutable"))
+
+    def __delattr__(self, name):
+        raise(AttributeError("Address is immutable"))
+
+    def __reduce__(self):
+        #default pickling would try to setattr the slots back in
+        return (Address, (self.addr,))
+
+    def __hash__(self):
+        #same as the callsign string, since == is true against it
+        return hash(self.callsign)
 
     def __str__(self):
         return "%s == 0x%06x"%(self.callsign,self.addr)
     def __bytes__(self):
-        return bitstruct.pack("u48",self.addr)
+        return self.addr.to_bytes(6, "big")
 
     def __index__(self):
         return self.addr
@@ -84,7 +209,11 @@ class Address:
             if compareto.isdigit(): #yeah, gross.
                 return int(compareto) == self.addr
             else: 
-                return compareto.upper() == self.callsign
+                #through encode(), so it's the canonical callsign either way (case, trailing spaces)
+                try:
+                    return Address.encode(compareto) == self.addr
+                except Exception:
+                    return False #not a callsign at all
         elif type(compareto) == type(1):
             return compareto == self.addr
         elif type(compareto) == type(self):
@@ -142,14 +271,134 @@ class Address:
         callsign = "".join(chars)
         return callsign
 
+    @staticmethod
+    def _need_numpy():
+        if numpy is None:
+            raise(Exception("Bulk address encoding needs numpy, install it or `pip install m17[Codec2]`"))
+
+    @staticmethod
+    def encode_many(callsigns):
+        """
+        Encode a whole list (or numpy array) of callsigns at once.
+
+        Returns (addrs, bad): a uint64 numpy array of addresses, and a
+        boolean array marking the rows that weren't valid callsigns
+        (characters outside the alphabet, or too long to fit in 48 bits).
+        Bad rows get an address of 0.
+
+        >>> addrs, bad = Address.encode_many(["W2FBI", "SP5WWP", "NOT_OK"])
+        >>> addrs.tolist(), bad.tolist()
+        ([23178783, 1698803859, 0], [False, False, True])
+        """
+        Address._need_numpy()
+        calls = numpy.asarray(callsigns, dtype="U").reshape(-1)
+        n = len(calls)
+        if n == 0:
+            return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=bool)
+        if isinstance(callsigns, numpy.ndarray):
+            lengths = numpy.char.str_len(calls)
+        else:
+            #numpy drops trailing NULs, so go by the strings we were given
+            lengths = numpy.fromiter((len(c) for c in callsigns), dtype=numpy.intp, count=n)
+        width = max(calls.dtype.itemsize // 4, 1)
+        #unicode arrays are fixed width UCS4, so this is each callsign as a row of code points,
+        #right-padded with zeros, which conveniently encode the same as trailing spaces would
+        codepoints = numpy.ascontiguousarray(calls).view(numpy.uint32).reshape(n, -1)
+        if codepoints.shape[1] < max_callsign_len:
+            codepoints = numpy.pad(codepoints, ((0,0),(0, max_callsign_len - codepoints.shape[1])))
+        outside = codepoints >= len(_char_table)
+        digits = _char_table[numpy.where(outside, 0, codepoints)]
+        bad = (outside | (digits < 0)).any(axis=1)
+        #zeros inside the string are real NULs rather than padding, and encode() won't take those
+        inside = numpy.arange(codepoints.shape[1]) < lengths[:, None]
+        bad |= ((codepoints == 0) & inside).any(axis=1)
+        #anything nonzero past the 9th character overflows 48 bits
+        bad |= (digits[:, max_callsign_len:] != 0).any(axis=1)
+        digits = digits[:, :max_callsign_len].astype(numpy.uint64)
+        addrs = digits @ _powers
+        addrs[bad] = 0
+        return addrs, bad
+
+    @staticmethod
+    def decode_many(addrs):
+        """
+        Decode a whole list (or numpy array) of addresses at once.
+
+        Returns (callsigns, bad): a numpy unicode array of callsigns, and a
+        boolean array marking the rows that weren't callsign addresses
+        (40**9 and up). Bad rows decode to "".
+
+        >>> calls, bad = Address.decode_many([23178783, 1698803859, 2**48-1])
+        >>> calls.tolist(), bad.tolist()
+        (['W2FBI', 'SP5WWP', ''], [False, False, True])
+        """
+        Address._need_numpy()
+        addrs = numpy.asarray(addrs, dtype=numpy.uint64).reshape(-1)
+        bad = addrs >= numpy.uint64(40**max_callsign_len)
+        addrs = numpy.where(bad, numpy.uint64(0), addrs)
+        shifted = addrs[:, None] // _powers
+        digits = (shifted % numpy.uint64(40)).astype(numpy.intp)
+        #decode() stops once there's nothing left, so the high zero digits don't become spaces
+        codepoints = numpy.where(shifted > 0, _alphabet_codepoints[digits], 0).astype(numpy.uint32)
+        callsigns = codepoints.view("U%d"%(max_callsign_len)).reshape(-1)
+        return callsigns, bad
+
+
+if numpy is not None:
+    #char code point -> base40 digit, -1 for anything not in the alphabet
+    _char_table = numpy.full(128, -1, dtype=numpy.int8)
+    _char_table[0] = 0 #padding in fixed width numpy strings
+    for _idx, _c in enumerate(callsign_alphabet):
+        _char_table[ord(_c)] = _idx
+        _char_table[ord(_c.lower())] = _idx
+    _alphabet_codepoints = numpy.array([ord(c) for c in callsign_alphabet], dtype=numpy.uint32)
+    _powers = numpy.array([40**i for i in range(max_callsign_len)], dtype=numpy.uint64)
+
+def _parse_addr(line):
+    try:
+        num = int(line, 0)
+    except ValueError:
+        num = -1
+    #anything unparseable or out of range gets flagged by decode_many
+    return num if 0 <= num < 2**64 else 2**64-1
+
+def stream(infile, outfile, errfile, decode=False, batch=65536):
+    """
+    Translate one callsign (or address, with decode) per line from infile,
+    in batches, writing "CALLSIGN == 0xADDR" lines to outfile and any
+    rejected lines to errfile
+    """
+    lineno = 0
+    while 1:
+        lines = [l.rstrip("\r\n") for _,l in zip(range(batch), infile)]
+        if not lines:
+            break
+        if decode:
+            nums = [_parse_addr(l) for l in lines]
+            calls, bad = Address.decode_many(nums)
+            addrs = nums
+        else:
+            addrs, bad = Address.encode_many(lines)
+            calls = [l.upper() for l in lines]
+        for i,line in enumerate(lines):
+            if bad[i]:
+                errfile.write("line %d: invalid %s: %r\n"%(lineno+i+1, "address" if decode else "callsign", line))
+            else:
+                outfile.write("%s == 0x%06x\n"%(calls[i], int(addrs[i])))
+        lineno += len(lines)
 
 def show_help():
     print("""
 Provide callsigns on the command line and they will be translated into M17 addresses
+
+Use "-" to translate callsigns from stdin, one per line, or "-d" to
+decode addresses (decimal or 0x hex) from stdin back into callsigns.
     """)
 if __name__ == "__main__":
     if len(sys.argv) <= 1:
         show_help()
+    elif sys.argv[1] in ["-", "-d"]:
+        stream(sys.stdin, sys.stdout, sys.stderr, decode=sys.argv[1] == "-d")
     else:
         for each in sys.argv[1:]:
             print(Address(callsign=each))
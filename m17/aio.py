@@ -0,0 +1,399 @@
+"""
+Run modular() chains on one asyncio event loop, instead of a process
+(and a multiprocessing.Queue) per block - so one process can host lots
+of chains at once, like a recorder per reflector module.
+
+Chains are the same lists of blocks modular() takes, and
+config.modular.runtime = "asyncio" makes apps.modular() hand them over
+here. How each kind of block gets run:
+
+    stepblocks - step() called right on the loop, @batched ones with
+        whatever's piled up on their queue
+    @heavy stepblocks (codec2enc, codec2dec, throttle...) - step() called
+        in a thread pool (config.modular.workers threads), so the loop
+        keeps going meanwhile. Anything whose step can sleep or block has
+        to be one of these, or it holds up every chain on the loop.
+    replicate(stepblock, n) - up to n steps at once in the thread pool,
+        results still in order
+    async def block(config, inq, outq) - a task, with asyncio.Queues
+    async def block(config, items) that yields - an async generator,
+        items being an async iterator over its input (None at the start
+        of a chain)
+    anything else (the usual blocking loops) - a thread of its own, with
+        its queues bridged to the loop's (its inq a queue.Queue with the
+        same maxsize and policy as the link in front of it)
+
+Links get an asyncio.Queue of their maxsize and policy, transport is
+ignored since it's all one process. The block at the end of a chain
+gets an outq that throws everything away.
+
+Like modular(), it runs until any block returns or dies.
+"""
+import queue
+import asyncio
+import inspect
+import threading
+import unittest
+import collections
+import concurrent.futures
+
+from . import pipeline
+
+class DroppingQueue(pipeline.QueueWrapper):
+    """
+    asyncio.Queue with a pipeline.link drop policy
+    """
+    def __init__(self, q, policy):
+        super().__init__(q)
+        self.policy = policy
+        self.dropped = 0
+    def put_nowait(self, x):
+        if self.q.full():
+            self.dropped += 1
+            if self.policy == "drop_newest":
+                return
+            self.q.get_nowait()
+        self.q.put_nowait(x)
+    async def put(self, x):
+        self.put_nowait(x)
+
+class _Done:
+    """
+    Awaitable that's already finished
+    """
+    def __await__(self):
+        return iter(())
+_done = _Done()
+
+class Discard:
+    """
+    outq for the end of a chain. put() is a plain call, so blocks in
+    threads can use it too, but what it returns can be awaited like an
+    asyncio.Queue's put()
+    """
+    def put_nowait(self, x):
+        pass
+    def put(self, x, block=True, timeout=None):
+        return _done
+
+def make_queue(l):
+    q = asyncio.Queue(l.maxsize)
+    if l.policy != "block":
+        q = DroppingQueue(q, l.policy)
+    return q
+
+async def get_batch(q, max_batch):
+    batch = [await q.get()]
+    while len(batch) < max_batch:
+        try:
+            batch.append(q.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+async def items(q):
+    while 1:
+        yield await q.get()
+
+class LoopPut:
+    """
+    outq for a blocking block running in a thread, putting onto an
+    asyncio.Queue (and blocking while it's full)
+    """
+    def __init__(self, q, loop):
+        self.q = q
+        self.loop = loop
+    def put(self, x, block=True, timeout=None):
+        asyncio.run_coroutine_threadsafe(self.q.put(x), self.loop).result()
+    def put_nowait(self, x):
+        self.put(x)
+
+async def run_steps(fn, config, inq, outq, executor, max_batch):
+    loop = asyncio.get_running_loop()
+    step = fn.setup(config)
+    heavy = getattr(fn, "heavy", False)
+    batched = pipeline.is_batched(fn)
+    try:
+        while 1:
+            x = await (get_batch(inq, max_batch) if batched else inq.get())
+            if heavy:
+                ys = await loop.run_in_executor(executor, lambda: list(step(x)))
+            else:
+                ys = step(x)
+            for y in ys:
+                await outq.put(y)
+    finally:
+        pipeline.close_steps([step])
+
+async def run_replicated(rep, config, inq, outq, executor):
+    """
+    Up to rep.n steps in the pool at once, each copy with its own step
+    (so its own state), results put in the order the items came in
+    """
+    if not hasattr(rep.block, "setup"):
+        raise(Exception("The asyncio runtime can only replicate() stepblocks, not %s"%(rep.block.__name__)))
+    loop = asyncio.get_running_loop()
+    free = asyncio.Queue()
+    steps = [pipeline.setup_step(rep.block, config) for _ in range(rep.n)]
+    for step in steps:
+        free.put_nowait(step)
+    inflight = asyncio.Queue(rep.n)
+    def call(step, x):
+        return list(step(x))
+    async def submit():
+        while 1:
+            x = await inq.get()
+            step = await free.get()
+            fut = loop.run_in_executor(executor, call, step, x)
+            fut.add_done_callback(lambda _, step=step: free.put_nowait(step))
+            await inflight.put(fut)
+    async def collect():
+        while 1:
+            fut = await inflight.get()
+            for y in await fut:
+                await outq.put(y)
+    try:
+        await asyncio.gather(submit(), collect())
+    finally:
+        pipeline.close_steps(steps)
+
+def thread_queue(l):
+    """
+    queue.Queue for a thread's inq, with the maxsize and policy of the
+    link in front of it
+    """
+    q = queue.Queue(l.maxsize)
+    if l.policy != "block":
+        q = pipeline.Dropping(q, l.policy)
+    return q
+
+async def run_thread(fn, config, inq, outq, name, inlink=None):
+    """
+    A blocking block in a thread of its own, with a queue.Queue fed from
+    inq, bounded (and dropping) like inlink says
+    """
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    tin = thread_queue(inlink or pipeline.link()) if inq is not None else None
+    tout = outq if isinstance(outq, Discard) else LoopPut(outq, loop)
+    def finished(result, error):
+        if not done.done():
+            if error is not None:
+                done.set_exception(error)
+            else:
+                done.set_result(result)
+    def target():
+        try:
+            result = fn(config, tin, tout)
+        except BaseException as e:
+            loop.call_soon_threadsafe(finished, None, e)
+        else:
+            loop.call_soon_threadsafe(finished, result, None)
+    threading.Thread(target=target, name=name, daemon=True).start()
+    async def pump():
+        while 1:
+            x = await inq.get()
+            while 1:
+                try:
+                    tin.put_nowait(x)
+                    break
+                except queue.Full:
+                    #the thread's behind, so is this chain - and a thread
+                    #blocked in put() here would hold up shutting down
+                    await asyncio.sleep(.001)
+    if tin is None:
+        return await done
+    pumping = asyncio.ensure_future(pump())
+    try:
+        return await done
+    finally:
+        pumping.cancel()
+
+async def run_block(fn, config, inq, outq, executor, max_batch, name, inlink=None):
+    if isinstance(fn, pipeline.replicate):
+        return await run_replicated(fn, config, inq, outq, executor)
+    if hasattr(fn, "setup"):
+        return await run_steps(fn, config, inq, outq, executor, max_batch)
+    if inspect.isasyncgenfunction(fn):
+        async for y in fn(config, None if inq is None else items(inq)):
+            await outq.put(y)
+        return
+    if inspect.iscoroutinefunction(fn):
+        return await fn(config, inq, outq)
+    return await run_thread(fn, config, inq, outq, name, inlink)
+
+async def run_chains(config, chains):
+    """
+    Start every block of every chain, and wait until one of them stops
+    """
+    max_batch = pipeline.option(config, "max_batch", 64)
+    executor = concurrent.futures.ThreadPoolExecutor(pipeline.option(config, "workers", None), thread_name_prefix="m17 heavy")
+    default_link = pipeline.default_link(config)
+    tasks = []
+    for chainidx,chain in enumerate(chains):
+        blocks, links = pipeline.split_links(chain, default_link)
+        inq = None
+        for fnidx,fn in enumerate(blocks):
+            name = "chain_%d/fn_%d/%s"%(chainidx, fnidx, fn.__name__)
+            outq = make_queue(links[fnidx]) if fnidx + 1 < len(blocks) else Discard()
+            inlink = links[fnidx - 1] if fnidx else None
+            tasks.append(asyncio.ensure_future(run_block(fn, config, inq, outq, executor, max_batch, name, inlink)))
+            tasks[-1].block_name = name
+            inq = outq
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            if t.exception() is not None:
+                print("%s died: %r"%(t.block_name, t.exception()))
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:
+            #no cancel_futures before 3.9, the queued steps just run out
+            executor.shutdown(wait=False)
+
+def modular(config, chains, fuse=None):
+    """
+    Same as apps.modular(), on an event loop (fuse doesn't mean anything here)
+    """
+    try:
+        asyncio.run(run_chains(config, chains))
+        print("lost a block")
+    except KeyboardInterrupt as e:
+        print("Got ^C, ")
+    finally:
+        print("closing down")
+
+class test_aio(unittest.TestCase):
+    def run_chain(self, chain, n):
+        """
+        Feed range(n) through chain, returning what comes out
+        """
+        got = []
+        async def source(config, inq, outq):
+            for x in range(n):
+                await outq.put(x)
+            await asyncio.sleep(10)
+        async def sink(config, inq, outq):
+            while len(got) < n:
+                got.append(await inq.get())
+        asyncio.run(asyncio.wait_for(run_chains({}, [[source] + chain + [sink]]), 10))
+        return got
+
+    def test_kinds_of_block(self):
+        import time
+        from .blocks import stepblock, batched, heavy
+        @stepblock
+        def inc(config):
+            return lambda x: [x + 1]
+        @batched
+        @stepblock
+        def double_all(config):
+            return lambda xs: [x * 2 for x in xs]
+        @heavy
+        @stepblock
+        def slow(config):
+            def step(x):
+                time.sleep(.001)
+                return [x]
+            return step
+        def blocking_loop(config, inq, outq):
+            while 1:
+                outq.put(inq.get() - 1)
+        async def agen(config, xs):
+            async for x in xs:
+                yield x * 10
+        chain = [inc, double_all, slow, pipeline.link(maxsize=2), blocking_loop, agen]
+        self.assertEqual(self.run_chain(chain, 50), [((x + 1) * 2 - 1) * 10 for x in range(50)])
+
+    def test_replicate_order(self):
+        import time
+        import random
+        from .blocks import stepblock
+        @stepblock
+        def jittery(config):
+            def step(x):
+                time.sleep(random.random() / 200)
+                return [x] * (x % 2 + 1)
+            return step
+        self.assertEqual(self.run_chain([pipeline.replicate(jittery, 4)], 60), [x for x in range(60) for _ in range(x % 2 + 1)][:60])
+
+    def test_discard(self):
+        import warnings
+        d = Discard()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            d.put(1) #from a thread, nothing to await
+            async def go():
+                await d.put(2)
+            asyncio.run(go())
+
+    def test_drop_oldest(self):
+        async def go():
+            q = make_queue(pipeline.link(maxsize=3, policy="drop_oldest"))
+            for x in range(5):
+                await q.put(x)
+            return [q.get_nowait() for _ in range(3)], q.dropped
+        self.assertEqual(asyncio.run(go()), ([2, 3, 4], 2))
+
+    def test_thread_queue(self):
+        q = thread_queue(pipeline.link(maxsize=3, policy="drop_oldest"))
+        for x in range(5):
+            q.put_nowait(x)
+        self.assertEqual(([q.get_nowait() for _ in range(3)], q.dropped), ([2, 3, 4], 2))
+        self.assertEqual(thread_queue(pipeline.link(maxsize=25)).maxsize, 25)
+
+    def test_throttle_off_loop(self):
+        import time
+        from .blocks import throttle
+        ticks = []
+        async def heartbeat(config, inq, outq):
+            while 1:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(.01)
+        got = []
+        async def source(config, inq, outq):
+            for x in range(10):
+                await outq.put(x)
+            await asyncio.sleep(10)
+        async def sink(config, inq, outq):
+            while len(got) < 10:
+                got.append(await inq.get())
+        asyncio.run(asyncio.wait_for(run_chains({}, [[source, throttle(50), sink], [heartbeat]]), 10))
+        self.assertEqual(got, list(range(10)))
+        gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+        self.assertGreater(len(ticks), 5)
+        self.assertLess(max(gaps), .1)
+
+    def test_close_on_cancel(self):
+        from .blocks import stepblock
+        closed = []
+        @stepblock
+        def closing(config):
+            step = lambda x: [x]
+            step.close = lambda: closed.append(True)
+            return step
+        self.assertEqual(self.run_chain([closing, pipeline.replicate(closing, 2)], 5), list(range(5)))
+        self.assertEqual(closed, [True] * 3)
+
+    def test_many_chains(self):
+        from .blocks import stepblock
+        @stepblock
+        def inc(config):
+            return lambda x: [x + 1]
+        seen = collections.Counter()
+        async def source(config, inq, outq):
+            for x in range(20):
+                await outq.put(x)
+            await asyncio.sleep(10)
+        async def sink(config, inq, outq):
+            while 1:
+                seen[await inq.get()] += 1
+                if sum(seen.values()) == 200 * 20:
+                    return
+        chains = [[source, inc, inc, sink] for _ in range(200)]
+        asyncio.run(asyncio.wait_for(run_chains({}, chains), 10))
+        self.assertEqual(seen, collections.Counter(dict((x + 2, 200) for x in range(20))))
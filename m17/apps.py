@@ -10,8 +10,16 @@ import multiprocessing
 from .const import *
 from .misc import example_bytes,_x,chunk,dattr
 from .blocks import *
+from . import pipeline
+from . import monitor
+from . import reflector
 import m17.network as network
 
+#for the queues in front of codec2dec and spkr_audio - if they fall behind,
+#drop the stalest audio rather than fall further and further behind
+#(25 codec2 or audio frames is half a second at 20ms each)
+live_audio = pipeline.link(maxsize=25, policy="drop_oldest")
+
 def default_config(c2_mode):
     c2,conrate,bitframe = codec2setup(c2_mode)
     print("conrate, bitframe = [%d,%d]"%(conrate,bitframe) )
@@ -29,6 +37,16 @@ def default_config(c2_mode):
             "conrate":conrate,
             "bitframe":bitframe,
             },
+        "modular":{
+            "runtime":"process", #or "asyncio", see modular()
+            "fuse":False, #see modular()
+            "link":{"transport":"queue"}, #or "shm", see pipeline.link
+            "max_batch":64, #most items a @batched block takes at once
+            "monitor":{
+                "print_interval":0, #seconds between block stats tables, 0 for none
+                "port":None, #e.g. 7017 for JSON stats on localhost:7017
+                },
+            },
         })
     return config
 
@@ -76,17 +94,53 @@ def udp_mirror(refcallsign, port=default_port):
     srv = udp_server(port, packet_handler, timer)
     srv()
 
-def udp_reflector(refcallsign, port=default_port):
-    # "Reflects" an incoming stream to all connected users.
+def udp_reflector(refcallsign, port=default_port, workers=1):
+    # "Reflects" an incoming stream to everyone connected to its module.
     # ✔ So first, we need a way to receive connections and keep track of them, right?
-    # We also have our own callsign, but we'll deal with that later.
+    # ✔ Clients CONN to a module, we PING them and they PONG back (see reflector.py)
+    # ✔ workers > 1 runs that many processes on the same port, for more cores
 
     port=int(port)
+    workers=int(workers)
+    if workers == 1:
+        return reflector_worker(port, reflector.ModuleRouter(refcallsign))
+    procs = start_reflector(refcallsign, port, workers)
+    try:
+        for p in procs:
+            p.join()
+    finally:
+        for p in procs:
+            p.terminate()
+
+def start_reflector(refcallsign, port, workers):
+    """
+    Start workers reflector processes sharing port, returning them
+    """
+    shared = reflector.SharedSubscribers(workers)
+    procs = [multiprocessing.Process(name="udp_reflector %d"%(w), target=reflector_worker,
+        args=(port, reflector.ShardedRouter(refcallsign, shared, w), True)) for w in range(workers)]
+    for p in procs:
+        p.start()
+    return procs
+
+def reflector_handlers(router):
+    """
+    (packet_handler, on_expire) for a udp_server running router
+    """
     def packet_handler(sock, active_connections, bs, conn):
-        others = [c for c in active_connections.keys() if c != conn]
-        for c in others:
-            sock.sendto(bs, c)
-    srv = udp_server(port, packet_handler)
+        #only to who's on the stream's module, one sendmmsg() where we can
+        router.handle(sock, bs, conn)
+        if bs[:4] == b"DISC":
+            #left on purpose, so it's not going to time out later
+            active_connections.remove(conn)
+    def on_expire(sock, conn):
+        print("%s:%s timed out"%conn[:2])
+        router.forget(conn)
+    return packet_handler, on_expire
+
+def reflector_worker(port, router, reuseport=False):
+    packet_handler, on_expire = reflector_handlers(router)
+    srv = udp_server(port, packet_handler, router.ping, interval=3, on_expire=on_expire, reuseport=reuseport)
     srv()
 
 
@@ -103,7 +157,7 @@ def m17ref_client(mycall,mymodule,refname,module,port=default_port,mode=3200):
     myrefmod = "%s %s"%(mycall,mymodule)
     c = m17ref_client_blocks(myrefmod,module,host,port)
     tx_chain = [mic_audio, codec2enc, vox, m17frame, tobytes, c.sender()]
-    rx_chain = [c.receiver(), m17parse, payload2codec2, codec2dec, spkr_audio]
+    rx_chain = [c.receiver(), m17parse, jitter_buffer(), payload2codec2, live_audio, codec2dec, live_audio, spkr_audio]
     config = default_config(mode)
     config.m17.dst = "%s %s"%(refname,module)
     config.m17.src = mycall
@@ -141,7 +195,7 @@ def to_pcm(mode=3200,port=default_port):
 def recv_dump(mode=3200,port=default_port):
     mode=int(mode) #so we can call modular_client straight from command line
     port=int(port)
-    rx_chain = [udp_recv(port), teefile("rx"), m17parse, tee('M17'), payload2codec2, teefile('out.c2_3200'),codec2dec, teefile('out.raw'), spkr_audio]
+    rx_chain = [udp_recv(port), teefile("rx"), m17parse, jitter_buffer(), tee('M17'), payload2codec2, teefile('out.c2_3200'),codec2dec, teefile('out.raw'), spkr_audio]
     config = default_config(mode)
     modular(config, [rx_chain])
 
@@ -156,7 +210,7 @@ def voip(host="localhost",port=default_port,voipmode="full",mode=3200,src="W2FBI
     # if nothing else, simple to reason about
 
     tx_chain = [mic_audio, codec2enc, vox, m17frame, tobytes, udp_send((host,port))]
-    rx_chain = [udp_recv(port), m17parse, payload2codec2, codec2dec, spkr_audio]
+    rx_chain = [udp_recv(port), m17parse, jitter_buffer(), payload2codec2, live_audio, codec2dec, live_audio, spkr_audio]
     if voipmode == "tx":
         #disable the rx chain
         #useful for when something's already bound to listening port
@@ -185,7 +239,7 @@ def echolink_bridge(mycall,mymodule,refname,refmodule,refport=default_port,mode=
         raise(NotImplementedError)
     myrefmod = "%s %s"%(mycall,mymodule)
     c = m17ref_client_blocks(myrefmod,refmodule,host,refport)
-    echolink_to_m17ref = [udp_recv(55501), chunker_b(640), np_convert("<h"), integer_decimate(2), codec2enc, m17frame, tobytes, c.sender()]
+    echolink_to_m17ref = [udp_recv(55501), chunker_np(320, "<h"), integer_decimate(2), codec2enc, m17frame, tobytes, c.sender()]
     m17ref_to_echolink = [ c.receiver(), m17parse, payload2codec2, codec2dec, integer_interpolate(2), udp_send(("127.0.0.1",55500)) ]
     config = default_config(mode)
     config.m17.dst = "%s %s"%(refname,refmodule)
@@ -238,12 +292,35 @@ def _test_chains_example():
     config.verbose = 1
     modular(config, [test_chain])
 
-def modular(config, chains):
+def modular(config, chains, fuse=None):
     """
     Take in a global configuration, and a list of lists of queue
     processing functions, and hook them up in a chain, each function in
     its own process
     Fantastic for designing, developing, and debugging new features.
+
+    A pipeline.link() between two blocks in a chain picks how they're
+    connected, e.g. link(transport="shm") for a shared memory ring
+    instead of a multiprocessing.Queue; config.modular.link sets the default.
+
+    With fuse (or config.modular.fuse), lightweight stepblocks like
+    m17parse, payload2codec2 and tobytes get called directly inside a
+    neighboring block's process instead, and only @heavy blocks like
+    codec2enc/codec2dec keep processes of their own - see
+    pipeline.fuse_chain(). Same results, a lot fewer processes, queues
+    and pickles per frame.
+
+    @batched blocks (see blocks.batched) get lists of whatever has piled
+    up on their inq; modular() adapts between them and unbatched neighbors.
+
+    pipeline.replicate(block, n) in a chain runs n copies of a slow block
+    in parallel and keeps their output in order.
+
+    With config.modular.monitor set, every block gets counted - see
+    m17/monitor.py for what's counted and how to get at it.
+
+    With config.modular.runtime set to "asyncio", the same chains run on
+    one event loop in this process instead - see m17/aio.py.
     """
     #a chain is a series of small functions that share a queue between each pair
     #each small function is its own process - which is absurd, except this
@@ -255,7 +332,7 @@ def modular(config, chains):
     #As long as each function stays under the deadline individually, all we do is add latency from sampled->delivered
     #   (well, as long as we have enough processor cores, but it's current_year, these functions still arent that heavy, and its working excellently given what I needed it to do
     #if a function does get slower than realtime, can I make two in its place writing to the same queues?
-    #   as long as i have enough cores still, that seems reasonable - but I'll have to think about it
+    #   yes - see pipeline.replicate()
     """
     queues:
     n -> n2 -> n3 -> n4
@@ -269,36 +346,74 @@ def modular(config, chains):
         unless at end of chain, create an outq for each fn, outq=
 
     """
+    if pipeline.option(config, "runtime", "process") == "asyncio":
+        from . import aio
+        return aio.modular(config, chains)
+    if fuse is None:
+        fuse = pipeline.option(config, "fuse", False)
+    if fuse:
+        chains = [pipeline.fuse_chain(chain) for chain in chains]
     modules = {
             "chains":chains,
             "queues":[],
             "processes":[],
             }
 
+    default_link = pipeline.default_link(config)
+    max_batch = pipeline.option(config, "max_batch", 64)
+    mon = monitor.from_config(config)
     for chainidx,chain in enumerate(modules["chains"]):
         inq = None
-        for fnidx,fn in enumerate(chain):
+        blocks, links = pipeline.split_links(chain, default_link)
+        for fnidx,fn in enumerate(blocks):
             name = fn.__name__
-            if fnidx != len(chain):
-                outq = multiprocessing.Queue()
-                modules["queues"].append(outq)
+            if fnidx != len(blocks):
+                if fnidx + 1 < len(blocks) and isinstance(blocks[fnidx+1], pipeline.replicate):
+                    links[fnidx] = blocks[fnidx+1].check_link(links[fnidx])
+                q = links[fnidx].make()
+                modules["queues"].append(q)
+                if fnidx + 1 < len(blocks):
+                    #@batched blocks get lists, so adapt if only one side is batched
+                    #and number items going into a replicate()
+                    outq, nextq = pipeline.connect(fn, blocks[fnidx+1], q, max_batch)
+                else:
+                    outq, nextq = q, q
             else:
                 outq = None
-            process = multiprocessing.Process(name="chain_%d/fn_%d/%s"%(chainidx,fnidx,name), target=fn, args=(config, inq, outq))
-            modules["processes"].append({
-                    "name":name,
-                    "inq":inq,
-                    "outq":outq,
-                    "process":process
-                    })
-            process.start()
-            inq = outq
+            if isinstance(fn, pipeline.replicate):
+                #copies share inq, and put onto one more queue for the reorder stage
+                if inq is None:
+                    raise(Exception("Can't replicate %s, it's the start of the chain"%(fn.block.__name__)))
+                rq = multiprocessing.Queue()
+                modules["queues"].append(rq)
+                parts = [(partname, target, (rq if target is pipeline.reorder else inq), (outq if target is pipeline.reorder else rq))
+                        for partname, target in fn.processes(fn.block.__name__)]
+            else:
+                parts = [(name, fn, inq, outq)]
+            if mon is not None:
+                mon.add_queue(q, chainidx, fnidx, name)
+            for partname, target, part_inq, part_outq in parts:
+                args = (config, part_inq, part_outq)
+                if mon is not None:
+                    stats = mon.add_block(partname, chainidx, fnidx)
+                    args = (config,) + mon.wrap(target, stats, part_inq, part_outq)
+                process = multiprocessing.Process(name="chain_%d/fn_%d/%s"%(chainidx,fnidx,partname), target=target, args=args)
+                modules["processes"].append({
+                        "name":partname,
+                        "inq":part_inq,
+                        "outq":part_outq,
+                        "process":process
+                        })
+                process.start()
+            inq = nextq
     try:
         procs = modules['processes']
         while 1:
             if any(not p['process'].is_alive() for p in procs):
                 print("lost a client process")
                 break
+            if mon is not None:
+                mon.sample()
             time.sleep(.05)
         #I can see where this is going to need to change
         #it's fine for now, but a real server will need something different
@@ -310,6 +425,14 @@ def modular(config, chains):
             #messy
             #TODO make a rwlock for indicating shutdown
             proc["process"].terminate()
+        for proc in procs:
+            dropped = getattr(proc["outq"], "dropped", 0)
+            if dropped:
+                print("%s dropped %d"%(proc["process"].name, dropped))
+        for q in modules["queues"]:
+            pipeline.close_queue(q)
+        if mon is not None:
+            mon.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+"""
+Handle a whole buffer of back to back ipFrames as one numpy record array,
+instead of one Python object per frame.
+
+Nothing gets copied - the records are a view over the receive buffer -
+so filtering, stats, and bulk forwarding turn into boolean masks.
+
+>>> from m17.address import Address
+>>> from m17.frames import initialLICH, ipFrame
+>>> lich = initialLICH(src=Address(callsign="W2FBI"), dst=Address(callsign="M17-M17 A"), streamtype=5, nonce=bytes(14))
+>>> buf = b"".join(bytes(ipFrame(streamid=sid, LICH=lich, frame_number=fn, payload=bytes(16))) for sid,fn in [(1,0),(2,0),(1,1),(1,2)])
+>>> recs = frames_view(buf)
+>>> recs.frame_number.tolist()
+[0, 0, 1, 2]
+>>> recs[select(recs, streamid=1, frame_range=(1,3))].frame_number.tolist()
+[1, 2]
+>>> decode_addrs(recs.dst[:1]).tolist() == [Address(callsign="M17-M17 A").addr]
+True
+"""
+import unittest
+
+import numpy
+
+from .address import Address
+from .frames import ipFrame
+from . import crc
+
+ipframe_dtype = numpy.dtype([
+    ("magic", "S4"),
+    ("streamid", ">u2"),
+    ("dst", "u1", (6,)),
+    ("src", "u1", (6,)),
+    ("streamtype", ">u2"),
+    ("nonce", "u1", (14,)),
+    ("frame_number", ">u2"),
+    ("payload", "u1", (16,)),
+    ("crc", ">u2"),
+    ])
+assert ipframe_dtype.itemsize == ipFrame.sz
+
+_addr_shifts = numpy.arange(40, -8, -8, dtype=numpy.uint64)
+
+def frames_view(buf):
+    """
+    Map a contiguous buffer of ipFrames into a record array without copying.
+    Trailing bytes that don't make up a whole frame are ignored.
+    The view is writable if buf is (bytearray, mmap, ...).
+    """
+    count = len(memoryview(buf).cast("B")) // ipframe_dtype.itemsize
+    return numpy.frombuffer(buf, dtype=ipframe_dtype, count=count).view(numpy.recarray)
+
+def decode_addrs(field):
+    """
+    Turn a (n,6) array of big endian address bytes (like recs.dst) into uint64 addresses
+    """
+    return numpy.bitwise_or.reduce(field.astype(numpy.uint64) << _addr_shifts, axis=-1)
+
+def _as_addr(a):
+    if isinstance(a, str):
+        return Address(callsign=a).addr
+    return int(a)
+
+def _addr_bytes(a):
+    return numpy.frombuffer(_as_addr(a).to_bytes(6, "big"), dtype=numpy.uint8)
+
+def select(recs, streamid=None, dst=None, src=None, frame_range=None):
+    """
+    Boolean mask of the records matching everything given:
+        streamid - a streamid
+        dst, src - an Address, int address, or callsign
+        frame_range - (first, last) frame numbers, half open like range()
+    Frames without the "M17 " magic never match.
+    """
+    mask = recs["magic"] == b"M17 "
+    if streamid is not None:
+        mask &= recs["streamid"] == streamid
+    if dst is not None:
+        mask &= (recs["dst"] == _addr_bytes(dst)).all(axis=1)
+    if src is not None:
+        mask &= (recs["src"] == _addr_bytes(src)).all(axis=1)
+    if frame_range is not None:
+        first,last = frame_range
+        fn = recs["frame_number"]
+        mask &= (fn >= first) & (fn < last)
+    return mask
+
+def crc_ok(recs):
+    """
+    Boolean mask of the records with a valid CRC
+    """
+    raw = numpy.asarray(recs).view(numpy.uint8).reshape(len(recs), ipframe_dtype.itemsize)
+    return crc.crc_ok_many(raw, ipframe_dtype.itemsize)
+
+class test_batch(unittest.TestCase):
+    def setUp(self):
+        from .frames import initialLICH
+        self.frames = []
+        for i in range(30):
+            lich = initialLICH(
+                    src=Address(callsign="W2FBI"),
+                    dst=Address(callsign=["M17-M17 A","M17-M17 B"][i%2]),
+                    streamtype=5,
+                    nonce=bytes(range(14)))
+            self.frames.append(ipFrame(streamid=0x100 + i%3, LICH=lich, frame_number=i, payload=bytes([i])*16))
+        self.buf = bytearray(b"".join(bytes(f) for f in self.frames))
+
+    def test_fields(self):
+        recs = frames_view(self.buf)
+        self.assertEqual(len(recs), len(self.frames))
+        for f,r in zip(self.frames, recs):
+            self.assertEqual(r.streamid, f.streamid)
+            self.assertEqual(r.frame_number, f.frame_number)
+            self.assertEqual(bytes(r.payload), bytes(f.payload))
+            self.assertEqual(bytes(r.nonce), bytes(f.LICH.nonce))
+            self.assertEqual(r.streamtype, f.LICH.streamtype)
+        self.assertEqual(decode_addrs(recs.dst).tolist(), [int(f.LICH.dst) for f in self.frames])
+        self.assertEqual(decode_addrs(recs.src).tolist(), [int(f.LICH.src) for f in self.frames])
+
+    def test_no_copy(self):
+        recs = frames_view(self.buf)
+        self.buf[4:6] = b"\xbe\xef"
+        self.assertEqual(recs[0].streamid, 0xbeef)
+
+    def test_select(self):
+        recs = frames_view(self.buf)
+        mask = select(recs, streamid=0x101, dst="M17-M17 B", frame_range=(5, 25))
+        expected = [f.frame_number for f in self.frames if f.streamid == 0x101 and f.LICH.dst == "M17-M17 B" and 5 <= f.frame_number < 25]
+        self.assertEqual(recs.frame_number[mask].tolist(), expected)
+
+    def test_crc(self):
+        self.buf[ipframe_dtype.itemsize + 40] ^= 1
+        ok = crc_ok(frames_view(self.buf))
+        self.assertEqual(ok.tolist(), [True, False] + [True]*(len(self.frames)-2))
@@ -0,0 +1,145 @@
+"""
+Loopback benchmark for udp_reflector, to see how it scales with workers.
+
+    python -m m17.bench_reflector [seconds] [workers ...]
+    python -m m17.bench_reflector 5 1 2 4
+
+For each number of workers it starts a reflector on a free port, puts
+listeners on a few modules, then has talkers throw stream frames at it
+as fast as they can for a while and counts what the listeners get.
+Talkers and listeners are processes of their own too, and they take
+CPU, so on a machine without spare cores the numbers won't go up much
+with more workers - leave cores for them.
+
+Prints frames in per second (what the talkers managed to send),
+frames out per second (what the listeners got, so fan-out included),
+and frames out compared to one worker.
+"""
+import sys
+import time
+import socket
+import selectors
+import multiprocessing
+
+from . import apps
+from . import mmsg
+from .address import Address
+from .reflector import example_frame
+
+refcallsign = "M17-BNC"
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def connect(sock, ref, module):
+    """
+    CONN sock to module, waiting for the ACKN
+    """
+    sock.settimeout(.2)
+    while 1:
+        #the reflector might not be up yet
+        sock.sendto(b"CONN" + bytes(Address(callsign="N0CALL")) + module.encode("ascii"), ref)
+        try:
+            if sock.recv(64).startswith(b"ACKN"):
+                break
+        except socket.timeout:
+            pass
+    sock.setblocking(False)
+
+def listener(port, modules, ready, go, stop, results):
+    """
+    One socket per module, connected and counting frames from go until stop
+    """
+    ref = ("127.0.0.1", port)
+    socks = []
+    for module in modules:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sock.bind(("127.0.0.1", 0))
+        connect(sock, ref, module)
+        socks.append(sock)
+    ready.release()
+    go.wait()
+    sel = selectors.DefaultSelector()
+    rxs = {}
+    for sock in socks:
+        sel.register(sock, selectors.EVENT_READ)
+        rxs[sock] = mmsg.Receiver(sock)
+    got = 0
+    while not stop.is_set():
+        for key,_ in sel.select(.1):
+            for data, addr in rxs[key.fileobj].recv():
+                if data[:4] == b"M17 ":
+                    got += 1
+    results.put(("out", got))
+
+def talker(port, modules, streamid, ready, go, stop, results):
+    """
+    One socket per module, connected (the reflector only relays for its
+    clients) and sending a stream to each as fast as it can
+    """
+    ref = ("127.0.0.1", port)
+    txs = []
+    for i,module in enumerate(modules):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        connect(sock, ref, module)
+        frames = [(example_frame(streamid + i, "%s %s"%(refcallsign, module), fn), ref) for fn in range(64)]
+        txs.append((mmsg.Sender(sock), frames))
+    ready.release()
+    go.wait()
+    sent = 0
+    while not stop.is_set():
+        for tx, frames in txs:
+            sent += tx.send(frames)
+    results.put(("in", sent))
+
+def run(workers, seconds=5, modules="ABCDEFGH", listeners=2, talkers=2):
+    """
+    (frames in/s, frames out/s) with workers reflector processes
+    """
+    port = free_port()
+    procs = apps.start_reflector(refcallsign, port, workers)
+    ready = multiprocessing.Semaphore(0)
+    go = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    load = []
+    for l in range(listeners):
+        load.append(multiprocessing.Process(target=listener, args=(port, modules, ready, go, stop, results)))
+    for t in range(talkers):
+        load.append(multiprocessing.Process(target=talker, args=(port, modules, t * len(modules), ready, go, stop, results)))
+    try:
+        for p in load:
+            p.start()
+        for p in load:
+            ready.acquire()
+        go.set()
+        time.sleep(seconds)
+        stop.set()
+        totals = {"in": 0, "out": 0}
+        for p in load:
+            kind, n = results.get()
+            totals[kind] += n
+        for p in load:
+            p.join()
+    finally:
+        for p in procs + load:
+            p.terminate()
+    return totals["in"] / seconds, totals["out"] / seconds
+
+def main(args):
+    seconds = float(args[0]) if args else 5
+    counts = [int(w) for w in args[1:]] or [1, 2, 4]
+    print("%d cores"%(multiprocessing.cpu_count()))
+    print("%8s %12s %12s %8s"%("workers", "in/s", "out/s", "scaling"))
+    base = None
+    for workers in counts:
+        fin, fout = run(workers, seconds)
+        base = base or fout
+        print("%8d %12.0f %12.0f %8.2f"%(workers, fin, fout, fout / base if base else 0))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
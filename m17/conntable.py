@@ -0,0 +1,167 @@
+"""
+Who's connected to a udp_server, and who's gone quiet.
+
+A peer counts as connected until timeout seconds after the last packet
+from it. Hearing from a peer just stores the time, O(1), and a min-heap
+of expiry times says who to check next, so expire() only ever looks at
+peers that might actually be due - O(log n) each, instead of going over
+everyone on every packet.
+
+The heap isn't updated when a peer is heard from again, so its entries
+can be out of date. That's fine: when one comes up, the peer's real last
+seen time gets checked, and if it's been heard from since, it goes back
+on the heap with the right time. One heap entry per peer, always.
+
+>>> c = fake_clock()
+>>> gone = []
+>>> t = ConnectionTable(timeout=30, on_expire=gone.append, clock=c.clock)
+>>> t.seen(("10.0.0.1", 17000)), t.seen(("10.0.0.2", 17000))
+(True, True)
+>>> c.now += 20; t.seen(("10.0.0.1", 17000))
+False
+>>> c.now += 15; t.expire()
+[('10.0.0.2', 17000)]
+>>> gone, list(t)
+([('10.0.0.2', 17000)], [('10.0.0.1', 17000)])
+"""
+import time
+import heapq
+import unittest
+
+from .misc import fake_clock
+
+class ConnectionTable:
+    """
+    timeout - seconds without a packet before a peer's dropped
+    on_expire(conn) - called for each peer as it's dropped
+    clock - time.monotonic, or something standing in for it in tests
+
+    Iterating (or keys()) gives the connected peers, table[conn] is when
+    that one was last heard from.
+    """
+    def __init__(self, timeout=30, on_expire=None, clock=time.monotonic):
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.clock = clock
+        self.last_seen = {}
+        self.heap = []
+        self.queued = set() #conns with an entry on the heap
+
+    def seen(self, conn, now=None):
+        """
+        Heard from conn, returns True if it's new
+        """
+        now = self.clock() if now is None else now
+        new = conn not in self.last_seen
+        self.last_seen[conn] = now
+        if conn not in self.queued:
+            self.queued.add(conn)
+            heapq.heappush(self.heap, (now + self.timeout, conn))
+        return new
+
+    def remove(self, conn):
+        """
+        Forget conn now (like on a disconnect), without calling on_expire
+        """
+        #its heap entry gets thrown away when it comes up
+        self.last_seen.pop(conn, None)
+
+    def expire(self, now=None):
+        """
+        Drop every peer that's timed out, returning them
+        """
+        now = self.clock() if now is None else now
+        heap = self.heap
+        last_seen = self.last_seen
+        gone = []
+        while heap and heap[0][0] <= now:
+            _, conn = heapq.heappop(heap)
+            last = last_seen.get(conn)
+            if last is not None and last + self.timeout > now:
+                #heard from since this entry went on
+                heapq.heappush(heap, (last + self.timeout, conn))
+                continue
+            self.queued.discard(conn)
+            if last is None:
+                continue #removed
+            del last_seen[conn]
+            gone.append(conn)
+            if self.on_expire is not None:
+                self.on_expire(conn)
+        return gone
+
+    def next_expiry(self):
+        """
+        The soonest anyone could time out (maybe sooner than they really
+        will), or None with nobody connected - for how long to sleep
+        """
+        heap = self.heap
+        while heap and heap[0][1] not in self.last_seen:
+            self.queued.discard(heapq.heappop(heap)[1])
+        return heap[0][0] if heap else None
+
+    def keys(self):
+        return self.last_seen.keys()
+
+    def __iter__(self):
+        return iter(self.last_seen)
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def __contains__(self, conn):
+        return conn in self.last_seen
+
+    def __getitem__(self, conn):
+        return self.last_seen[conn]
+
+class test_conntable(unittest.TestCase):
+    def test_refresh_keeps_alive(self):
+        c = fake_clock()
+        t = ConnectionTable(timeout=10, clock=c.clock)
+        for _ in range(100):
+            t.seen("a")
+            c.now += 5
+            self.assertEqual(t.expire(), [])
+        self.assertEqual(list(t), ["a"])
+        self.assertEqual(len(t.heap), 1)
+        c.now += 5
+        self.assertEqual(t.expire(), ["a"])
+        self.assertEqual((len(t), t.heap), (0, []))
+
+    def test_expiry_order(self):
+        import random
+        c = fake_clock()
+        t = ConnectionTable(timeout=30, clock=c.clock)
+        last = {}
+        for step in range(2000):
+            c.now += random.uniform(0, .1)
+            if step < 1000:
+                i = random.randrange(300)
+                t.seen(i)
+                last[i] = c.now
+            t.expire()
+            self.assertEqual(set(t), set(i for i in last if last[i] + 30 > c.now))
+            self.assertEqual(len(t.heap), len(t.queued))
+        #everyone left goes in one batch, soonest first
+        left = set(t)
+        c.now += 30
+        gone = t.expire()
+        self.assertEqual(set(gone), left)
+        self.assertEqual(sorted(gone, key=last.get), gone)
+        self.assertIsNone(t.next_expiry())
+
+    def test_remove(self):
+        c = fake_clock()
+        gone = []
+        t = ConnectionTable(timeout=10, on_expire=gone.append, clock=c.clock)
+        t.seen("a")
+        t.remove("a")
+        c.now += 5
+        t.seen("a") #back again before its old heap entry came up
+        self.assertEqual(len(t.heap), 1)
+        c.now += 9
+        self.assertEqual(t.expire(), [])
+        c.now += 1
+        self.assertEqual(t.expire(), ["a"])
+        self.assertEqual(gone, ["a"])
@@ -0,0 +1,149 @@
+"""
+M17 CRC-16: polynomial 0x5935, initial value 0xFFFF, not reflected, no final xor.
+
+Table driven, slicing-by-8 for single frames, and a numpy path that
+checks a whole buffer of back to back frames at once.
+
+>>> hex(crc16(b"123456789"))
+'0x772b'
+
+Because there's no final xor, running the CRC over a frame including
+its big endian CRC comes out to zero, which is how frames get checked:
+
+>>> data = b"M17 some frame data"
+>>> crc_ok(data + crc16(data).to_bytes(2, "big"))
+True
+"""
+import struct
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None #only needed for the batch functions
+
+poly = 0x5935
+init = 0xFFFF
+
+class CRCError(Exception):
+    pass
+
+def _make_tables(n):
+    """
+    tables[0] is the usual byte-at-a-time table, i.e. i*x^16 mod P.
+    tables[k] pushes that through another k bytes of zeros, i*x^(16+8k) mod P,
+    which is what lets us fold 8 bytes in at once.
+    """
+    t = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+        t.append(crc)
+    tables = [t]
+    for _ in range(n-1):
+        prev = tables[-1]
+        tables.append([((c << 8) & 0xFFFF) ^ t[c >> 8] for c in prev])
+    return tables
+
+_tables = _make_tables(8)
+_t1,_t2,_t3,_t4,_t5,_t6,_t7,_t8 = _tables
+_eight = struct.Struct("8B")
+
+def crc16(data, crc=init):
+    """
+    CRC-16 of data (anything bytes-like).
+    Pass a previous result as crc to continue a running CRC.
+    """
+    data = memoryview(data).cast("B")
+    n = len(data)
+    whole = n - n%8
+    t1,t2,t3,t4,t5,t6,t7,t8 = _tables
+    for a,b,c,d,e,f,g,h in _eight.iter_unpack(data[:whole]):
+        crc = (t8[(crc >> 8) ^ a] ^ t7[(crc & 0xFF) ^ b] ^ t6[c] ^ t5[d]
+                ^ t4[e] ^ t3[f] ^ t2[g] ^ t1[h])
+    for b in data[whole:]:
+        crc = ((crc << 8) & 0xFFFF) ^ t1[(crc >> 8) ^ b]
+    return crc
+
+def crc_ok(data):
+    """
+    True if data ends with a valid big endian CRC of everything before it
+    """
+    return crc16(data) == 0
+
+if numpy is not None:
+    _np_t1 = numpy.array(_t1, dtype=numpy.uint16)
+    _np_t2 = numpy.array(_t2, dtype=numpy.uint16)
+
+def _frames_array(buf, size):
+    if numpy is None:
+        raise(Exception("Batch CRCs need numpy, install it or `pip install m17[Codec2]`"))
+    if isinstance(buf, numpy.ndarray) and buf.ndim == 2:
+        return buf.view(numpy.uint8) if buf.dtype != numpy.uint8 else buf
+    count = len(memoryview(buf).cast("B")) // size
+    return numpy.frombuffer(buf, dtype=numpy.uint8, count=count*size).reshape(count, size)
+
+def crc16_many(buf, size):
+    """
+    CRC-16 of every size-byte frame in a contiguous buffer, as a numpy
+    uint16 array. Works down the columns two bytes at a time, so it's
+    size/2 vectorized steps no matter how many frames there are.
+    A 2d uint8 array of frames (one per row) works for buf too.
+    """
+    frames = _frames_array(buf, size)
+    size = frames.shape[1]
+    crc = numpy.full(frames.shape[0], init, dtype=numpy.uint16)
+    whole = size - size%2
+    for j in range(0, whole, 2):
+        word = (frames[:,j].astype(numpy.uint16) << 8) | frames[:,j+1]
+        v = crc ^ word
+        crc = _np_t2[v >> 8] ^ _np_t1[v & 0xFF]
+    if whole != size:
+        crc = ((crc << 8) & 0xFFFF) ^ _np_t1[(crc >> 8) ^ frames[:,whole]]
+    return crc
+
+def crc_ok_many(buf, size):
+    """
+    Boolean array marking which size-byte frames in buf have a valid CRC in their last two bytes
+
+    >>> good = b"frame one" + crc16(b"frame one").to_bytes(2, "big")
+    >>> crc_ok_many(good + b"frame two\\x00\\x00" + good, len(good)).tolist()
+    [True, False, True]
+    """
+    return crc16_many(buf, size) == 0
+
+class test_crc(unittest.TestCase):
+    def test_vectors(self):
+        #from the M17 spec
+        self.assertEqual(crc16(b""), 0xFFFF)
+        self.assertEqual(crc16(b"A"), 0x206E)
+        self.assertEqual(crc16(b"123456789"), 0x772B)
+        self.assertEqual(crc16(bytes(range(256))), 0x1C31)
+
+    def test_running(self):
+        data = bytes(range(100))
+        self.assertEqual(crc16(data[37:], crc16(data[:37])), crc16(data))
+
+    def test_bitwise(self):
+        import random
+        def slow(data):
+            crc = init
+            for byte in data:
+                crc ^= byte << 8
+                for _ in range(8):
+                    crc = ((crc << 1) ^ poly) if crc & 0x8000 else (crc << 1)
+                    crc &= 0xFFFF
+            return crc
+        for n in range(40):
+            data = bytes(random.getrandbits(8) for _ in range(n))
+            self.assertEqual(crc16(data), slow(data))
+
+    @unittest.skipIf(numpy is None, "batch CRCs need numpy")
+    def test_many(self):
+        import random
+        for size in [53, 54]:
+            frames = [bytes(random.getrandbits(8) for _ in range(size)) for _ in range(20)]
+            crcs = crc16_many(b"".join(frames), size)
+            self.assertEqual(crcs.tolist(), [crc16(f) for f in frames])
@@ -1,4 +1,5 @@
 import random
+import struct
 try:
     from .address import Address
     from .frames import *
@@ -6,11 +7,32 @@ except:
     from address import Address
     from frames import *
 
+_u16 = struct.Struct(">H")
+
 
 class M17_RFFramer:
+    """
+    Turns a stream of payload bytes into numbered M17 frames.
+
+    feed() takes bytes in whatever sized pieces they show up in, yields
+    frames as soon as there's a full payload's worth, and holds on to
+    the rest for the next call:
+
+    >>> framer = M17_RFFramer(src=Address(callsign="W2FBI"), dst=Address(callsign="SP5WWP"), streamtype=5, nonce=bytes(14))
+    >>> [f.frame_number for f in framer.feed(b"c2 bits!" * 3)]
+    [0]
+    >>> framer.pending()
+    8
+    >>> [f.frame_number for f in framer.feed(b"c2 bits!")]
+    [1]
+
+    flush() pads out whatever is left into one last frame.
+    Both are generators, so make sure to run them to the end.
+    """
     def __init__(self, *args, **kwargs):
         self.packet_count = 0
         self.LICH = initialLICH(*args,**kwargs)
+        self._partial = bytearray()
 
     def makeLICH(self):
         return bytes(self.LICH)
@@ -20,37 +42,129 @@ class M17_RFFramer:
         d = initialLICH.dict_from_bytes( data )
         return cls( **d )
 
+    def make_frame(self, payload:bytes):
+        return regularFrame(LICH=self.LICH, frame_number=self.packet_count, payload=payload)
+
+    def _next_frame(self, payload:bytes):
+        pkt = self.make_frame(bytes(payload))
+        self.packet_count+=1
+        if self.packet_count >= 2**16:
+            self.packet_count = 0
+        return pkt
+
+    def pending(self):
+        """
+        Bytes held over waiting for a full payload
+        """
+        return len(self._partial)
+
+    def feed(self, data:bytes):
+        return self._feed(data, self._next_frame)
+
+    def _feed(self, data, make):
+        sz = regularFrame.payload_sz
+        partial = self._partial
+        data = memoryview(data).cast("B")
+        start = 0
+        if partial:
+            start = min(sz - len(partial), len(data))
+            partial += data[:start]
+            if len(partial) < sz:
+                return
+            payload = bytes(partial)
+            partial.clear()
+            yield make(payload)
+        end = len(data) - (len(data) - start) % sz
+        for i in range(start, end, sz):
+            yield make(data[i:i+sz])
+        partial += data[end:]
+
+    def flush(self):
+        if self._partial:
+            sz = regularFrame.payload_sz
+            payload = bytes(self._partial) + b"\x00"*(sz - len(self._partial))
+            self._partial.clear()
+            yield self._next_frame(payload)
+
     def payload_stream( self, payload:bytes):
-        LICH = self.LICH
-        payloads = chunk( payload, regularFrame.payload_sz )
-        pkts = []
-        for p in payloads:
-            if len(p) < regularFrame.payload_sz:
-                p = p + b"\x00"*(regularFrame.payload_sz - len(p))
-            pkt = regularFrame(LICH=LICH, frame_number=self.packet_count, payload=p)
-            self.packet_count+=1
-            if self.packet_count >= 2**16:
-                self.packet_count = 0
-            pkts.append(pkt)
+        """
+        Frame a whole payload at once, zero padding the last frame
+        """
+        pkts = list(self.feed(payload))
+        pkts.extend(self.flush())
         return pkts
 
 class M17_IPFramer(M17_RFFramer):
+    """
+    Same as M17_RFFramer but makes ipFrames.
+
+    Everything before the frame number in an ipFrame ("M17 ", streamid,
+    and the full LICH) stays the same for the whole stream, so that gets
+    rendered once into a preallocated frame buffer. render() and
+    feed_rendered() then only write the frame number, payload and CRC
+    in place and hand back a memoryview of the buffer - no frame objects,
+    no per frame allocation.
+
+    The memoryview gets overwritten by the next frame, so send it (or
+    copy it) before asking for another:
+
+    >>> framer = M17_IPFramer(streamid=0xf00d, src=Address(callsign="W2FBI"), dst=Address(callsign="SP5WWP"), streamtype=5, nonce=bytes(14))
+    >>> view = framer.render(bytes(16))
+    >>> ipFrameView(view).frame_number, ipFrameView(view).crc_ok()
+    (0, True)
+    >>> [bytes(v) == bytes(f) for v,f in zip(framer.feed_rendered(bytes(32)), M17_IPFramer.from_framer(framer, 1).feed(bytes(32)))]
+    [True, True]
+
+    Call render_template() again after changing streamid or the LICH.
+    """
     def __init__(self, *args, **kwargs):
         self.streamid = kwargs.pop("streamid", random.randint(0,2**16-1))
         super().__init__(*args,**kwargs)
+        self._frame = bytearray(ipFrame.sz)
+        self._frame_view = memoryview(self._frame)
+        self.render_template()
 
-    def payload_stream( self, payload:bytes):
-        #only difference is which frame we use, ipFrame instead of regularFrame
+    @classmethod
+    def from_framer(cls, other, packet_count=0):
+        """
+        Another framer for the same stream, starting at packet_count
+        """
+        LICH = other.LICH
+        framer = cls(streamid=other.streamid, src=LICH.src, dst=LICH.dst, streamtype=LICH.streamtype, nonce=LICH.nonce)
+        framer.packet_count = packet_count
+        return framer
+
+    def render_template(self):
         LICH = self.LICH
-        payloads = chunk( payload, regularFrame.payload_sz )
-        pkts = []
-        for p in payloads:
-            if len(p) < regularFrame.payload_sz:
-                p = p + b"\x00"*(regularFrame.payload_sz - len(p))
-            pkt = ipFrame(streamid=self.streamid, LICH=LICH, frame_number=self.packet_count, payload=p)
-            self.packet_count+=1
-            if self.packet_count >= 2**16:
-                self.packet_count = 0
-            pkts.append(pkt)
-        return pkts
+        pack_ipframe_into(self._frame, 0, self.streamid,
+                LICH.dst, LICH.src, LICH.streamtype, LICH.nonce,
+                0, bytes(regularFrame.payload_sz), 0)
+        #CRC register state after the fixed part, so per frame we only run it over what changed
+        self._header_crc = crc16(self._frame_view[:ipFrameView.fn_offset])
+
+    def render(self, payload:bytes):
+        """
+        Fill in the next frame from a payload_sz byte payload, returning a
+        memoryview of the frame that's only valid until the next render()
+        """
+        buf = self._frame
+        view = self._frame_view
+        fn = ipFrameView.fn_offset
+        crc_at = ipFrameView.crc_offset
+        _u16.pack_into(buf, fn, self.packet_count)
+        buf[ipFrameView.payload_offset:crc_at] = payload
+        _u16.pack_into(buf, crc_at, crc16(view[fn:crc_at], self._header_crc))
+        self.packet_count+=1
+        if self.packet_count >= 2**16:
+            self.packet_count = 0
+        return view
 
+    def feed_rendered(self, data:bytes):
+        """
+        Like feed(), but yields rendered memoryviews instead of ipFrames
+        """
+        return self._feed(data, self.render)
+
+    def make_frame(self, payload:bytes):
+        #only difference is which frame we use, ipFrame instead of regularFrame
+        return ipFrame(streamid=self.streamid, LICH=self.LICH, frame_number=self.packet_count, payload=payload)
@@ -1,14 +1,30 @@
 
+import time
+import struct
+import itertools
+import operator
+import collections
+
 import bitstruct
 try:
     from .address import Address
     from .const import *
+    from .crc import crc16, crc_ok, CRCError
     from .misc import _x, chunk, example_bytes
 except:
     from address import Address
     from const import *
+    from crc import crc16, crc_ok, CRCError
     from misc import _x, chunk, example_bytes
 
+#Precompiled layouts, so we aren't re-parsing format strings per field per frame.
+#struct has no 48 bit type, so addresses get split into a 16 bit high and 32 bit low half.
+_u16 = struct.Struct(">H")
+_addr = struct.Struct(">HI")
+_lich_struct = struct.Struct(">HIHIH14s") #dst, src, streamtype, nonce
+_ipframe_struct = struct.Struct(">4sH" + _lich_struct.format[1:] + "H16sH")
+_ipframe_crc_offset = _ipframe_struct.size - 2
+
 class initialLICH:
     """
     parts that get replicated in regularFrames:
@@ -16,21 +32,46 @@ class initialLICH:
         48b  Address src
         16b  int(M17_streamtype)
         112b nonce (for encryption)
-        #if actually sent on RF, needs a 16bit CRC also
+        16b  CRC, only when actually sent on RF (i.e. in the chunks)
     """
+    __slots__ = ("_src", "_dst", "_streamtype", "_nonce", "_chunks")
     sz = int((48+48+16+112)/8)
+    n_chunks = 5
     def __init__(self, 
             src:Address=None, 
             dst:Address=None,
             streamtype=None,
             nonce=None):
 
-        self.src = src
-        self.dst = dst
-        self.streamtype = streamtype
-        self.nonce = nonce 
+        #straight into the slots, this is on the per frame path
+        self._src = src
+        self._dst = dst
+        self._streamtype = streamtype
+        self._nonce = nonce 
+        self._chunks = None
         assert len(nonce) == 14
 
+    def _field(name):
+        #reads go through a C level getter, only setting has to drop the cached chunks
+        def set(self, value):
+            setattr(self, name, value)
+            self._chunks = None
+        return property(operator.attrgetter(name), set)
+    src = _field("_src")
+    dst = _field("_dst")
+    streamtype = _field("_streamtype")
+    nonce = _field("_nonce")
+    del _field
+
+    def load(self, data:bytes):
+        """
+        Take on the LICH in data
+        """
+        d = initialLICH.dict_from_bytes(data)
+        self._src, self._dst, self._streamtype, self._nonce = d["src"], d["dst"], d["streamtype"], d["nonce"]
+        self._chunks = None
+        return self
+
     def __eq__(self, other):
         return bytes(self) == bytes(other)
         # for name in ["src","dst","streamtype","nonce"]:
@@ -44,16 +85,30 @@ class initialLICH:
         return "LICH: " + self.src.callsign + " =[%d]> "%(self.streamtype) + self.dst.callsign
 
     def __bytes__(self):
-        b = b""
-        b += bitstruct.pack("u48",self.dst.addr)
-        b += bitstruct.pack("u48",self.src.addr)
-        b += bitstruct.pack("u16",self.streamtype)
-        b += self.nonce
-        return b
+        b = bytearray(self.sz)
+        self.pack_into(b)
+        return bytes(b)
+
+    def pack_into(self, buf, offset=0):
+        """
+        Write the LICH into a caller supplied buffer (bytearray, memoryview, mmap...)
+        """
+        dst = int(self._dst)
+        src = int(self._src)
+        _lich_struct.pack_into(buf, offset,
+                dst >> 32, dst & 0xffffffff,
+                src >> 32, src & 0xffffffff,
+                self._streamtype, bytes(self._nonce))
 
     def chunks(self):
-        me = bytes(self)
-        return chunk( me, 6)
+        """
+        The LICH plus its CRC, split into the 6 byte pieces that ride along in regularFrames
+        Worked out once and cached until the LICH changes.
+        """
+        if self._chunks is None:
+            me = bytes(self)
+            self._chunks = tuple(chunk( me + _u16.pack(crc16(me)), 6))
+        return self._chunks
 
     @staticmethod
     def from_bytes(data:bytes):
@@ -63,38 +118,129 @@ class initialLICH:
     @staticmethod
     def dict_from_bytes(data:bytes):
         d = {}
-        d["dst"], d["src"], d["streamtype"] = bitstruct.unpack("u48u48u16", data[:14])
-        d["dst"] = Address(addr=d["dst"])
-        d["src"] = Address(addr=d["src"])
-        d["nonce"] = data[14:14+14]
+        dst_hi, dst_lo, src_hi, src_lo, d["streamtype"], d["nonce"] = _lich_struct.unpack_from(data)
+        d["dst"] = Address(addr=dst_hi << 32 | dst_lo)
+        d["src"] = Address(addr=src_hi << 32 | src_lo)
         return d
 
     @staticmethod
     def recover_bytes_from_bytes_frames( bytes_frames:list):
-        frames = [ regularFrame.dict_from_bytes(b) for b in bytes_frames ]
-        #frame number gives us the idea of which part of the LICH we have in it
-        #assuming that the first regular frame has the first part of the lich
-        #per the spec
-        #so we really just need one each of the "numbers on the clock"
-        #so we could do this better by taking in packets and returning a LICH once 
-        #each spot is filled, which might be more robust
-
-        #code below assumes there's a solution in the frames, that there's only one frame
-        #for each spot on the "clock", etc, so it will be fragile with real RF
-
-        idx_frame_number = [ (frames.index(x), x["frame_number"]) for x in frames]
-        # idx_frame_number = [ (0,9),(1,10),(2,11),(3,12),(4,13) ]
-        #reorder so fn%5 == 0 is first
-        # print( list(map( lambda x: x, idx_frame_number) ) )
-        zeroth_chunk = list(map( lambda x: x[1]%5 == 0, idx_frame_number)).index(True)
-        # print(zeroth_chunk)
-        reordered = frames[zeroth_chunk:] + frames[0:zeroth_chunk]
-        # print(reordered)
-        b=b""
-        for p in reordered:
-            b += p["lich_chunk"]
-        return b
+        """
+        Put the LICH chunks from a set of regularFrames (as bytes) back
+        together, using frame_number%5 to know which piece each one holds.
+        Later frames win if a slot shows up more than once.
+        See LICHReassembler for doing this incrementally on a live feed.
+        """
+        slots = [b""] * initialLICH.n_chunks
+        for b in bytes_frames:
+            d = regularFrame.dict_from_bytes(b)
+            slots[ d["frame_number"] % initialLICH.n_chunks ] = d["lich_chunk"]
+        return b"".join(slots)
+
+class _LICHSlots:
+    __slots__ = ("chunks", "filled", "last_seen", "lich")
+    def __init__(self):
+        self.chunks = [None] * initialLICH.n_chunks
+        self.filled = 0
+        self.last_seen = 0
+        self.lich = None
+
+class LICHReassembler:
+    """
+    Rebuilds initialLICHs from a live feed of regularFrames, one frame
+    at a time, for any number of interleaved streams.
+
+    Each frame's chunk goes straight into its frame_number%5 slot, and
+    once all five slots of a stream are filled (and the LICH CRC checks
+    out) the initialLICH comes back from add(). After that it's only
+    returned again if it changes, e.g. a new transmission on the same stream.
+
+    Streams not heard from for timeout seconds are dropped, and there are
+    never more than max_streams kept (least recently heard go first), so
+    memory stays bounded with abandoned streams on a live RF feed.
+
+    stream can be anything hashable that tells streams apart, e.g. a
+    channel, a receiver, or a (host,port).
+    """
+    def __init__(self, max_streams=64, timeout=10):
+        self.max_streams = max_streams
+        self.timeout = timeout
+        self.streams = collections.OrderedDict()
+
+    def add(self, data, stream=None):
+        """
+        Add a regularFrame (as bytes, or a regularFrame with a lich_chunk)
+        Returns an initialLICH when one is newly complete, otherwise None.
+        A frame with a bad CRC throws away what's been collected for the
+        stream so far, since there's no telling which chunk it was.
+        """
+        if isinstance(data, regularFrame):
+            frame_number, lich_chunk = data.frame_number, data.lich_chunk
+        else:
+            try:
+                d = regularFrame.dict_from_bytes(data)
+            except CRCError:
+                self.discard(stream)
+                return None
+            frame_number, lich_chunk = d["frame_number"], d["lich_chunk"]
+        return self.add_chunk(frame_number, lich_chunk, stream)
+
+    def add_chunk(self, frame_number, lich_chunk, stream=None):
+        now = time.monotonic()
+        streams = self.streams
+        st = streams.get(stream)
+        if st is None:
+            st = streams[stream] = _LICHSlots()
+        else:
+            streams.move_to_end(stream)
+        st.last_seen = now
+        self.expire(now)
+
+        idx = frame_number % initialLICH.n_chunks
+        if st.chunks[idx] is None:
+            st.filled += 1
+        st.chunks[idx] = bytes(lich_chunk)
+        if st.filled < initialLICH.n_chunks:
+            return None
+
+        b = b"".join(st.chunks)
+        st.chunks = [None] * initialLICH.n_chunks
+        st.filled = 0
+        if not crc_ok(b):
+            return None #mixed up chunks from two different LICHs, start over
+        if st.lich is not None and bytes(st.lich) == b[:initialLICH.sz]:
+            return None
+        st.lich = initialLICH.from_bytes(b)
+        return st.lich
+
+    def discard(self, stream=None):
+        """
+        Forget the chunks collected so far for stream (but not its last LICH)
+        """
+        st = self.streams.get(stream)
+        if st is not None:
+            st.chunks = [None] * initialLICH.n_chunks
+            st.filled = 0
+
+    def get(self, stream=None):
+        """
+        Most recently completed LICH for a stream, or None
+        """
+        st = self.streams.get(stream)
+        return st.lich if st else None
 
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        streams = self.streams
+        while streams:
+            oldest = next(iter(streams.values()))
+            if len(streams) > self.max_streams or oldest.last_seen + self.timeout < now:
+                streams.popitem(last=False)
+            else:
+                break
+
+    def __len__(self):
+        return len(self.streams)
 
 class regularFrame:
     """
@@ -103,9 +249,11 @@ class regularFrame:
     128b payload
     16b  CRC-16 chksum
     """
-    sz = int((48+16+128)/8)
+    sz = int((48+16+128+16)/8)
     lich_chunk_sz = int(48/8);
     payload_sz = int(128/8)
+    check_crc = True #set False to accept frames from senders that leave the CRC zeroed
+    __slots__ = ("LICH", "lich_chunk", "frame_number", "payload")
     def __init__(self, frame_number, payload, LICH:initialLICH=None, lich_chunk:bytes=None):
         """
         Can instantiate with either a full LICH object or just a lich_chunk 
@@ -114,8 +262,11 @@ class regularFrame:
         self.lich_chunk = lich_chunk
         self.frame_number = frame_number
         self.payload = payload
-        if self.LICH:
-            self.LICH_chunks = self.LICH.chunks()
+
+    @property
+    def LICH_chunks(self):
+        return self.LICH.chunks()
+
     def __eq__(self, other):
         return bytes(self) == bytes(other)
 
@@ -125,15 +276,14 @@ class regularFrame:
     def __bytes__(self):
         b=b""
         if self.LICH:
-            lich_chunk_idx = self.frame_number % 5; 
+            lich_chunk_idx = self.frame_number % initialLICH.n_chunks
             assert len(self.LICH_chunks[lich_chunk_idx]) == 48/8
             b += self.LICH_chunks[lich_chunk_idx]
         else:
             b += self.lich_chunk
         b += bitstruct.pack("u16", self.frame_number)
         b += bytes(self.payload)
-        b += bytes([0]*2) #crc16
-        # b += bitstruct.pack("u4",0)
+        b += _u16.pack(crc16(b))
         return b
 
     @classmethod
@@ -143,14 +293,26 @@ class regularFrame:
 
     @staticmethod
     def dict_from_bytes(data:bytes):
+        if regularFrame.check_crc and not crc_ok(data[:regularFrame.sz]):
+            raise(CRCError("Bad CRC on regularFrame"))
         d = {}
         d["lich_chunk"] = data[0:6]
         d["frame_number"]= bitstruct.unpack("u16", data[6:8])[0]
         d["payload"] = data[8:8+16]
-        #ignore the CRC, it's not implemented yet
-        # d["chksum"] = bitstruct.unpack("u16", data[8+16:8+16+2])[0]
         return d
 
+    def load(self, data:bytes):
+        """
+        Refill this frame in place from bytes, instead of making a new one
+        (see FramePool)
+        """
+        d = self.dict_from_bytes(data)
+        self.LICH = None
+        self.lich_chunk = d["lich_chunk"]
+        self.frame_number = d["frame_number"]
+        self.payload = d["payload"]
+        return self
+
 class ipFrame(regularFrame):
     """
     32b "M17 " 
@@ -161,6 +323,7 @@ class ipFrame(regularFrame):
     16b  CRC-16 chksum
     """
     sz = 4+2+initialLICH.sz+2+16+2
+    __slots__ = ("streamid",)
     def __init__(self, *args, **kwargs):
         self.streamid = kwargs.pop('streamid',0x0)
         super().__init__(*args,**kwargs)
@@ -171,35 +334,226 @@ class ipFrame(regularFrame):
         return "SID: %04x\n LICH: "%(self.streamid) + self.LICH.src.callsign + " =[%d]> "%(self.LICH.streamtype) + self.LICH.dst.callsign + "\nM17[%d]: %s"%(self.frame_number,_x(self.payload))
 
     def __bytes__(self):
-        b=b""
-        b += b"M17 "
-        b += bitstruct.pack("u16", self.streamid)
-        b += bytes(self.LICH)
-        b += bitstruct.pack("u16", self.frame_number)
-        b += bytes(self.payload)
-        b += bytes([0]*2) #crc16, TODO
-        assert self.sz == len(b)
-        return b
+        b = bytearray(self.sz)
+        self.pack_into(b)
+        return bytes(b)
+
+    def pack_into(self, buf, offset=0):
+        """
+        Serialize straight into a caller supplied buffer at offset,
+        e.g. a preallocated bytearray that gets reused for every frame
+        """
+        LICH = self.LICH
+        pack_ipframe_into(buf, offset, self.streamid,
+                LICH.dst, LICH.src, LICH.streamtype, LICH.nonce,
+                self.frame_number, self.payload)
 
     @staticmethod
     def is_m17(data:bytes):
         return data[0:4] == b"M17 "
 
     @staticmethod
-    def dict_from_bytes(data:bytes):
+    def _unpack(data:bytes):
         assert ipFrame.is_m17(data)
+        if ipFrame.check_crc and not crc_ok(data[:ipFrame.sz]):
+            raise(CRCError("Bad CRC on ipFrame"))
+        (_, streamid,
+            dst_hi, dst_lo, src_hi, src_lo, streamtype, nonce,
+            frame_number, payload, crc) = _ipframe_struct.unpack_from(data)
+        dst = Address(addr=dst_hi << 32 | dst_lo)
+        src = Address(addr=src_hi << 32 | src_lo)
+        return streamid, dst, src, streamtype, nonce, frame_number, payload
+
+    @staticmethod
+    def dict_from_bytes(data:bytes):
+        streamid, dst, src, streamtype, nonce, frame_number, payload = ipFrame._unpack(data)
         d = {}
-        d["streamid"]= bitstruct.unpack("u16", data[4:6])[0]
-        lich_start = 6
-        lich_end = lich_start+initialLICH.sz
-        payload_start = lich_end+2
-        payload_end = payload_start+16
-        d["LICH"] = initialLICH.from_bytes(data[lich_start:lich_end])
-        d["frame_number"]= bitstruct.unpack("u16", data[lich_end:payload_start])[0]
-        d["payload"] = data[payload_start:payload_end]
-        # d["crc"] = bitstruct.unpack("u16", ...
+        d["streamid"] = streamid
+        d["LICH"] = initialLICH(
+                dst=dst,
+                src=src,
+                streamtype=streamtype,
+                nonce=nonce)
+        d["frame_number"] = frame_number
+        d["payload"] = payload
         return d
 
+    def load(self, data:bytes):
+        """
+        Refill this frame (and its LICH) in place from bytes, instead of
+        making new ones (see FramePool)
+        """
+        streamid, dst, src, streamtype, nonce, frame_number, payload = ipFrame._unpack(data)
+        LICH = getattr(self, "LICH", None)
+        if LICH is None:
+            self.LICH = initialLICH(src=src, dst=dst, streamtype=streamtype, nonce=nonce)
+        elif not (LICH.nonce == nonce and LICH.streamtype == streamtype and LICH.dst is dst and LICH.src is src):
+            #same stream as last time is the usual case, and then there's nothing to do
+            LICH.dst = dst
+            LICH.src = src
+            LICH.streamtype = streamtype
+            LICH.nonce = nonce
+        self.lich_chunk = None
+        self.streamid = streamid
+        self.frame_number = frame_number
+        self.payload = payload
+        return self
+
+class FramePool:
+    """
+    Recycles frame objects in a decode loop, so a busy receiver isn't
+    allocating (and garbage collecting) a frame and LICH for every packet.
+
+        pool = FramePool(ipFrame)
+        while 1:
+            f = pool.from_bytes(sock.recv(1500))
+            ... use f ...
+            pool.release(f)
+
+    Once a frame is released it will get overwritten by a later
+    from_bytes(), so don't release anything that's still referenced
+    elsewhere (like sitting in a queue waiting to be pickled).
+    At most size frames are kept around for reuse.
+
+    >>> pool = FramePool(ipFrame, size=1)
+    >>> f = ipFrame(streamid=1, frame_number=2, payload=bytes(16), LICH=initialLICH(src=Address(callsign="W2FBI"), dst=Address(callsign="SP5WWP"), streamtype=5, nonce=bytes(14)))
+    >>> g = pool.from_bytes(bytes(f))
+    >>> g == f
+    True
+    >>> pool.release(g)
+    >>> pool.from_bytes(bytes(f)) is g
+    True
+    """
+    def __init__(self, cls=ipFrame, size=64):
+        self.cls = cls
+        self.size = size
+        self.free = []
+
+    def from_bytes(self, data:bytes):
+        f = self.free.pop() if self.free else self.cls.__new__(self.cls)
+        try:
+            return f.load(data)
+        except:
+            self.release(f)
+            raise
+
+    def release(self, frame):
+        if len(self.free) < self.size:
+            self.free.append(frame)
+
+def pack_ipframe_into(buf, offset, streamid, dst, src, streamtype, nonce, frame_number, payload, crc=None):
+    """
+    Write a whole ipFrame into buf at offset in a single struct call,
+    without building any frame or LICH objects.
+    dst and src can be Addresses or plain ints.
+    The CRC gets calculated over the written frame unless one is given.
+
+    >>> b = bytearray(ipFrame.sz)
+    >>> pack_ipframe_into(b, 0, 0xf00d, Address(callsign="SP5WWP"), Address(callsign="W2FBI"), 5, bytes(14), 3, bytes(16))
+    >>> ipFrameView(b).src.callsign
+    'W2FBI'
+    """
+    dst = int(dst)
+    src = int(src)
+    _ipframe_struct.pack_into(buf, offset, b"M17 ", streamid,
+            dst >> 32, dst & 0xffffffff,
+            src >> 32, src & 0xffffffff,
+            streamtype, bytes(nonce),
+            frame_number, bytes(payload), crc or 0)
+    if crc is None:
+        mv = memoryview(buf)
+        _u16.pack_into(buf, offset + _ipframe_crc_offset, crc16(mv[offset:offset + _ipframe_crc_offset]))
+
+class ipFrameView:
+    """
+    Lazy, zero-copy access to an ipFrame sitting in a receive buffer.
+
+    Nothing is parsed up front - each field is unpacked from the buffer
+    only when it's asked for, and nonce, payload and the LICH come back as
+    memoryview slices of the original buffer rather than copies.
+    Hang on to the view only as long as the buffer stays valid.
+
+    >>> f = ipFrame(streamid=0xf00d, frame_number=7, payload=bytes(range(16)),
+    ...     LICH=initialLICH(src=Address(callsign="W2FBI"), dst=Address(callsign="SP5WWP"), streamtype=5, nonce=bytes(14)))
+    >>> v = ipFrameView(bytes(f))
+    >>> hex(v.streamid), v.frame_number, v.dst.callsign
+    ('0xf00d', 7, 'SP5WWP')
+    >>> v.to_ipFrame() == f
+    True
+    """
+    __slots__ = ("buf",)
+    sz = ipFrame.sz
+    lich_offset = 6
+    fn_offset = lich_offset + initialLICH.sz
+    payload_offset = fn_offset + 2
+    crc_offset = payload_offset + regularFrame.payload_sz
+
+    def __init__(self, data, offset=0):
+        self.buf = memoryview(data)[offset:offset+self.sz]
+        if len(self.buf) < self.sz:
+            raise(Exception("Need %d bytes for an ipFrame, got %d"%(self.sz, len(self.buf))))
+
+    def is_m17(self):
+        return self.buf[0:4] == b"M17 "
+
+    @property
+    def streamid(self):
+        return _u16.unpack_from(self.buf, 4)[0]
+
+    @property
+    def dst_addr(self):
+        hi,lo = _addr.unpack_from(self.buf, self.lich_offset)
+        return hi << 32 | lo
+
+    @property
+    def src_addr(self):
+        hi,lo = _addr.unpack_from(self.buf, self.lich_offset + 6)
+        return hi << 32 | lo
+
+    @property
+    def dst(self):
+        return Address(addr=self.dst_addr)
+
+    @property
+    def src(self):
+        return Address(addr=self.src_addr)
+
+    @property
+    def streamtype(self):
+        return _u16.unpack_from(self.buf, self.lich_offset + 12)[0]
+
+    @property
+    def nonce(self):
+        return self.buf[self.lich_offset + 14:self.fn_offset]
+
+    @property
+    def lich(self):
+        return self.buf[self.lich_offset:self.fn_offset]
+
+    @property
+    def frame_number(self):
+        return _u16.unpack_from(self.buf, self.fn_offset)[0]
+
+    @property
+    def payload(self):
+        return self.buf[self.payload_offset:self.crc_offset]
+
+    @property
+    def crc(self):
+        return _u16.unpack_from(self.buf, self.crc_offset)[0]
+
+    def crc_ok(self):
+        return crc_ok(self.buf)
+
+    def __bytes__(self):
+        return bytes(self.buf)
+
+    def to_ipFrame(self):
+        """
+        Copy out into a full ipFrame object, for when you need to keep it around
+        """
+        return ipFrame.from_bytes(self.buf)
+
 def is_LICH( b:bytes ):
     """
     No real way to tell other than size with the implementation in this file
@@ -220,6 +574,25 @@ class M17_Frametype(int):
     2b: encryption-subtype
     remaining of 16: reserved
     codec2 3200bps voice stream 00101
+
+    Every one of the 65536 possible values gets decoded once, into a
+    table of immutable namedtuples, so looking at the bits of a
+    streamtype in the hot path is just an index:
+
+    >>> M17_Frametype.decode(5)
+    M17_FrametypeFields(is_stream=1, has_data=0, has_voice=1, non_codec2=0, non_3200bps=0, enc_type=0, enc_subtype=0, reserved=0)
+    >>> M17_Frametype(5).has_voice
+    1
+    >>> M17_Frametype.encode(is_stream=1, has_voice=1)
+    5
+    >>> M17_Frametype.encode(**M17_Frametype.decode(0x1ff)._asdict()) == 0x1ff
+    True
+    >>> M17_Frametype.decode(-1)
+    Traceback (most recent call last):
+    ...
+    ValueError: Not a 16 bit frame type: -1
+
+    The table gets built the first time it's needed.
     """
     fields = [
             (1, "is_stream"),
@@ -231,4 +604,45 @@ class M17_Frametype(int):
             (2, "enc_subtype"),
             (7, "reserved"),
             ]
+    _table = None
+
+    @classmethod
+    def table(cls):
+        if cls._table is None:
+            #product() counts up with the last range changing fastest,
+            #so highest field first gives every value in order
+            ranges = [range(1 << width) for width,_ in reversed(cls.fields)]
+            make = M17_FrametypeFields._make
+            cls._table = tuple(make(reversed(bits)) for bits in itertools.product(*ranges))
+        return cls._table
+
+    @classmethod
+    def decode(cls, value):
+        table = cls.table()
+        if not 0 <= value < len(table):
+            #a negative index would happily pick something off the end
+            raise(ValueError("Not a 16 bit frame type: %r"%(value,)))
+        return table[value]
+
+    @classmethod
+    def encode(cls, **kwargs):
+        value = 0
+        shift = 0
+        for width,name in cls.fields:
+            x = kwargs.pop(name, 0)
+            if not 0 <= x < (1 << width):
+                raise(Exception("%s doesn't fit in %d bits: %r"%(name, width, x)))
+            value |= x << shift
+            shift += width
+        if kwargs:
+            raise(Exception("Not M17_Frametype fields: %s"%(", ".join(kwargs))))
+        return cls(value)
+
+    def __getattr__(self, name):
+        #only called for names int doesn't have, i.e. our fields
+        if name in M17_FrametypeFields._fields:
+            #through decode(), so out of range values fail the same way
+            return getattr(self.decode(self), name)
+        raise(AttributeError(name))
 
+M17_FrametypeFields = collections.namedtuple("M17_FrametypeFields", [name for _,name in M17_Frametype.fields])
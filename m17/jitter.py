@@ -0,0 +1,316 @@
+"""
+Jitter buffer for received M17 streams.
+
+Frames come off the network late, early, out of order, or not at all,
+but codec2dec and the speaker want one frame every 40ms. JitterBuffer
+holds on to frames for a playout delay, hands them back in frame_number
+order on a steady schedule, and fills in the gaps.
+
+The delay adapts: it tracks the interarrival jitter the same way RTP
+does (RFC 3550, a running average of how far each frame's spacing is
+from 40ms) and aims for jitter_mult times that, between min_delay and
+max_delay. On a good link that's about one frame of delay; on a bad
+one it grows until frames stop missing their turn. It moves one frame
+at a time - repeating a frame to stretch, skipping one to shrink.
+
+Frames live in a ring of slots indexed by frame_number, so putting one
+in, taking the next one out, and throwing away one that's too late to
+play are all O(1).
+
+>>> from m17.address import Address
+>>> from m17.frames import initialLICH, ipFrame
+>>> lich = initialLICH(src=Address(callsign="W2FBI"), dst=Address(callsign="SP5WWP"), streamtype=5, nonce=bytes(14))
+>>> jb = JitterBuffer(min_delay=.08)
+>>> for fn, arrival in [(0, 0), (2, .07), (1, .09)]:
+...     _ = jb.push(ipFrame(streamid=1, LICH=lich, frame_number=fn, payload=bytes([fn])*16), arrival)
+>>> [(f.frame_number, f.payload[0]) for f in jb.pop(.17)]
+[(0, 0), (1, 1), (2, 2)]
+>>> [(f.frame_number, f.payload[0]) for f in jb.pop(.21)] #frame 3 never showed, so repeat 2
+[(3, 2)]
+"""
+import unittest
+
+from .frames import ipFrame
+
+EOS = 0x8000 #frame_number bit marking the last frame of a stream
+
+def fn_diff(a, b):
+    """
+    a - b for frame numbers, so that it comes out right across wraparound.
+    The counter's 15 bits, the top bit is the end of stream flag
+    >>> fn_diff(0, 0x7FFF), fn_diff(0x8003, 2)
+    (1, 1)
+    """
+    return (((a & 0x7FFF) - (b & 0x7FFF) + 0x4000) & 0x7FFF) - 0x4000
+
+class JitterBuffer:
+    """
+    push() frames as they arrive, pop() whatever is due, and wait until
+    next_deadline() in between. Times are in seconds, on whatever clock
+    the caller uses (time.monotonic() for real).
+
+        frame_time - how much audio each frame carries
+        min_delay, max_delay - limits for the playout delay
+        slots - most frames held at once, also how far ahead of the
+            playout point a frame can be before we assume the stream
+            jumped and start over
+        max_repeat - gaps get the last frame repeated this many times,
+            then silence
+        max_missing - after this many frames in a row are missing, the
+            stream's over: stop filling, wait for the next one
+        shrink_after - frames the delay has to be more than needed
+            before it comes down
+        silence - payload to fill with after max_repeat
+    """
+    def __init__(self, frame_time=.04, min_delay=.04, max_delay=.5, jitter_mult=3,
+            slots=64, max_repeat=2, max_missing=25, shrink_after=50, silence=bytes(16)):
+        self.frame_time = frame_time
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter_mult = jitter_mult
+        self.slots = slots
+        self.max_repeat = max_repeat
+        self.max_missing = max_missing
+        self.shrink_after = shrink_after
+        self.silence = silence
+        self.ring = [None] * slots
+        self.jitter = 0
+        self.last_arrival = None
+        self.ended = None #(streamid, last frame_number) of the stream that just ended
+        #stats
+        self.late = 0
+        self.concealed = 0
+        self.skipped = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the current stream (but not the jitter estimate)
+        """
+        self.playing = False
+        self.streamid = None
+        self.last = None
+        self.missing = 0
+        self.held = 0
+        self.end_fn = None
+        for i in range(self.slots):
+            self.ring[i] = None
+
+    def target_delay(self):
+        return min(self.max_delay, max(self.min_delay, self.jitter_mult * self.jitter))
+
+    def start(self, frame, now):
+        self.reset()
+        self.playing = True
+        self.streamid = frame.streamid
+        self.next_fn = frame.frame_number & 0x7FFF
+        self.delay = self.target_delay()
+        self.calm = 0
+        self.base = now + self.delay
+        self.tick = 0
+
+    def push(self, frame, now):
+        """
+        Add an arriving frame, returning False if it was thrown away for
+        being too late to play
+        """
+        fn = frame.frame_number & 0x7FFF
+        if self.last_arrival is not None and self.streamid == frame.streamid:
+            last_time, last_fn = self.last_arrival
+            d = (now - last_time) - fn_diff(fn, last_fn) * self.frame_time
+            self.jitter += (abs(d) - self.jitter) / 16
+        self.last_arrival = (now, fn)
+
+        if not self.playing and self.ended is not None:
+            streamid, end_fn = self.ended
+            if frame.streamid == streamid and fn_diff(fn, end_fn) <= 0:
+                #straggler from a stream that's already over
+                self.late += 1
+                return False
+        if not self.playing or frame.streamid != self.streamid:
+            self.start(frame, now)
+        ahead = fn_diff(fn, self.next_fn)
+        if ahead < 0:
+            self.late += 1
+            return False
+        if ahead >= self.slots:
+            #way past anything we're holding - the stream must have skipped
+            self.start(frame, now)
+        idx = fn % self.slots
+        if self.ring[idx] is None:
+            self.held += 1
+        self.ring[idx] = frame
+        if frame.frame_number & EOS:
+            #play up to here, then stop instead of filling in
+            self.end_fn = fn
+        return True
+
+    def next_deadline(self):
+        """
+        When the next frame is due out, or None if we're waiting on a stream
+        """
+        if not self.playing:
+            return None
+        return self.base + self.tick * self.frame_time
+
+    def filler(self, fn):
+        self.concealed += 1
+        last = self.last
+        payload = last.payload if self.missing <= self.max_repeat else self.silence
+        return ipFrame(streamid=last.streamid, LICH=last.LICH, frame_number=fn, payload=payload)
+
+    def take(self, fn):
+        idx = fn % self.slots
+        frame = self.ring[idx]
+        if frame is None or frame.frame_number & 0x7FFF != fn:
+            return None
+        self.ring[idx] = None
+        self.held -= 1
+        return frame
+
+    def adapt(self):
+        """
+        Move the delay a frame towards the target, by repeating or skipping
+        """
+        target = self.target_delay()
+        if target > self.delay + self.frame_time/2:
+            self.delay += self.frame_time
+            return "stretch"
+        if target <= self.delay - self.frame_time + 1e-9:
+            #only come down once it's been calm for a while, or we just
+            #go back and forth with every wobble in the estimate
+            self.calm += 1
+            if self.calm >= self.shrink_after and self.held > 1:
+                self.calm = 0
+                self.delay -= self.frame_time
+                return "shrink"
+        else:
+            self.calm = 0
+        return None
+
+    def play_one(self):
+        fn = self.next_fn
+        self.tick += 1
+        change = self.adapt() if self.last is not None and not self.missing else None
+        if change == "stretch":
+            #play the last frame again and push everything back a frame
+            self.concealed += 1
+            return ipFrame(streamid=self.last.streamid, LICH=self.last.LICH, frame_number=fn, payload=self.last.payload)
+        if change == "shrink":
+            if self.take(fn) is not None:
+                self.skipped += 1
+            fn = self.next_fn = (fn + 1) & 0x7FFF
+        self.next_fn = (fn + 1) & 0x7FFF
+        frame = self.take(fn)
+        if frame is not None:
+            self.last = frame
+            self.missing = 0
+        else:
+            self.missing += 1
+            if self.missing > self.max_missing or self.last is None:
+                self.reset()
+                return None
+            frame = self.filler(fn)
+        if fn == self.end_fn:
+            self.reset()
+            self.ended = (frame.streamid, fn)
+        return frame
+
+    def pop(self, now):
+        """
+        Every frame that's due by now, real or filler, in order
+        """
+        out = []
+        while self.playing and now >= self.next_deadline():
+            frame = self.play_one()
+            if frame is not None:
+                out.append(frame)
+        return out
+
+class test_jitter(unittest.TestCase):
+    def setUp(self):
+        from .address import Address
+        from .frames import initialLICH
+        self.lich = initialLICH(src=Address(callsign="W2FBI"), dst=Address(callsign="SP5WWP"), streamtype=5, nonce=bytes(14))
+
+    def frame(self, fn, streamid=1):
+        return ipFrame(streamid=streamid, LICH=self.lich, frame_number=fn & 0xFFFF, payload=bytes([fn & 0xFF])*16)
+
+    def run_stream(self, jb, arrivals, until):
+        """
+        arrivals is [(frame_number, time)], returns [(time, frame_number, payload byte)] played
+        """
+        arrivals = sorted(arrivals, key=lambda a: a[1])
+        played = []
+        t = 0
+        while t <= until:
+            while arrivals and arrivals[0][1] <= t:
+                fn, at = arrivals.pop(0)
+                jb.push(self.frame(fn), at)
+            for f in jb.pop(t):
+                played.append((round(t, 3), f.frame_number, f.payload[0]))
+            t = round(t + .005, 3)
+        return played
+
+    def test_in_order_steady(self):
+        jb = JitterBuffer()
+        played = self.run_stream(jb, [(fn, fn*.04) for fn in range(50)], 3)
+        #(after the end it fills in for max_missing frames, in case there's more coming)
+        self.assertEqual([p[1] for p in played[:50]], list(range(50)))
+        self.assertEqual([p[2] for p in played[:50]], list(range(50)))
+        self.assertEqual(played[0][0], .04) #min_delay on a clean link
+        self.assertEqual((jb.late, jb.skipped), (0, 0))
+
+    def test_reorder_and_late(self):
+        jb = JitterBuffer(min_delay=.08)
+        arrivals = [(fn, fn*.04) for fn in range(10)]
+        arrivals[3], arrivals[4] = (3, .17), (4, .16) #swapped, still in time
+        arrivals[6] = (6, .5) #way too late
+        played = self.run_stream(jb, arrivals, 1)
+        self.assertEqual([p[1] for p in played[:10]], list(range(10)))
+        #6 got repeated from 5, and the real 6 thrown away when it showed up
+        self.assertEqual([p[2] for p in played[:10]], [0,1,2,3,4,5,5,7,8,9])
+        self.assertEqual(jb.late, 1)
+
+    def test_adapts_to_jitter(self):
+        import random
+        rnd = random.Random(17)
+        jb = JitterBuffer()
+        arrivals = [(fn, fn*.04 + rnd.uniform(0, .12)) for fn in range(300)]
+        played = self.run_stream(jb, arrivals, 13)
+        self.assertGreater(jb.delay, .08)
+        real = [p[1] for p in played if p[1] & 0xFF == p[2]]
+        #nothing comes out of order or gets played twice
+        self.assertEqual(real, sorted(set(real)))
+        #and once it's settled, everything makes it in time - anything
+        #missing was skipped on purpose to bring the delay back down
+        missing = set(range(100, 300)) - set(real)
+        self.assertLessEqual(len(missing), jb.skipped)
+        self.assertLess(len(missing), 10)
+
+    def test_wraparound_and_end(self):
+        jb = JitterBuffer(max_missing=5)
+        played = self.run_stream(jb, [((0x7FFE + fn) & 0x7FFF, fn*.04) for fn in range(4)], 1)
+        self.assertEqual([p[1] for p in played][:4], [0x7FFE, 0x7FFF, 0, 1])
+        self.assertEqual(len(played), 4 + 5) #a few frames of filling in, then it gives up
+        self.assertFalse(jb.playing)
+        self.assertIsNone(jb.next_deadline())
+
+    def test_end_of_stream(self):
+        jb = JitterBuffer(min_delay=.08)
+        arrivals = [((0x7FFD + fn) & 0x7FFF, fn*.04) for fn in range(5)]
+        arrivals[-1] = (EOS | 1, 4*.04)
+        arrivals[2] = (0x7FFF, .5) #too late, so it gets filled in
+        played = self.run_stream(jb, arrivals, 2)
+        #nothing thrown away as late or out of order, nothing played past the end
+        self.assertEqual([p[1] for p in played], [0x7FFD, 0x7FFE, 0x7FFF, 0, EOS | 1])
+        self.assertEqual(jb.late, 1)
+        self.assertEqual(jb.concealed, 1)
+        self.assertFalse(jb.playing)
+        self.assertIsNone(jb.next_deadline())
+
+    def test_new_stream(self):
+        jb = JitterBuffer()
+        jb.push(self.frame(7), 0)
+        jb.push(self.frame(100, streamid=2), .01)
+        self.assertEqual([(f.streamid, f.frame_number) for f in jb.pop(1)][:1], [(2, 100)])
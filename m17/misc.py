@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import random
 import binascii
 import unittest
@@ -94,6 +95,204 @@ class test_nested_dattr(unittest.TestCase):
         x.abc.fed = "in"
         self.assertEqual(x.abc.fed, "in")
 
+class rechunker:
+    """
+    Cuts bytes arriving in any size pieces into exact size chunks.
+
+    Whole chunks inside a piece come back as memoryview slices of it, no
+    copying. Only a tail too short for a chunk gets copied, into a
+    bytearray, and the chunk it ends up starting gets finished off from
+    the next piece.
+
+    >>> r = rechunker(4)
+    >>> [bytes(c) for c in r.feed(b"abcdefghij")]
+    [b'abcd', b'efgh']
+    >>> [bytes(c) for c in r.feed(b"klmnop")], r.pending()
+    ([b'ijkl', b'mnop'], 0)
+    """
+    def __init__(self, size):
+        self.size = size
+        self.partial = bytearray()
+
+    def pending(self):
+        return len(self.partial)
+
+    def feed(self, data):
+        size = self.size
+        partial = self.partial
+        data = memoryview(data).cast("B")
+        out = []
+        start = 0
+        if partial:
+            start = min(size - len(partial), len(data))
+            partial += data[:start]
+            if len(partial) < size:
+                return out
+            #hand over this bytearray and start a fresh one, so the chunk stays valid
+            out.append(memoryview(partial))
+            partial = self.partial = bytearray()
+        end = len(data) - (len(data) - start) % size
+        out.extend(data[i:i+size] for i in range(start, end, size))
+        partial += data[end:]
+        return out
+
+class pacer:
+    """
+    Ticks at a steady rate, for sources that need to keep an exact cadence
+    (one 20ms audio frame, one 40ms M17 frame...) over long runs.
+
+    Every tick has a deadline of start + n/rate on time.monotonic(), and
+    wait() sleeps until the next one - so however long the work between
+    ticks takes, and however late a sleep wakes up, it doesn't add up
+    into drift the way sleep(1/rate) does.
+
+    If we get more than max_lag seconds behind (machine suspended,
+    debugger...), start over from now instead of bursting to catch up.
+
+    >>> t = pacer(50)
+    >>> t.wait(); t.wait() #second one returns 20ms after the first
+    """
+    def __init__(self, rate, max_lag=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.max_lag = max_lag
+        self.clock = clock
+        self.sleep = sleep
+        self.start = None
+        self.n = 0
+
+    def deadline(self):
+        return self.start + self.n / self.rate
+
+    def wait(self):
+        now = self.clock()
+        if self.start is None:
+            self.start = now
+        delay = self.deadline() - now
+        if delay > 0:
+            self.sleep(delay)
+        elif self.max_lag is not None and -delay > self.max_lag:
+            self.start = now
+            self.n = 0
+        self.n += 1
+
+class token_bucket:
+    """
+    Rate limiter: take() returns right away while there are tokens, and
+    sleeps just long enough otherwise. Tokens come back at rate per
+    second, up to burst of them saved up while idle.
+
+    Tokens are kept as a fraction against time.monotonic(), and taking
+    more than there are goes into debt that the next refill pays back,
+    so oversleeping doesn't cost anything and the long run rate is exact.
+    """
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0 or burst < 1:
+            raise(Exception("token_bucket needs a positive rate and a burst of at least 1"))
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.last = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def try_take(self, n=1):
+        """
+        Take n tokens if they're there, without waiting
+        """
+        self.refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def take(self, n=1):
+        self.refill()
+        self.tokens -= n
+        if self.tokens < 0:
+            self.sleep(-self.tokens / self.rate)
+
+class fake_clock:
+    """
+    Stands in for time.monotonic and time.sleep in tests
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+    def clock(self):
+        return self.now
+    def sleep(self, t):
+        self.slept.append(t)
+        self.now += t
+
+class test_rechunker(unittest.TestCase):
+    def test_any_pieces(self):
+        import random
+        data = bytes(random.getrandbits(8) for _ in range(5000))
+        for size in [1, 7, 640]:
+            r = rechunker(size)
+            chunks = []
+            i = 0
+            while i < len(data):
+                n = random.randint(0, 2000)
+                chunks.extend(bytes(c) for c in r.feed(data[i:i+n]))
+                i += n
+            whole = len(data) - len(data) % size
+            self.assertEqual(b"".join(chunks), data[:whole])
+            self.assertTrue(all(len(c) == size for c in chunks))
+            self.assertEqual(r.pending(), len(data) % size)
+
+    def test_exact_fit(self):
+        #a piece that's exactly one chunk comes straight back out
+        r = rechunker(640)
+        self.assertEqual(len(r.feed(bytes(640))), 1)
+
+    def test_no_copy(self):
+        data = bytearray(12)
+        chunks = rechunker(4).feed(data)
+        data[5] = 1
+        self.assertEqual(chunks[1][1], 1)
+
+class test_pacing(unittest.TestCase):
+    def test_pacer_no_drift(self):
+        c = fake_clock()
+        p = pacer(50, clock=c.clock, sleep=c.sleep)
+        ticks = []
+        for i in range(1000):
+            p.wait()
+            ticks.append(c.now)
+            c.now += .007 #work, plus sleeps waking late
+        self.assertAlmostEqual(ticks[-1] - ticks[0], 999 / 50)
+
+    def test_pacer_resync(self):
+        c = fake_clock()
+        p = pacer(50, clock=c.clock, sleep=c.sleep)
+        p.wait()
+        c.now += 5 #way behind
+        p.wait()
+        p.wait()
+        self.assertAlmostEqual(c.slept[-1], 1 / 50)
+
+    def test_bucket_burst_then_rate(self):
+        c = fake_clock()
+        b = token_bucket(10, burst=3, clock=c.clock, sleep=c.sleep)
+        start = c.now
+        for _ in range(3):
+            b.take()
+        self.assertEqual(c.now, start) #the burst goes out right away
+        for _ in range(20):
+            b.take()
+            c.now += .001 #oversleeping doesn't slow it down
+        self.assertAlmostEqual(c.now - start, 2.0 + .001, places=6)
+        self.assertFalse(b.try_take())
+        c.now += 10
+        self.assertTrue(all(b.try_take() for _ in range(3)))
+        self.assertFalse(b.try_take())
+
 def c_array_init_file(filename):
     with open(filename,"rb") as fd:
         c_array_init(fd.read())
@@ -0,0 +1,410 @@
+"""
+Batched UDP: recvmmsg() and sendmmsg() through ctypes on Linux, so a
+whole batch of datagrams in, or one frame out to every listener on a
+reflector module, is one syscall instead of one per packet.
+
+Anywhere those aren't available (not Linux, no libc to find, an old
+kernel), the same Receiver and Sender fall back to plain recvfrom()
+and sendto() loops, so callers don't have to care.
+
+    rx = Receiver(sock)
+    for data, addr in rx.recv(): #everything waiting, up to rx.n
+        ...
+    sendto_many(sock, frame, listeners) #one sendmmsg()
+
+Addresses come and go as the usual (host, port) tuples, or
+(host, port, flowinfo, scope_id) for IPv6, same as recvfrom/sendto.
+"""
+import sys
+import errno
+import ctypes
+import select
+import socket
+import weakref
+import unittest
+import collections
+
+MSG_WAITFORONE = 0x10000 #linux/socket.h
+_sockaddr_max = 128 #sizeof(struct sockaddr_storage)
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+            ("iov_base", ctypes.c_void_p),
+            ("iov_len", ctypes.c_size_t),
+            ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+            ("msg_name", ctypes.c_void_p),
+            ("msg_namelen", ctypes.c_uint32),
+            ("msg_iov", ctypes.POINTER(iovec)),
+            ("msg_iovlen", ctypes.c_size_t),
+            ("msg_control", ctypes.c_void_p),
+            ("msg_controllen", ctypes.c_size_t),
+            ("msg_flags", ctypes.c_int),
+            ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+            ("msg_hdr", msghdr),
+            ("msg_len", ctypes.c_uint),
+            ]
+
+def _load():
+    if not sys.platform.startswith("linux"):
+        return None, None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None, None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+_recvmmsg, _sendmmsg = _load()
+available = _recvmmsg is not None
+
+_decoded = {}
+def decode_sockaddr(raw):
+    """
+    struct sockaddr bytes to a Python address tuple
+    """
+    addr = _decoded.get(raw)
+    if addr is None:
+        family = int.from_bytes(raw[:2], sys.byteorder)
+        port = int.from_bytes(raw[2:4], "big")
+        if family == socket.AF_INET:
+            addr = (socket.inet_ntop(socket.AF_INET, raw[4:8]), port)
+        elif family == socket.AF_INET6:
+            addr = (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port,
+                    int.from_bytes(raw[4:8], "big"), int.from_bytes(raw[24:28], sys.byteorder))
+        else:
+            raise(Exception("Can't decode address family %d"%(family)))
+        if len(_decoded) > 65536:
+            _decoded.clear()
+        _decoded[raw] = addr
+    return addr
+
+def encode_sockaddr(family, addr):
+    """
+    A Python address tuple (already resolved) to struct sockaddr bytes
+    """
+    if family == socket.AF_INET:
+        return (socket.AF_INET.to_bytes(2, sys.byteorder) + addr[1].to_bytes(2, "big")
+                + socket.inet_pton(socket.AF_INET, addr[0]) + bytes(8))
+    if family == socket.AF_INET6:
+        flowinfo = addr[2] if len(addr) > 2 else 0
+        scope_id = addr[3] if len(addr) > 3 else 0
+        return (socket.AF_INET6.to_bytes(2, sys.byteorder) + addr[1].to_bytes(2, "big")
+                + flowinfo.to_bytes(4, "big") + socket.inet_pton(socket.AF_INET6, addr[0])
+                + scope_id.to_bytes(4, sys.byteorder))
+    raise(Exception("Can't encode address family %d"%(family)))
+
+def _raise_errno():
+    e = ctypes.get_errno()
+    raise(OSError(e, "%s"%(errno.errorcode.get(e, e))))
+
+class Receiver:
+    """
+    Takes in up to n datagrams (of up to bufsize bytes) per recv() call.
+
+    On a blocking socket, recv() waits for the first one and then takes
+    whatever else is already there; on a non-blocking one it returns
+    right away, with an empty list if there's nothing. A socket with a
+    timeout raises TimeoutError like recvfrom() would.
+    Buffers are allocated once, up front.
+    """
+    def __init__(self, sock, n=64, bufsize=1500, use_mmsg=None):
+        self.sock = sock
+        self.n = n
+        self.bufsize = bufsize
+        self.use_mmsg = available if use_mmsg is None else (use_mmsg and available)
+        if self.use_mmsg:
+            self.bufs = (ctypes.c_char * (n * bufsize))()
+            self.names = (ctypes.c_char * (n * _sockaddr_max))()
+            self.iovs = (iovec * n)()
+            self.msgs = (mmsghdr * n)()
+            base = ctypes.addressof(self.bufs)
+            names = ctypes.addressof(self.names)
+            for i in range(n):
+                self.iovs[i].iov_base = base + i * bufsize
+                self.iovs[i].iov_len = bufsize
+                hdr = self.msgs[i].msg_hdr
+                hdr.msg_name = names + i * _sockaddr_max
+                hdr.msg_namelen = _sockaddr_max
+                hdr.msg_iov = ctypes.pointer(self.iovs[i])
+                hdr.msg_iovlen = 1
+            self.used = 0
+
+    def recv(self):
+        """
+        A list of (data, addr) for every datagram waiting (at least one,
+        if the socket blocks), up to n of them
+        """
+        if not self.use_mmsg:
+            return self._recv_fallback()
+        msgs = self.msgs
+        for i in range(self.used):
+            msgs[i].msg_hdr.msg_namelen = _sockaddr_max
+        timeout = self.sock.gettimeout()
+        flags = 0
+        if timeout is None:
+            flags = MSG_WAITFORONE
+        elif timeout > 0:
+            #python keeps sockets with a timeout non-blocking underneath, and waits itself
+            if not select.select([self.sock], [], [], timeout)[0]:
+                raise(TimeoutError("timed out"))
+        while 1:
+            count = _recvmmsg(self.sock.fileno(), msgs, self.n, flags, None)
+            if count >= 0:
+                break
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            if e in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.used = 0
+                return []
+            _raise_errno()
+        self.used = count
+        bufs = self.bufs
+        names = self.names
+        bufsize = self.bufsize
+        out = []
+        for i in range(count):
+            m = msgs[i]
+            start = i * bufsize
+            at = i * _sockaddr_max
+            addr = decode_sockaddr(names[at:at + m.msg_hdr.msg_namelen])
+            out.append((bufs[start:start + m.msg_len], addr))
+        return out
+
+    def _recv_fallback(self):
+        sock = self.sock
+        out = []
+        try:
+            out.append(sock.recvfrom(self.bufsize))
+            timeout = sock.gettimeout()
+            dontwait = getattr(socket, "MSG_DONTWAIT", 0)
+            #(with a timeout, even MSG_DONTWAIT waits, so just take the one)
+            if timeout == 0 or (timeout is None and dontwait):
+                while len(out) < self.n:
+                    out.append(sock.recvfrom(self.bufsize, dontwait))
+        except (BlockingIOError, InterruptedError):
+            pass
+        return out
+
+class Sender:
+    """
+    Sends lists of datagrams with sendmmsg(), as many per syscall as the
+    kernel will take (1024 on Linux).
+
+    fanout() is the reflector case, one datagram to a list of addresses:
+    the message headers for a list get built once and reused for as long
+    as the list stays the same, so each frame after that only points
+    the one shared iovec at the new data. The last fan_cache lists are
+    kept, so a few streams on different modules don't rebuild them
+    every frame.
+
+    A datagram that can't go (full socket buffer on a non-blocking
+    socket, unreachable address...) is skipped, the same as what a
+    sendto() loop ignoring errors would do.
+    """
+    fan_cache = 16
+    resolve_cache = 4096
+
+    def __init__(self, sock, use_mmsg=None):
+        self.sock = sock
+        self.use_mmsg = available if use_mmsg is None else (use_mmsg and available)
+        self.resolved = collections.OrderedDict()
+        self.iov = iovec()
+        self._fans = collections.OrderedDict()
+
+    def resolve(self, addr):
+        """
+        sockaddr bytes for addr, looking up hostnames once (for the last
+        resolve_cache addresses, so a reflector's churn of peers doesn't
+        pile up)
+        """
+        cache = self.resolved
+        raw = cache.get(addr)
+        if raw is not None:
+            cache.move_to_end(addr)
+        else:
+            family = self.sock.family
+            try:
+                raw = encode_sockaddr(family, addr)
+            except OSError:
+                #a hostname, not an address
+                resolved = socket.getaddrinfo(addr[0], addr[1], family, socket.SOCK_DGRAM)[0][4]
+                raw = encode_sockaddr(family, resolved)
+            raw = cache[addr] = ctypes.create_string_buffer(raw, len(raw))
+            if len(cache) > self.resolve_cache:
+                cache.popitem(last=False)
+        return raw
+
+    def _headers(self, addrs, iovs):
+        msgs = (mmsghdr * len(addrs))()
+        #msg_name is only a pointer, so the headers hang on to the buffers
+        #themselves in case resolve() lets go of them
+        msgs.names = names = []
+        for i,addr in enumerate(addrs):
+            raw = self.resolve(addr)
+            names.append(raw)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(raw)
+            hdr.msg_namelen = len(raw)
+            hdr.msg_iov = iovs[i]
+            hdr.msg_iovlen = 1
+        return msgs
+
+    def _send(self, msgs, count):
+        """
+        sendmmsg() until everything's gone, skipping anything that fails
+        """
+        fd = self.sock.fileno()
+        size = ctypes.sizeof(mmsghdr)
+        base = ctypes.addressof(msgs)
+        at = 0
+        sent = 0
+        while at < count:
+            n = _sendmmsg(fd, ctypes.cast(base + at * size, ctypes.POINTER(mmsghdr)), count - at, 0)
+            if n < 0:
+                e = ctypes.get_errno()
+                if e == errno.EINTR:
+                    continue
+                if e in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                at += 1 #this one's bad, carry on with the rest
+                continue
+            at += n
+            sent += n
+        return sent
+
+    def fanout(self, data, addrs):
+        """
+        Send data to every address in addrs, returning how many went
+        """
+        if not self.use_mmsg:
+            return self._send_fallback((data, addr) for addr in addrs)
+        if not addrs:
+            return 0
+        key = tuple(addrs)
+        msgs = self._fans.get(key)
+        if msgs is None:
+            msgs = self._fans[key] = self._headers(key, [ctypes.pointer(self.iov)] * len(key))
+            if len(self._fans) > self.fan_cache:
+                self._fans.popitem(last=False)
+        else:
+            self._fans.move_to_end(key)
+        data = bytes(data)
+        self.iov.iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        self.iov.iov_len = len(data)
+        return self._send(msgs, len(key))
+
+    def send(self, packets):
+        """
+        Send a list of (data, addr), returning how many went
+        """
+        if not self.use_mmsg:
+            return self._send_fallback(packets)
+        packets = [(bytes(data), addr) for data,addr in packets]
+        if not packets:
+            return 0
+        iovs = (iovec * len(packets))()
+        for i,(data,addr) in enumerate(packets):
+            iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+            iovs[i].iov_len = len(data)
+        msgs = self._headers([addr for data,addr in packets], [ctypes.pointer(iov) for iov in iovs])
+        return self._send(msgs, len(packets))
+
+    def _send_fallback(self, packets):
+        sent = 0
+        for data,addr in packets:
+            try:
+                self.sock.sendto(data, addr)
+                sent += 1
+            except BlockingIOError:
+                break
+            except OSError:
+                pass
+        return sent
+
+_senders = weakref.WeakKeyDictionary()
+def sendto_many(sock, data, addrs):
+    """
+    sendto() data to every address in addrs, in one syscall where possible
+    """
+    sender = _senders.get(sock)
+    if sender is None:
+        sender = _senders[sock] = Sender(sock)
+    return sender.fanout(data, addrs)
+
+class test_mmsg(unittest.TestCase):
+    def sockets(self, family=socket.AF_INET, host="127.0.0.1", count=3):
+        socks = []
+        for _ in range(count):
+            s = socket.socket(family, socket.SOCK_DGRAM)
+            s.bind((host, 0))
+            s.settimeout(2)
+            self.addCleanup(s.close)
+            socks.append(s)
+        return socks
+
+    def roundtrip(self, use_mmsg, family=socket.AF_INET, host="127.0.0.1"):
+        tx, a, b = self.sockets(family, host)
+        addrs = [a.getsockname(), b.getsockname()]
+        sender = Sender(tx, use_mmsg)
+        self.assertEqual(sender.fanout(b"frame one", addrs), 2)
+        self.assertEqual(sender.fanout(b"frame two", addrs), 2)
+        self.assertEqual(sender.send([(b"just a", addrs[0]), (bytearray(b"just b"), addrs[1])]), 2)
+        for sock,last in [(a, b"just a"), (b, b"just b")]:
+            rx = Receiver(sock, n=8, use_mmsg=use_mmsg)
+            got = []
+            while len(got) < 3:
+                got.extend(rx.recv())
+            self.assertEqual([d for d,addr in got], [b"frame one", b"frame two", last])
+            self.assertEqual(set(addr for d,addr in got), set([tx.getsockname()]))
+
+    def test_mmsg(self):
+        if not available:
+            self.skipTest("no recvmmsg/sendmmsg here")
+        self.roundtrip(True)
+
+    def test_fallback(self):
+        self.roundtrip(False)
+
+    def test_ipv6(self):
+        if not available or not socket.has_ipv6:
+            self.skipTest("no recvmmsg/sendmmsg or IPv6 here")
+        try:
+            self.roundtrip(True, socket.AF_INET6, "::1")
+        except OSError as e:
+            self.skipTest("no IPv6 loopback: %s"%(e))
+
+    def test_nonblocking_empty(self):
+        (s,) = self.sockets(count=1)
+        s.setblocking(False)
+        self.assertEqual(Receiver(s).recv(), [])
+        self.assertEqual(Receiver(s, use_mmsg=False).recv(), [])
+
+    def test_resolve_cache(self):
+        socks = self.sockets(count=3)
+        addrs = [s.getsockname() for s in socks]
+        tx = Sender(socks[0])
+        tx.resolve_cache = 2
+        #more addresses than the cache holds, in one go and across sends
+        self.assertEqual(tx.fanout(b"x", addrs[1:] + [addrs[0]]), 3)
+        self.assertEqual(len(tx.resolved), 2)
+        self.assertEqual(tx.fanout(b"y", addrs[1:] + [addrs[0]]), 3)
+        for s in socks:
+            self.assertEqual([s.recv(10) for _ in range(2)], [b"x", b"y"])
+
+    def test_hostname(self):
+        tx, rx = self.sockets(count=2)
+        port = rx.getsockname()[1]
+        self.assertEqual(Sender(tx).fanout(b"hi", [("localhost", port)]), 1)
+        self.assertEqual(rx.recvfrom(100)[0], b"hi")
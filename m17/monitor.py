@@ -0,0 +1,348 @@
+"""
+Counters for figuring out which block in a modular() chain is behind.
+
+Each block's inq and outq get wrapped (CountingGet, CountingPut) so that
+every get() and put() bumps counters in a BlockStats - a small shared
+memory array, one writer (the block's process) and one reader (the
+supervisor), so no locks. The supervisor (Monitor) also samples how deep
+every queue between blocks is, then prints a table every so often and/or
+hands out a JSON snapshot to anything that connects to a local TCP port:
+
+    $ nc localhost 7017
+
+What the numbers mean, per block:
+    in, out - items taken off the inq, put on the outq
+    wait - time spent blocked in inq.get(), i.e. starved
+    busy - time between getting an item and asking for the next one,
+           i.e. actually working on it (including putting results)
+    put - the part of busy spent blocked in outq.put(), i.e. backpressure
+    outq - depth now/most seen of the queue after the block
+    drops - items thrown away by that queue's drop policy (pipeline.link)
+    us/item, p50, p99 - per item busy time, the percentiles from a
+           log2 histogram so they're rounded up to a power of two
+
+A block that's behind shows high busy and a deep inq; the ones after it
+show high wait.
+"""
+import json
+import time
+import socket
+import threading
+import unittest
+import multiprocessing
+
+from . import pipeline
+
+class BlockStats:
+    """
+    Counters for one block, in a multiprocessing.RawArray so they can be
+    handed to the block's process and read from the supervisor
+    """
+    fields = ("items_in", "items_out", "gets", "puts", "wait_ns", "busy_ns", "put_ns")
+    buckets = 24 #log2 microseconds, 1us .. ~8s, anything past goes in the last
+
+    def __init__(self, name, chain=0, index=0):
+        self.name = name
+        self.chain = chain
+        self.index = index
+        self.counters = multiprocessing.RawArray("Q", len(self.fields) + self.buckets)
+        for i,f in enumerate(self.fields):
+            setattr(self, "_" + f, i)
+
+    def add(self, field, n):
+        self.counters[getattr(self, "_" + field)] += n
+
+    def record(self, service_ns, items=1):
+        """
+        items took service_ns between them
+        """
+        c = self.counters
+        base = len(self.fields)
+        per_item = service_ns // (items * 1000)
+        c[base + min(per_item.bit_length(), self.buckets - 1)] += items
+        c[self._busy_ns] += service_ns
+
+    def histogram(self):
+        base = len(self.fields)
+        return list(self.counters[base:base + self.buckets])
+
+    def percentile(self, p, hist=None):
+        """
+        Upper bound in microseconds of the bucket holding the p'th percentile
+        per item time, None if nothing's been recorded yet
+        """
+        hist = self.histogram() if hist is None else hist
+        total = sum(hist)
+        if not total:
+            return None
+        seen = 0
+        for i,n in enumerate(hist):
+            seen += n
+            if seen * 100 >= total * p:
+                return 2**i
+        return 2**(len(hist) - 1)
+
+    def snapshot(self):
+        c = list(self.counters)
+        d = dict(zip(self.fields, c))
+        hist = c[len(self.fields):]
+        d.update({
+            "chain": self.chain,
+            "index": self.index,
+            "name": self.name,
+            "us_per_item": d["busy_ns"] / d["items_in"] / 1000 if d["items_in"] else None,
+            "p50_us": self.percentile(50, hist),
+            "p99_us": self.percentile(99, hist),
+            "histogram_us": dict(("<%d"%(2**i), n) for i,n in enumerate(hist) if n),
+            })
+        return d
+
+def _count(x, batched):
+    return len(x) if batched else 1
+
+class CountingGet(pipeline.QueueWrapper):
+    """
+    Wraps a block's inq, timing how long it waits in get() and how long
+    it takes before coming back for the next item
+    """
+    def __init__(self, q, stats, batched=False):
+        self.q = q
+        self.stats = stats
+        self.batched = batched
+        self.last = None
+        self.last_n = 1
+    def get(self, block=True, timeout=None):
+        stats = self.stats
+        now = time.perf_counter_ns()
+        if self.last is not None:
+            stats.record(now - self.last, self.last_n)
+            self.last = None
+        x = self.q.get(block, timeout)
+        after = time.perf_counter_ns()
+        self.last_n = _count(x, self.batched)
+        stats.add("wait_ns", after - now)
+        stats.add("gets", 1)
+        stats.add("items_in", self.last_n)
+        self.last = after
+        return x
+    def get_nowait(self):
+        return self.get(False)
+
+class CountingPut(pipeline.QueueWrapper):
+    """
+    Wraps a block's outq, counting what goes out and time spent blocked on it
+    """
+    def __init__(self, q, stats, batched=False):
+        self.q = q
+        self.stats = stats
+        self.batched = batched
+    def put(self, x, *args, **kwargs):
+        start = time.perf_counter_ns()
+        self.q.put(x, *args, **kwargs)
+        stats = self.stats
+        stats.add("put_ns", time.perf_counter_ns() - start)
+        stats.add("puts", 1)
+        stats.add("items_out", _count(x, self.batched))
+    def put_nowait(self, x):
+        self.put(x, False)
+
+def qdepth(q):
+    try:
+        return q.qsize()
+    except (NotImplementedError, OSError, ValueError):
+        #mp.Queue.qsize() isn't there on macOS
+        return None
+
+class Monitor:
+    """
+    The supervisor side. Register blocks and queues, call sample() from
+    the supervisor loop, and it takes care of printing and serving
+    snapshots as configured.
+
+    print_interval - seconds between tables on stdout, 0 for never
+    port - serve JSON snapshots on 127.0.0.1:port, None for no server
+    """
+    def __init__(self, print_interval=0, port=None):
+        self.blocks = []
+        self.queues = []
+        self.print_interval = print_interval
+        self.last_print = time.monotonic()
+        self.last_counts = {}
+        self.lock = threading.Lock()
+        self.server = None
+        if port is not None:
+            self.serve(port)
+
+    def add_block(self, name, chain=0, index=0):
+        stats = BlockStats(name, chain, index)
+        self.blocks.append(stats)
+        return stats
+
+    def wrap(self, fn, stats, inq, outq):
+        """
+        inq and outq for fn, counted into stats
+        """
+        batched = pipeline.is_batched(fn)
+        if inq is not None:
+            inq = CountingGet(inq, stats, batched)
+        if outq is not None:
+            outq = CountingPut(outq, stats, batched)
+        return inq, outq
+
+    def add_queue(self, q, chain=0, index=0, after=""):
+        """
+        q is the outq of block index in chain (named after)
+        """
+        self.queues.append({"q":q, "chain":chain, "index":index, "after":after, "depth":None, "max_depth":0, "dropped":None})
+
+    def sample(self):
+        with self.lock:
+            for entry in self.queues:
+                depth = qdepth(entry["q"])
+                entry["depth"] = depth
+                if depth is not None and depth > entry["max_depth"]:
+                    entry["max_depth"] = depth
+                entry["dropped"] = getattr(entry["q"], "dropped", None)
+        if self.print_interval and time.monotonic() - self.last_print >= self.print_interval:
+            print(self.table())
+
+    def snapshot(self):
+        with self.lock:
+            queues = [dict((k,v) for k,v in entry.items() if k != "q") for entry in self.queues]
+        return {
+                "time": time.time(),
+                "blocks": [b.snapshot() for b in self.blocks],
+                "queues": queues,
+                }
+
+    def table(self):
+        """
+        One line per block, with rates and percentages since the last table
+        """
+        now = time.monotonic()
+        elapsed = max(now - self.last_print, 1e-9)
+        self.last_print = now
+        snap = self.snapshot()
+        depths = dict(((q["chain"], q["index"]), q) for q in snap["queues"])
+        def us(v):
+            return "-" if v is None else "%.0f"%(v)
+        lines = ["%-28s %10s %10s %9s %8s %7s %7s %6s %6s %6s %9s %8s"%(
+            "block", "in", "out", "in/s", "us/item", "p50", "p99", "wait%", "busy%", "put%", "outq", "drops")]
+        for b in snap["blocks"]:
+            key = (b["chain"], b["index"])
+            last = self.last_counts.get(key + (b["name"],), {})
+            self.last_counts[key + (b["name"],)] = b
+            def since(field):
+                return b[field] - last.get(field, 0)
+            q = depths.get(key)
+            depth = "-" if q is None or q["depth"] is None else "%d/%d"%(q["depth"], q["max_depth"])
+            drops = "-" if q is None or q["dropped"] is None else "%d"%(q["dropped"])
+            lines.append("%-28s %10d %10d %9.1f %8s %7s %7s %6.1f %6.1f %6.1f %9s %8s"%(
+                ("%d/%d/%s"%(b["chain"], b["index"], b["name"]))[:28],
+                b["items_in"], b["items_out"],
+                since("items_in") / elapsed,
+                us(b["us_per_item"]), us(b["p50_us"]), us(b["p99_us"]),
+                since("wait_ns") / 1e7 / elapsed,
+                since("busy_ns") / 1e7 / elapsed,
+                since("put_ns") / 1e7 / elapsed,
+                depth, drops))
+        return "\n".join(lines)
+
+    def serve(self, port):
+        """
+        Every connection to 127.0.0.1:port gets one JSON snapshot, then closed
+        """
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port))
+        self.server.listen(4)
+        self.port = self.server.getsockname()[1]
+        def accept():
+            while 1:
+                try:
+                    conn,_ = self.server.accept()
+                except OSError:
+                    return #closed
+                try:
+                    conn.sendall(json.dumps(self.snapshot()).encode("utf-8") + b"\n")
+                except OSError:
+                    pass
+                finally:
+                    conn.close()
+        threading.Thread(target=accept, name="m17 monitor", daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+def from_config(config):
+    """
+    A Monitor as set up in config.modular.monitor, or None if that's missing or off
+    """
+    settings = pipeline.option(config, "monitor", None)
+    if not settings:
+        return None
+    return Monitor(settings.get("print_interval", 0), settings.get("port", None))
+
+class test_monitor(unittest.TestCase):
+    def test_counts(self):
+        import queue
+        mon = Monitor()
+        stats = mon.add_block("double")
+        def double(config, inq, outq):
+            for _ in range(3):
+                x = inq.get()
+                outq.put(x * 2)
+        q1, q2 = queue.Queue(), queue.Queue()
+        for x in range(3):
+            q1.put(x)
+        mon.add_queue(q2, after="double")
+        double(None, *mon.wrap(double, stats, q1, q2))
+        mon.sample()
+        snap = mon.snapshot()
+        b = snap["blocks"][0]
+        self.assertEqual((b["items_in"], b["items_out"], b["gets"], b["puts"]), (3, 3, 3, 3))
+        #the last item's time only gets recorded on the next get()
+        self.assertEqual(sum(stats.histogram()), 2)
+        self.assertEqual(snap["queues"][0]["depth"], 3)
+        self.assertIn("0/0/double", mon.table())
+
+    def test_batched_counts(self):
+        import queue
+        from .blocks import batched
+        stats = BlockStats("batch")
+        @batched
+        def fn(config, inq, outq):
+            pass
+        inq, outq = Monitor().wrap(fn, stats, queue.Queue(), queue.Queue())
+        inq.q.put([1, 2, 3])
+        inq.q.put([4])
+        inq.get(); inq.get()
+        outq.put([1, 2])
+        s = stats.snapshot()
+        self.assertEqual((s["items_in"], s["gets"], s["items_out"]), (4, 2, 2))
+        self.assertEqual(sum(stats.histogram()), 3)
+
+    def test_percentile(self):
+        stats = BlockStats("x")
+        for _ in range(99):
+            stats.record(3000)
+        stats.record(1000000)
+        self.assertEqual(stats.percentile(50), 4)
+        self.assertEqual(stats.percentile(100), 1024)
+
+    def test_server(self):
+        mon = Monitor(port=0)
+        mon.add_block("blk")
+        try:
+            with socket.create_connection(("127.0.0.1", mon.port), timeout=5) as s:
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = s.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+            self.assertEqual(json.loads(data)["blocks"][0]["name"], "blk")
+        finally:
+            mon.close()
@@ -6,6 +6,7 @@ import json
 import struct
 import random
 import logging
+import selectors
 import unittest
 import binascii
 import socket
@@ -19,6 +20,8 @@ from kademlia.network import Server
 import bitstruct
 import m17
 import m17.misc
+import m17.mmsg
+import m17.pipeline
 from m17.misc import dattr
 import m17.address
 
@@ -102,7 +105,7 @@ class m17_networking_direct:
         # self.sock.bind( ("::1", 17000) )
 
         self.recvQ = queue.Queue()
-        self.sendQ = queue.Queue()
+        self.sendQ = m17.pipeline.WakeQueue(queue.Queue())
         network = threading.Thread(target=self.networker, args=(self.recvQ, self.sendQ))
         network.start()
  
@@ -120,25 +123,31 @@ class m17_networking_direct:
 
     def networker(self, recvq, sendq):
         """
+        Sleeps until there's a packet in or something to send, then
+        does all of it
         """
+        rx = m17.mmsg.Receiver(self.sock)
+        tx = m17.mmsg.Sender(self.sock)
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ)
+        sel.register(sendq, selectors.EVENT_READ)
         while 1:
-            try:
-                data,conn = self.sock.recvfrom(1500)
-                print("RECV",conn, data)
-                recvq.put((data,conn))
-            except BlockingIOError as e:
-                pass
-            if not sendq.empty():
-                data,conn = sendq.get_nowait()
-                print("SEND",conn, data)
-                self.sock.sendto(data,conn)
-            time.sleep(.0001)
+            for key,_ in sel.select():
+                if key.fileobj is self.sock:
+                    for data,conn in rx.recv():
+                        print("RECV",conn, data)
+                        recvq.put((data,conn))
+                else:
+                    packets = sendq.drain()
+                    for data,conn in packets:
+                        print("SEND",conn, data)
+                    tx.send(packets)
 
     def loop(self):
         def looper(self):
             while 1:
-                self.loop_once()
-                time.sleep(.005)
+                #wakes up for keepalives even when nothing's coming in
+                self.loop_once(timeout=1)
         self.looper = threading.Thread(target=looper, args=(self,))
         self.looper.start()
 
@@ -146,10 +155,16 @@ class m17_networking_direct:
         ...
         # self.conns = {conn: data for conn, data in self.conns if time.time() - data.last > self.connection_timeout}
 
-    def loop_once(self):
+    def loop_once(self, timeout=0):
+        """
+        Handle everything that's come in, waiting up to timeout for it
+        """
         self.registration_keepalive()
-        if not self.recvQ.empty():
-            data,conn = self.recvQ.get_nowait()
+        try:
+            data,conn = self.recvQ.get(timeout=timeout) if timeout else self.recvQ.get_nowait()
+        except queue.Empty:
+            return
+        while 1:
             print("Recv:", data,conn)
             if conn[0] not in self.conns:
                 self.conns[ conn ] = dattr({
@@ -160,6 +175,10 @@ class m17_networking_direct:
             else:
                 self.conns[ conn[0] ].last = time.time()
             self.process_packet( data, conn )
+            try:
+                data,conn = self.recvQ.get_nowait()
+            except queue.Empty:
+                break
         # self.clean_conns()
         # self.clean_whereis()
 
@@ -0,0 +1,994 @@
+"""
+Plumbing for modular() in apps.py - the parts that decide how a chain of
+blocks actually gets run, as opposed to what the blocks do.
+"""
+import os
+import time
+import queue
+import pickle
+import struct
+import threading
+import unittest
+import collections
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def option(config, name, default):
+    """
+    Look up a modular() setting from config.modular, if there is one
+    """
+    try:
+        return config["modular"][name]
+    except (KeyError, TypeError):
+        return default
+
+def run_steps(steps, x):
+    """
+    Push one item through a list of step functions (see blocks.stepblock),
+    returning whatever comes out the far end
+    """
+    items = [x]
+    for step in steps:
+        items = [y for item in items for y in step(item)]
+        if not items:
+            break
+    return items
+
+def close_steps(steps):
+    """
+    Call the close hook (step.close, if it has one) of each step, for
+    steps holding onto something like an open file
+    """
+    for step in steps:
+        close = getattr(step, "close", None)
+        if close is not None:
+            close()
+
+class QueueWrapper:
+    """
+    Base for things that stand in for a queue, passing along anything
+    they don't handle themselves to the real one underneath
+    """
+    def __init__(self, q):
+        self.q = q
+    def __getattr__(self, name):
+        if name == "q":
+            #not set yet, like while being unpickled in a spawned process
+            raise(AttributeError(name))
+        return getattr(self.q, name)
+
+class StepPut(QueueWrapper):
+    """
+    Stands in for an outq, running items through steps on the way in.
+    """
+    def __init__(self, q, steps):
+        self.q = q
+        self.steps = steps
+    def put(self, x, *args, **kwargs):
+        for y in run_steps(self.steps, x):
+            self.q.put(y, *args, **kwargs)
+    def put_nowait(self, x):
+        self.put(x, False)
+
+class StepGet(QueueWrapper):
+    """
+    Stands in for an inq, running items through steps on the way out.
+    """
+    def __init__(self, q, steps):
+        self.q = q
+        self.steps = steps
+        self.pending = collections.deque()
+    def get(self, block=True, timeout=None):
+        #items the steps filter out don't get to restart the timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.pending:
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            self.pending.extend(run_steps(self.steps, self.q.get(block, timeout)))
+        return self.pending.popleft()
+    def get_nowait(self):
+        return self.get(False)
+    def empty(self):
+        return not self.pending and self.q.empty()
+
+class ShmRing:
+    """
+    A single producer, single consumer queue made of fixed size slots in
+    multiprocessing.shared_memory, for use in place of a
+    multiprocessing.Queue between two blocks.
+
+    bytes and 1d numpy arrays (audio frames, codec2 frames, ipFrames as
+    bytes) get copied straight into a slot - no pickling, no pipe, no
+    feeder thread. Anything else falls back to being pickled into a slot.
+    Items bigger than slot_size are an error.
+
+    Normally get() copies the item back out, so it's safe to hang on to.
+    With zero_copy, get() instead returns a view (numpy array or
+    memoryview) right into the slot, and the slot is only handed back to
+    the producer on the next get() - so the item has to be used up (or
+    copied) by then, which is the case for most blocks.
+
+    Only one process may put() and one may get().
+    """
+    _header = struct.Struct("<B3xI8s") #kind, nbytes, numpy dtype
+    _bytes, _ndarray, _pickled = range(3)
+
+    def __init__(self, slot_size=4096, nslots=64, zero_copy=False):
+        from multiprocessing import shared_memory
+        self.slot_size = slot_size
+        self.nslots = nslots
+        self.zero_copy = zero_copy
+        self.stride = self._header.size + slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.stride * nslots)
+        self.items = multiprocessing.Semaphore(0)
+        self.spaces = multiprocessing.Semaphore(nslots)
+        self._put_idx = 0
+        self._get_idx = 0
+        self._held = False
+
+    def __getstate__(self):
+        #for spawned processes, which have to attach to the shared memory by name
+        state = self.__dict__.copy()
+        state["shm"] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state["shm"])
+
+    def put(self, x, block=True, timeout=None):
+        if not self.spaces.acquire(block, timeout):
+            raise(queue.Full)
+        try:
+            self._write(x)
+        except BaseException:
+            #the slot's still free, don't lose it
+            self.spaces.release()
+            raise
+        self._put_idx = (self._put_idx + 1) % self.nslots
+        self.items.release()
+
+    def _write(self, x):
+        """
+        Copy x into the slot at _put_idx
+        """
+        buf = self.shm.buf
+        offset = self._put_idx * self.stride
+        start = offset + self._header.size
+        dtype = b""
+        if isinstance(x, (bytes, bytearray, memoryview)):
+            kind = self._bytes
+            data = memoryview(x).cast("B")
+        elif numpy is not None and isinstance(x, numpy.ndarray) and x.ndim == 1 and x.dtype.names is None and not x.dtype.hasobject and len(x.dtype.str) <= 8:
+            kind = self._ndarray
+            if not x.dtype.isnative:
+                #the other side gets the same values, in native byte order
+                x = x.astype(x.dtype.newbyteorder("="))
+            dtype = x.dtype.str.encode("ascii")
+            data = memoryview(numpy.ascontiguousarray(x)).cast("B")
+        else:
+            kind = self._pickled
+            data = pickle.dumps(x, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size:
+            raise(Exception("%d byte item doesn't fit in a %d byte ShmRing slot"%(len(data), self.slot_size)))
+        buf[start:start + len(data)] = data
+        self._header.pack_into(buf, offset, kind, len(data), dtype)
+
+    def put_nowait(self, x):
+        self.put(x, False)
+
+    def get(self, block=True, timeout=None):
+        if self._held:
+            self._held = False
+            self.spaces.release()
+        if not self.items.acquire(block, timeout):
+            raise(queue.Empty)
+        buf = self.shm.buf
+        offset = self._get_idx * self.stride
+        start = offset + self._header.size
+        kind, nbytes, dtype = self._header.unpack_from(buf, offset)
+        self._get_idx = (self._get_idx + 1) % self.nslots
+        view = buf[start:start + nbytes]
+        if kind == self._pickled:
+            x = pickle.loads(view)
+        elif kind == self._ndarray:
+            x = numpy.frombuffer(view, dtype=dtype.rstrip(b"\x00").decode("ascii"))
+            if not self.zero_copy:
+                x = x.copy()
+        else:
+            x = view if self.zero_copy else bytes(view)
+        if self.zero_copy and kind != self._pickled:
+            self._held = True
+        else:
+            view.release()
+            self.spaces.release()
+        return x
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return self.items.get_value()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+class Dropping(QueueWrapper):
+    """
+    A bounded queue that throws items away instead of blocking when it's
+    full, so a block that falls behind costs us audio instead of ever
+    growing latency:
+        drop_newest - the item being put is thrown away
+        drop_oldest - the one that's been waiting longest is thrown away
+            to make room (needs a queue the producer can get() from too,
+            so not a ShmRing)
+    dropped counts them, and is shared with the supervisor process.
+    """
+    def __init__(self, q, policy):
+        super().__init__(q)
+        self.policy = policy
+        self._dropped = multiprocessing.RawValue("Q", 0)
+
+    @property
+    def dropped(self):
+        return self._dropped.value
+
+    def put(self, x, block=True, timeout=None):
+        #block and timeout are ignored, never waiting is the whole point
+        while 1:
+            try:
+                self.q.put_nowait(x)
+                return
+            except queue.Full:
+                pass
+            if self.policy == "drop_newest":
+                self._dropped.value += 1
+                return
+            try:
+                self.q.get_nowait()
+                self._dropped.value += 1
+            except queue.Empty:
+                pass #the consumer beat us to it, so there's room now
+
+    def put_nowait(self, x):
+        self.put(x, False)
+
+class WakeQueue(QueueWrapper):
+    """
+    A queue for a loop that's waiting on sockets too: every put() also
+    writes a byte to a pipe, and fileno() is the read end of that pipe,
+    so it goes in a selector (or select()) alongside the sockets and the
+    loop sleeps until there's a packet or something to send.
+
+    The consumer takes items with drain(), which returns everything put
+    since last time - one byte per item, so it knows how many to get()
+    even when a multiprocessing.Queue's feeder thread hasn't caught up
+    yet. Don't mix in plain get()s, that gets the count out of step.
+
+    Make it before starting the processes that use it, the pipe goes
+    along to them like the queue does.
+    """
+    def __init__(self, q=None):
+        super().__init__(multiprocessing.Queue() if q is None else q)
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        os.set_blocking(self.reader.fileno(), False)
+
+    def put(self, x, *args, **kwargs):
+        self.q.put(x, *args, **kwargs)
+        #blocks only with 64k items waiting, backpressure like any full queue
+        os.write(self.writer.fileno(), b"\0")
+
+    def put_nowait(self, x):
+        self.put(x, False)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def drain(self):
+        """
+        Everything that's been put so far, [] if nothing
+        """
+        try:
+            n = len(os.read(self.reader.fileno(), 65536))
+        except BlockingIOError:
+            return []
+        return [self.q.get() for _ in range(n)]
+
+class link:
+    """
+    Goes between two blocks in a chain, to choose how modular() connects them:
+
+        [mic_audio, link(transport="shm", slot_size=320), codec2enc, ...]
+
+    transport is "queue" for a multiprocessing.Queue (the default) or
+    "shm" for a ShmRing, with any other keyword arguments passed on to it.
+
+    maxsize bounds the queue (0 is unbounded, for a ShmRing it's nslots),
+    and policy says what happens when it's full: "block" the producer
+    (the default), or "drop_newest"/"drop_oldest" - see Dropping.
+
+    Links between blocks that don't have one use config.modular.link
+    (a dict of the same arguments), if set.
+    modular(..., fuse=True) never fuses across an explicit link.
+    """
+    policies = ("block", "drop_newest", "drop_oldest")
+
+    def __init__(self, transport="queue", maxsize=0, policy="block", **options):
+        if policy not in self.policies:
+            raise(Exception("Unknown link policy %r, expected one of %s"%(policy, ", ".join(self.policies))))
+        if policy != "block" and not maxsize and transport == "queue":
+            raise(Exception("A %s link needs a maxsize"%(policy)))
+        if policy == "drop_oldest" and transport == "shm":
+            raise(Exception("ShmRing only allows one getter, so it can't drop_oldest"))
+        self.transport = transport
+        self.maxsize = maxsize
+        self.policy = policy
+        self.options = options
+
+    def make(self):
+        if self.transport == "queue":
+            q = multiprocessing.Queue(self.maxsize)
+        elif self.transport == "shm":
+            options = dict(self.options)
+            if self.maxsize:
+                options["nslots"] = self.maxsize
+            q = ShmRing(**options)
+        else:
+            raise(Exception("Unknown link transport %r"%(self.transport)))
+        if self.policy != "block":
+            q = Dropping(q, self.policy)
+        return q
+
+def default_link(config):
+    return link(**option(config, "link", {}))
+
+def split_links(chain, default):
+    """
+    Pull the link()s out of a chain, returning the blocks and one link
+    per block for its outq
+    """
+    blocks = []
+    links = []
+    for fn in chain:
+        if isinstance(fn, link):
+            if blocks:
+                links[-1] = fn
+            continue
+        blocks.append(fn)
+        links.append(default)
+    return blocks, links
+
+def close_queue(q):
+    while isinstance(q, QueueWrapper):
+        q = q.q
+    if isinstance(q, ShmRing):
+        q.unlink()
+        try:
+            q.close()
+        except BufferError:
+            pass #something still has a zero_copy view, the mapping goes away with the process
+
+class BatchGet(QueueWrapper):
+    """
+    inq for a @batched block fed by an unbatched one: get() waits for
+    one item, then takes whatever else is already waiting, up to max_batch
+    """
+    def __init__(self, q, max_batch=64):
+        if getattr(q, "zero_copy", False):
+            raise(Exception("Can't batch from a zero_copy ShmRing, each get() frees the last slot"))
+        self.q = q
+        self.max_batch = max_batch
+    def get(self, block=True, timeout=None):
+        batch = [self.q.get(block, timeout)]
+        try:
+            while len(batch) < self.max_batch:
+                batch.append(self.q.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+    def get_nowait(self):
+        return self.get(False)
+
+class Unbatch(QueueWrapper):
+    """
+    outq for a @batched block feeding an unbatched one
+    """
+    def __init__(self, q):
+        self.q = q
+    def put(self, batch, *args, **kwargs):
+        for x in batch:
+            self.q.put(x, *args, **kwargs)
+    def put_nowait(self, batch):
+        self.put(batch, False)
+
+def is_batched(fn):
+    return getattr(fn, "batched", False)
+
+def adapt_batching(producer, consumer, q, max_batch=64):
+    """
+    The (outq, inq) views of q for a producer -> consumer hop, so that
+    batched and unbatched blocks can sit next to each other
+    """
+    if is_batched(producer) == is_batched(consumer):
+        return q, q
+    if is_batched(producer):
+        return Unbatch(q), q
+    return q, BatchGet(q, max_batch)
+
+def setup_step(block, config):
+    """
+    A stepblock's step, always taking a single item (for fusing)
+    """
+    step = block.setup(config)
+    if is_batched(block):
+        single = lambda x: step([x])
+        single.close = getattr(step, "close", None)
+        return single
+    return step
+
+class SeqTag(QueueWrapper):
+    """
+    outq in front of a replicate(): numbers everything put on it
+    """
+    def __init__(self, q):
+        super().__init__(q)
+        self.seq = 0
+    def put(self, x, *args, **kwargs):
+        self.q.put((self.seq, x), *args, **kwargs)
+        self.seq += 1
+    def put_nowait(self, x):
+        self.put(x, False)
+
+class SeqGet(QueueWrapper):
+    """
+    inq for one copy of a replicated loop block: strips the sequence
+    number off, and since asking for the next item means the block is
+    done with the last one, tells the reorder stage so first
+    """
+    def __init__(self, q, out):
+        super().__init__(q)
+        self.out = out
+        self.seq = None
+    def get(self, block=True, timeout=None):
+        if self.seq is not None:
+            self.out.put((self.seq, (), True))
+            self.seq = None
+        self.seq, x = self.q.get(block, timeout)
+        return x
+    def get_nowait(self):
+        return self.get(False)
+
+class SeqPut(QueueWrapper):
+    """
+    outq for one copy of a replicated loop block, tagging what it puts
+    with the sequence number of the item it's working on
+    """
+    def __init__(self, q, inq):
+        super().__init__(q)
+        self.inq = inq
+    def put(self, y, *args, **kwargs):
+        self.q.put((self.inq.seq, (y,), False), *args, **kwargs)
+    def put_nowait(self, y):
+        self.put(y, False)
+
+class replicate:
+    """
+    Goes in a chain in place of a block that can't keep up on one core,
+    to run n copies of it side by side:
+
+        [mic_audio, replicate(codec2enc, 2), m17frame, ...]
+
+    Items going in are numbered and shared out among the copies over one
+    multiprocessing.Queue, whichever copy is free takes the next one, and
+    a reorder stage after them puts results back in the original order -
+    so audio doesn't get shuffled.
+
+    Every copy only sees some of the items, so this is for blocks where
+    each item stands on its own (no state carried from one to the next).
+    Stepblocks (batched or not) are run step by step; any other block gets
+    its queues wrapped so each item's results are followed by a marker
+    saying that item's done. The input can't be a ShmRing (it's single
+    consumer) or have a drop policy (a dropped number would stall the
+    reorder stage) - put drop links after it instead.
+    """
+    heavy = True #never fused
+
+    def __init__(self, block, n):
+        if n < 1:
+            raise(Exception("replicate() needs at least one copy"))
+        self.block = block
+        self.n = n
+        self.__name__ = "%s*%d"%(block.__name__, n)
+
+    def check_link(self, l):
+        if l.policy != "block":
+            raise(Exception("%s can't take its input over a %s link, the reorder stage would wait forever on what got dropped"%(self.__name__, l.policy)))
+        if l.transport != "queue":
+            return link("queue", maxsize=l.maxsize)
+        return l
+
+    def worker(self, config, inq, outq):
+        """
+        One copy: takes (seq, x) from inq, puts (seq, ys, done) on outq
+        """
+        if hasattr(self.block, "setup"):
+            step = setup_step(self.block, config)
+            try:
+                while 1:
+                    seq, x = inq.get()
+                    outq.put((seq, list(step(x)), True))
+            finally:
+                close_steps([step])
+        tagged = SeqGet(inq, outq)
+        self.block(config, tagged, SeqPut(outq, tagged))
+
+    def processes(self, name):
+        """
+        (name, target) for every process this takes - the copies, then
+        the reorder stage
+        """
+        procs = [("%s#%d"%(name, i), self.worker) for i in range(self.n)]
+        procs.append(("%s#reorder"%(name), reorder))
+        return procs
+
+def reorder(config, inq, outq):
+    """
+    Puts what the copies of a replicate()d block made back in order.
+    Results for the item that's next in line go straight through, anything
+    else waits until everything before it is done.
+    """
+    nxt = 0
+    pending = {}
+    done = set()
+    while 1:
+        seq, ys, finished = inq.get()
+        if seq == nxt:
+            for y in ys:
+                outq.put(y)
+        elif ys:
+            pending.setdefault(seq, []).extend(ys)
+        if finished:
+            done.add(seq)
+        while nxt in done:
+            done.remove(nxt)
+            nxt += 1
+            for y in pending.pop(nxt, ()):
+                outq.put(y)
+
+def connect(producer, consumer, q, max_batch=64):
+    """
+    The (outq, inq) views of q for a producer -> consumer hop, for
+    batching (see adapt_batching) and numbering items for a replicate()
+    """
+    if isinstance(consumer, replicate):
+        outq = SeqTag(q)
+        return (Unbatch(outq) if is_batched(producer) else outq), q
+    return adapt_batching(producer, consumer, q, max_batch)
+
+def _is_step(fn):
+    return hasattr(fn, "setup") and not getattr(fn, "heavy", False)
+
+def _is_host(fn):
+    return not isinstance(fn, link) and not hasattr(fn, "setup") and not getattr(fn, "heavy", False)
+
+def _names(blocks):
+    return "+".join(b.__name__ for b in blocks)
+
+def fused(run):
+    """
+    One block that runs a whole list of stepblocks back to back
+    """
+    def fn(config, inq, outq):
+        steps = [setup_step(b, config) for b in run]
+        try:
+            while 1:
+                for y in run_steps(steps, inq.get()):
+                    outq.put(y)
+        finally:
+            close_steps(steps)
+    fn.__name__ = _names(run)
+    return fn
+
+def fused_after(host, run):
+    """
+    host, with the steps of run called on everything it puts
+    """
+    def fn(config, inq, outq):
+        steps = [setup_step(b, config) for b in run]
+        try:
+            host(config, inq, StepPut(outq, steps))
+        finally:
+            close_steps(steps)
+    fn.__name__ = _names([host] + run)
+    return fn
+
+def fused_before(run, host):
+    """
+    host, with the steps of run called on everything it gets
+    """
+    def fn(config, inq, outq):
+        steps = [setup_step(b, config) for b in run]
+        try:
+            host(config, StepGet(inq, steps), outq)
+        finally:
+            close_steps(steps)
+    fn.__name__ = _names(run + [host])
+    return fn
+
+def fuse_chain(chain):
+    """
+    Rewrite a chain so runs of lightweight stepblocks get called directly
+    inside a neighboring block's process, instead of each getting its own
+    process with a multiprocessing.Queue (and pickling) on either side.
+
+    A run of steps rides along with the block before it if that's an
+    ordinary (not @heavy) loop block, otherwise with the block after it,
+    otherwise it becomes a process of its own. @heavy blocks, like the
+    codec2 ones, always stay in their own process, and link()s stay where
+    they are.
+    """
+    out = []
+    i = 0
+    while i < len(chain):
+        fn = chain[i]
+        if not _is_step(fn):
+            out.append(fn)
+            i += 1
+            continue
+        j = i
+        while j < len(chain) and _is_step(chain[j]):
+            j += 1
+        run = list(chain[i:j])
+        if out and _is_host(out[-1]):
+            out[-1] = fused_after(out[-1], run)
+        elif j < len(chain) and _is_host(chain[j]):
+            out.append(fused_before(run, chain[j]))
+            j += 1
+        elif len(run) == 1:
+            out.append(run[0])
+        else:
+            out.append(fused(run))
+        i = j
+    return out
+
+
+class test_fuse(unittest.TestCase):
+    def setUp(self):
+        from .blocks import stepblock, heavy
+        def src(config, inq, outq):
+            for x in range(5):
+                outq.put(x)
+        def sink(config, inq, outq):
+            while 1:
+                outq.put(("sink", inq.get()))
+        @stepblock
+        def double(config):
+            return lambda x: [x, x]
+        @stepblock
+        def inc(config):
+            return lambda x: [x + config["by"]]
+        @stepblock
+        def odd(config):
+            return lambda x: [x] if x % 2 else []
+        self.src, self.sink, self.double, self.inc, self.odd = src, sink, double, inc, odd
+        self.heavy_inc = heavy(stepblock(inc.setup))
+
+    def run_chain(self, chain, n):
+        config = {"by": 1}
+        inq = queue.Queue()
+        for fn in chain:
+            outq = queue.Queue()
+            threading.Thread(target=fn, args=(config, inq, outq), daemon=True).start()
+            inq = outq
+        return [inq.get(timeout=5) for _ in range(n)]
+
+    def test_plan(self):
+        chain = [self.src, self.double, self.inc, self.heavy_inc, self.inc, self.odd, self.sink]
+        fused_chain = fuse_chain(chain)
+        self.assertEqual([f.__name__ for f in fused_chain], ["src+double+inc", "inc", "inc+odd+sink"])
+
+    def test_same_output(self):
+        chain = [self.src, self.double, self.inc, self.heavy_inc, self.odd, self.inc, self.sink]
+        expected = [("sink", x) for x in [4, 4, 6, 6]]
+        self.assertEqual(self.run_chain(chain, 4), expected)
+        self.assertEqual(self.run_chain(fuse_chain(chain), 4), expected)
+
+    def test_standalone_run(self):
+        chain = [self.src, self.heavy_inc, self.double, self.odd, self.heavy_inc]
+        fused_chain = fuse_chain(chain)
+        self.assertEqual([f.__name__ for f in fused_chain], ["src", "inc", "double+odd", "inc"])
+        self.assertEqual(self.run_chain(fused_chain, 4), [2, 2, 4, 4])
+
+
+class test_step_get(unittest.TestCase):
+    def test_timeout_with_filtered_items(self):
+        q = queue.Queue()
+        stop = threading.Event()
+        def feed():
+            while not stop.is_set():
+                q.put(0) #all filtered out
+                time.sleep(.01)
+        threading.Thread(target=feed, daemon=True).start()
+        g = StepGet(q, [lambda x: [x] if x else []])
+        start = time.monotonic()
+        try:
+            self.assertRaises(queue.Empty, g.get, True, .2)
+        finally:
+            stop.set()
+        self.assertLess(time.monotonic() - start, 1)
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class test_shm_ring(unittest.TestCase):
+    def test_roundtrip(self):
+        ring = ShmRing(slot_size=64, nslots=4)
+        try:
+            items = [b"abc", numpy.arange(10, dtype="<h"), {"x": 1}, bytearray(b"\x00"*64)]
+            for x in items:
+                ring.put(x)
+            self.assertEqual(ring.qsize(), 4)
+            with self.assertRaises(queue.Full):
+                ring.put_nowait(b"one too many")
+            out = [ring.get() for _ in items]
+            self.assertEqual(out[0], b"abc")
+            self.assertEqual(out[1].tolist(), list(range(10)))
+            self.assertEqual(out[1].dtype, numpy.dtype("<h"))
+            self.assertEqual(out[2], {"x": 1})
+            self.assertEqual(out[3], bytes(64))
+            with self.assertRaises(queue.Empty):
+                ring.get_nowait()
+            with self.assertRaises(Exception):
+                ring.put(bytes(65))
+        finally:
+            close_queue(ring)
+
+    def test_byte_order(self):
+        ring = ShmRing(slot_size=512, nslots=4)
+        try:
+            ring.put(numpy.array([1, -2, 300], dtype=">h"))
+            ring.put(numpy.array([(1, 2.5)], dtype=[("a", ">i4"), ("b", "<f8")]))
+            x = ring.get()
+            self.assertEqual(x.tolist(), [1, -2, 300])
+            self.assertTrue(x.dtype.isnative)
+            #structured dtypes go the pickled way, and come back as they were
+            y = ring.get()
+            self.assertEqual(y.tolist(), [(1, 2.5)])
+            self.assertEqual(y.dtype.names, ("a", "b"))
+        finally:
+            close_queue(ring)
+
+    def test_failed_put(self):
+        ring = ShmRing(slot_size=256, nslots=2)
+        try:
+            #object arrays get pickled, not copied as raw pointers
+            ring.put(numpy.array(["a", 1], dtype=object))
+            self.assertEqual(ring.get().tolist(), ["a", 1])
+            for _ in range(3):
+                with self.assertRaises(Exception):
+                    ring.put(bytes(257))
+                with self.assertRaises(Exception):
+                    ring.put(lambda: "can't pickle this")
+            #none of that cost a slot
+            ring.put_nowait(b"a")
+            ring.put_nowait(b"b")
+            self.assertEqual([ring.get(), ring.get()], [b"a", b"b"])
+        finally:
+            close_queue(ring)
+
+    def test_zero_copy(self):
+        ring = ShmRing(slot_size=64, nslots=2, zero_copy=True)
+        try:
+            ring.put(numpy.arange(4, dtype="<h"))
+            ring.put(b"xyz")
+            a = ring.get()
+            self.assertEqual(a.tolist(), [0, 1, 2, 3])
+            #slot isn't handed back until the next get
+            with self.assertRaises(queue.Full):
+                ring.put_nowait(b"no room yet")
+            self.assertEqual(bytes(ring.get()), b"xyz")
+            del a
+            ring.put_nowait(b"room now")
+        finally:
+            close_queue(ring)
+
+    def test_across_processes(self):
+        ring = ShmRing(slot_size=400, nslots=3)
+        def producer(ring):
+            for i in range(50):
+                ring.put(numpy.full(160, i, dtype="<h"))
+        try:
+            p = multiprocessing.Process(target=producer, args=(ring,))
+            p.start()
+            got = [ring.get(timeout=5) for _ in range(50)]
+            p.join()
+            self.assertEqual([int(x[0]) for x in got], list(range(50)))
+            self.assertTrue(all((x == x[0]).all() and len(x) == 160 for x in got))
+        finally:
+            close_queue(ring)
+
+class test_batching(unittest.TestCase):
+    def test_adapt(self):
+        from .blocks import batched
+        def plain(config, inq, outq):
+            while 1:
+                outq.put(inq.get() + 1)
+        @batched
+        def summed(config, inq, outq):
+            while 1:
+                xs = inq.get()
+                outq.put([sum(xs)] * len(xs))
+        q1, q2, q3 = queue.Queue(), queue.Queue(), queue.Queue()
+        for x in range(5):
+            q1.put(x)
+        _, inq = adapt_batching(plain, summed, q1)
+        outq, _ = adapt_batching(summed, plain, q2)
+        self.assertEqual(inq.get(), [0, 1, 2, 3, 4])
+        outq.put([7, 8])
+        self.assertEqual([q2.get(), q2.get()], [7, 8])
+        self.assertEqual(adapt_batching(summed, summed, q3), (q3, q3))
+
+    def test_fused_batched_step(self):
+        from .blocks import stepblock, batched
+        @batched
+        @stepblock
+        def double_all(config):
+            return lambda xs: [x * 2 for x in xs]
+        self.assertEqual(run_steps([setup_step(double_all, {})], 4), [8])
+
+    def test_close_hook(self):
+        import os
+        import tempfile
+        from .blocks import stepblock, batched, teefile
+        class Stop(Exception):
+            pass
+        class Feed:
+            def __init__(self, items):
+                self.items = list(items)
+            def get(self):
+                if not self.items:
+                    raise(Stop())
+                return self.items.pop(0)
+        closed = []
+        @batched
+        @stepblock
+        def closing(config):
+            step = lambda xs: xs
+            step.close = lambda: closed.append(True)
+            return step
+        self.assertRaises(Stop, closing, {}, Feed([[1], [2]]), queue.Queue())
+        self.assertRaises(Stop, fused([closing]), {}, Feed([1, 2]), queue.Queue())
+        self.assertEqual(closed, [True, True])
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertRaises(Stop, teefile(filename), {}, Feed([[b"ab", b"c"], [b"d"]]), queue.Queue())
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"abcd")
+        finally:
+            os.unlink(filename)
+
+class test_drop_policy(unittest.TestCase):
+    def fill(self, policy, transport="queue"):
+        import time
+        q = link(transport, maxsize=3, policy=policy).make()
+        for x in range(5):
+            q.put(x)
+        time.sleep(.1) #let the mp.Queue feeder thread catch up
+        got = []
+        while 1:
+            try:
+                got.append(q.get(timeout=.2))
+            except queue.Empty:
+                break
+        close_queue(q)
+        return got, q.dropped
+
+    def test_drop_newest(self):
+        self.assertEqual(self.fill("drop_newest"), ([0, 1, 2], 2))
+        self.assertEqual(self.fill("drop_newest", "shm"), ([0, 1, 2], 2))
+
+    def test_drop_oldest(self):
+        self.assertEqual(self.fill("drop_oldest"), ([2, 3, 4], 2))
+
+    def test_bad_policy(self):
+        self.assertRaises(Exception, link, policy="drop_random")
+        self.assertRaises(Exception, link, transport="shm", maxsize=3, policy="drop_oldest")
+
+class test_wake_queue(unittest.TestCase):
+    def test_select(self):
+        import selectors
+        for q in (WakeQueue(), WakeQueue(queue.Queue())):
+            sel = selectors.DefaultSelector()
+            sel.register(q, selectors.EVENT_READ)
+            self.assertEqual(sel.select(0), [])
+            self.assertEqual(q.drain(), [])
+            for x in range(3):
+                q.put(x)
+            self.assertEqual(len(sel.select(1)), 1)
+            self.assertEqual(q.drain(), [0, 1, 2])
+            self.assertEqual(sel.select(0), [])
+            sel.close()
+
+    def test_other_process(self):
+        import selectors
+        q = WakeQueue()
+        def producer(q):
+            for x in range(100):
+                q.put(x)
+        p = multiprocessing.Process(target=producer, args=(q,))
+        p.start()
+        got = []
+        with selectors.DefaultSelector() as sel:
+            sel.register(q, selectors.EVENT_READ)
+            while len(got) < 100 and sel.select(5):
+                got += q.drain()
+        p.join()
+        self.assertEqual(got, list(range(100)))
+
+class test_replicate(unittest.TestCase):
+    def run_replicas(self, block, n, items):
+        rep = replicate(block, n)
+        q = queue.Queue()
+        outq, inq = connect(None, rep, q)
+        rq, results = queue.Queue(), queue.Queue()
+        for name, target in rep.processes("x"):
+            args = (None, rq, results) if target is reorder else (None, inq, rq)
+            threading.Thread(target=target, args=args, daemon=True).start()
+        for x in items:
+            outq.put(x)
+        got = []
+        while 1:
+            try:
+                got.append(results.get(timeout=.5))
+            except queue.Empty:
+                return got
+
+    def test_stepblock_order(self):
+        import time
+        import random
+        from .blocks import stepblock
+        @stepblock
+        def slow_split(config):
+            def step(x):
+                time.sleep(random.random() / 200)
+                return [x] * (x % 3)
+            return step
+        items = list(range(100))
+        self.assertEqual(self.run_replicas(slow_split, 4, items), [x for x in items for _ in range(x % 3)])
+
+    def test_loop_block_order(self):
+        import time
+        import random
+        def slow_loop(config, inq, outq):
+            while 1:
+                x = inq.get()
+                for i in range(x % 3):
+                    time.sleep(random.random() / 500)
+                    outq.put((x, i))
+        items = list(range(60))
+        self.assertEqual(self.run_replicas(slow_loop, 3, items), [(x, i) for x in items for i in range(x % 3)])
+
+    def test_links(self):
+        rep = replicate(lambda config, inq, outq: None, 2)
+        self.assertEqual(rep.check_link(link("shm", maxsize=8)).transport, "queue")
+        self.assertRaises(Exception, rep.check_link, link(maxsize=8, policy="drop_oldest"))
+
+class test_links(unittest.TestCase):
+    def test_split(self):
+        a, b, c = (lambda: None), (lambda: None), (lambda: None)
+        shm = link(transport="shm")
+        default = link()
+        blocks, links = split_links([a, shm, b, c], default)
+        self.assertEqual(blocks, [a, b, c])
+        self.assertEqual(links, [shm, default, default])
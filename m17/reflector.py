@@ -0,0 +1,545 @@
+"""
+Routing for udp_reflector: who's listening on which module, and which
+module each stream coming in is for.
+
+Clients connect the same way they do to other M17 reflectors:
+
+    CONN + 6 byte callsign + module letter  -> ACKN (or NACK)
+    PONG + 6 byte callsign                  (answering our PINGs)
+    DISC + 6 byte callsign                  -> gone
+
+Streams ("M17 " ipFrames) are only taken from clients that have
+CONNected. They go to the module in their dst callsign if it's this
+reflector's - "M17-XXX B" is module B of M17-XXX - or else to the
+sender's own module. Only the streamid and dst get looked at, and only on
+the first frame of a stream: after that (sender, streamid) -> module is
+a dict lookup until the stream ends. Frames are passed along untouched,
+to that module's subscribers only, so a frame costs one sendmmsg() to
+the people who want it no matter how many are on other modules.
+
+For more than one core, several workers can share a port with
+SO_REUSEPORT (udp_reflector's workers argument). The kernel hands each
+one the packets from a fixed set of clients, by a hash of their
+address, so a client's CONN, PONGs and streams all land on the same
+worker and its stream cache stays valid. Who's on which module is
+shared through SharedSubscribers, so any worker can fan out to everyone.
+"""
+import socket
+import string
+import struct
+import unittest
+import multiprocessing
+
+from .address import Address
+from .frames import ipFrameView
+from . import mmsg
+
+_u16 = struct.Struct(">H")
+
+def dst_module(callsign):
+    """
+    Module letter from a reflector callsign like "M17-XXX B", None if
+    there isn't one
+    >>> dst_module("M17-M17 C"), dst_module("W2FBI")
+    ('C', None)
+    """
+    parts = callsign.split(" ")
+    if len(parts) == 2 and len(parts[1]) == 1 and parts[1] in string.ascii_uppercase:
+        return parts[1]
+    return None
+
+def wire_callsign(bs, offset):
+    """
+    Callsign in the 6 bytes at offset, None for broadcast or anything
+    else that isn't one
+    """
+    addr = int.from_bytes(bs[offset:offset + 6], "big")
+    if not addr or addr >= 40**9:
+        return None
+    return Address(addr=addr).callsign
+
+class ModuleRouter:
+    """
+    callsign - ours, sent along with PINGs
+    modules - letters clients can connect to
+    max_streams - streams remembered per sender, in case some never end
+    """
+    def __init__(self, callsign, modules=string.ascii_uppercase, max_streams=16):
+        self.ping_packet = b"PING" + bytes(Address(callsign=callsign))
+        self.dst_prefix = Address(callsign=callsign).callsign + " "
+        self.modules = modules
+        self.max_streams = max_streams
+        self.module_of = {} #conn -> module
+        self.subscribers = {} #module -> {conn: callsign}, in the order they came
+        self.targets = {} #module -> {sender: tuple of everyone else on it}
+        self.pinged = {} #module -> tuple of our subscribers, for ping()
+        self.streams = {} #sender conn -> {streamid: module}
+        self.unrouted = 0
+
+    def subscribe(self, conn, module, callsign=None):
+        """
+        Put conn on module, returns False if there's no room
+        """
+        self.unsubscribe(conn)
+        self.module_of[conn] = module
+        self.subscribers.setdefault(module, {})[conn] = callsign
+        self.targets.pop(module, None)
+        self.pinged.pop(module, None)
+        return True
+
+    def unsubscribe(self, conn):
+        module = self.module_of.pop(conn, None)
+        if module is not None:
+            subs = self.subscribers[module]
+            del subs[conn]
+            if not subs:
+                del self.subscribers[module]
+            self.targets.pop(module, None)
+            self.pinged.pop(module, None)
+
+    def forget(self, conn):
+        """
+        conn's gone (disconnected or timed out)
+        """
+        self.unsubscribe(conn)
+        self.streams.pop(conn, None)
+
+    def listeners(self, module, sender):
+        """
+        Everyone on module but sender, as a tuple that stays the same
+        object (and so keeps its sendmmsg() headers) until someone comes
+        or goes
+        """
+        per_sender = self.targets.setdefault(module, {})
+        t = per_sender.get(sender)
+        if t is None:
+            t = per_sender[sender] = tuple(c for c in self.members(module) if c != sender)
+        return t
+
+    def members(self, module):
+        """
+        Everyone on module
+        """
+        return self.subscribers.get(module, ())
+
+    def route(self, bs, conn):
+        """
+        Which module the frame bs from conn is for, None to drop it
+        """
+        if len(bs) < ipFrameView.sz:
+            return None
+        own = self.module_of.get(conn)
+        if own is None:
+            #never CONNected, or gone since
+            return None
+        streamid = _u16.unpack_from(bs, 4)[0]
+        streams = self.streams.get(conn)
+        if streams is None:
+            streams = self.streams[conn] = {}
+        module = streams.get(streamid)
+        if module is None:
+            dst = wire_callsign(bs, ipFrameView.lich_offset)
+            module = own
+            if dst is not None and dst.startswith(self.dst_prefix):
+                #only a module of ours, "W2FBI D" isn't for module D
+                letter = dst_module(dst)
+                if letter is not None and letter in self.modules:
+                    module = letter
+            if len(streams) >= self.max_streams:
+                streams.clear()
+            streams[streamid] = module
+        if _u16.unpack_from(bs, ipFrameView.fn_offset)[0] & 0x8000:
+            #last frame, the next stream from conn decides for itself
+            del streams[streamid]
+        return module
+
+    def handle(self, sock, bs, conn):
+        """
+        Deal with one packet from conn
+        """
+        magic = bs[:4]
+        if magic == b"M17 ":
+            module = self.route(bs, conn)
+            if module is None:
+                self.unrouted += 1
+                return
+            mmsg.sendto_many(sock, bs, self.listeners(module, conn))
+        elif magic == b"CONN" and len(bs) >= 11:
+            module = bs[10:11].decode("ascii", "replace")
+            if module not in self.modules:
+                sock.sendto(b"NACK", conn)
+                return
+            callsign = wire_callsign(bs, 4)
+            if callsign is None:
+                sock.sendto(b"NACK", conn)
+                return
+            if self.module_of.get(conn) != module:
+                #streams it had going were routed by the old module
+                self.streams.pop(conn, None)
+                if not self.subscribe(conn, module, callsign):
+                    sock.sendto(b"NACK", conn)
+                    return
+            sock.sendto(b"ACKN", conn)
+        elif magic == b"DISC":
+            self.forget(conn)
+        #PONG and anything else just keeps conn from timing out
+
+    def ping(self, sock):
+        """
+        PING everyone connected, their PONGs keep them from timing out
+        """
+        for module, subs in self.subscribers.items():
+            #same tuple until someone comes or goes, so it keeps its
+            #sendmmsg() headers like listeners() does
+            t = self.pinged.get(module)
+            if t is None:
+                t = self.pinged[module] = tuple(subs)
+            mmsg.sendto_many(sock, self.ping_packet, t)
+
+class SharedSubscribers:
+    """
+    Who's on which module across every worker, in shared memory.
+
+    Each worker has a shard of slots (IPv4 address, port, module letter)
+    that only it writes, and a generation counter it bumps to odd before
+    changing its shard and back to even after, so readers can tell they
+    caught it halfway and look again. Readers keep what they read until
+    one of the counters moves, which is only when someone connects or
+    goes, so looking up a module's listeners is normally just a look at
+    the counters.
+
+    Make it before starting the workers, and give each one its
+    shard(worker) to write to.
+    """
+    slot = struct.Struct(">4sHc")
+    empty = b"\0"
+    max_retries = 10000
+
+    def __init__(self, workers, slots=1024):
+        self.workers = workers
+        self.slots = slots
+        self.table = multiprocessing.RawArray("B", workers * slots * self.slot.size)
+        self.gens = multiprocessing.RawArray("Q", workers)
+        self.seen = None
+        self.modules = {}
+        self.last_good = {} #worker -> rows, for a shard left halfway written
+
+    def shard(self, worker):
+        return Shard(self, worker)
+
+    def generation(self):
+        return tuple(self.gens)
+
+    def read_shard(self, w):
+        gens = self.gens
+        size = self.slot.size
+        start = w * self.slots * size
+        for _ in range(self.max_retries):
+            g = gens[w]
+            if g & 1:
+                continue #being written right now
+            raw = bytes(self.table[start:start + self.slots * size])
+            if gens[w] == g:
+                rows = [self.slot.unpack_from(raw, i * size) for i in range(self.slots)]
+                self.last_good[w] = rows
+                return rows
+        #its writer must have died halfway through, go with what we had
+        return self.last_good.get(w, [])
+
+    def members(self, module):
+        """
+        (host, port) of everyone on module, on any worker
+        """
+        gen = self.generation()
+        if gen != self.seen:
+            modules = {}
+            for w in range(self.workers):
+                for ip, port, m in self.read_shard(w):
+                    if m != self.empty:
+                        modules.setdefault(m.decode("ascii"), []).append((socket.inet_ntoa(ip), port))
+            self.modules = modules
+            self.seen = gen
+        return self.modules.get(module, ())
+
+class Shard:
+    """
+    One worker's part of a SharedSubscribers, for it to write its own
+    clients into
+    """
+    def __init__(self, shared, worker):
+        self.shared = shared
+        self.worker = worker
+        self.free = list(range(shared.slots - 1, -1, -1))
+        self.slot_of = {}
+
+    def _write(self, idx, ip, port, module):
+        shared = self.shared
+        gens = shared.gens
+        w = self.worker
+        gens[w] += 1
+        shared.slot.pack_into(shared.table, (w * shared.slots + idx) * shared.slot.size, ip, port, module)
+        gens[w] += 1
+
+    def add(self, conn, module):
+        """
+        Put conn on module, False if the shard's full
+        """
+        idx = self.slot_of.get(conn)
+        if idx is None:
+            if not self.free:
+                return False
+            idx = self.slot_of[conn] = self.free.pop()
+        self._write(idx, socket.inet_aton(conn[0]), conn[1], module.encode("ascii"))
+        return True
+
+    def remove(self, conn):
+        idx = self.slot_of.pop(conn, None)
+        if idx is not None:
+            self._write(idx, bytes(4), 0, self.shared.empty)
+            self.free.append(idx)
+
+class ShardedRouter(ModuleRouter):
+    """
+    ModuleRouter for one of several workers sharing a port: its own
+    clients go in its shard of shared, frames go to everyone's
+    """
+    def __init__(self, callsign, shared, worker, **kwargs):
+        super().__init__(callsign, **kwargs)
+        self.shared = shared
+        self.shard = shared.shard(worker)
+        self.shared_gen = None
+
+    def subscribe(self, conn, module, callsign=None):
+        super().subscribe(conn, module, callsign)
+        if not self.shard.add(conn, module):
+            self.unsubscribe(conn)
+            return False
+        return True
+
+    def unsubscribe(self, conn):
+        self.shard.remove(conn)
+        super().unsubscribe(conn)
+
+    def listeners(self, module, sender):
+        gen = self.shared.generation()
+        if gen != self.shared_gen:
+            #someone came or went, maybe on another worker
+            self.targets = {}
+            self.shared_gen = gen
+        return super().listeners(module, sender)
+
+    def members(self, module):
+        return self.shared.members(module)
+
+def example_frame(streamid, dst="M17-TST A", fn=0):
+    """
+    A stream frame from W2FBI to dst, for tests and bench_reflector
+    """
+    from .frames import ipFrame, initialLICH
+    lich = initialLICH(src=Address(callsign="W2FBI"), dst=Address(callsign=dst), streamtype=5, nonce=bytes(14))
+    return bytes(ipFrame(streamid=streamid, LICH=lich, frame_number=fn, payload=bytes(16)))
+
+class test_router(unittest.TestCase):
+    class fake_sock:
+        def __init__(self):
+            self.sent = []
+        def sendto(self, data, addr):
+            self.sent.append((bytes(data), addr))
+
+    def setUp(self):
+        #no ctypes on a fake socket, so plain sendto()s
+        self.sock = self.fake_sock()
+        mmsg._senders[self.sock] = mmsg.Sender(self.sock, use_mmsg=False)
+        self.r = ModuleRouter("M17-TST")
+
+    def conn(self, conn, module, callsign="W2FBI"):
+        self.r.handle(self.sock, b"CONN" + bytes(Address(callsign=callsign)) + module.encode("ascii"), conn)
+
+    def frame(self, streamid, dst="M17-TST A", fn=0):
+        return example_frame(streamid, dst, fn)
+
+    def sent_to(self, bs, conn):
+        self.sock.sent.clear()
+        self.r.handle(self.sock, bs, conn)
+        return sorted(addr for data,addr in self.sock.sent)
+
+    def test_connect(self):
+        self.conn("a", "A")
+        self.conn("b", "1")
+        self.assertEqual(self.sock.sent, [(b"ACKN", "a"), (b"NACK", "b")])
+        self.assertEqual(self.r.module_of, {"a": "A"})
+
+    def test_modules(self):
+        for c,m in [("a1", "A"), ("a2", "A"), ("a3", "A"), ("b1", "B")]:
+            self.conn(c, m)
+        self.assertEqual(self.sent_to(self.frame(1), "a1"), ["a2", "a3"])
+        self.assertEqual(self.sent_to(self.frame(2, "M17-TST B"), "a1"), ["b1"])
+        #no module in the dst, so the sender's
+        self.assertEqual(self.sent_to(self.frame(3, "SP5WWP"), "b1"), [])
+        self.assertEqual(self.sent_to(self.frame(3, "SP5WWP"), "a2"), ["a1", "a3"])
+        self.r.handle(self.sock, b"DISC" + bytes(Address(callsign="W2FBI")), "a3")
+        self.assertEqual(self.sent_to(self.frame(1), "a1"), ["a2"])
+
+    def test_stream_cache(self):
+        self.conn("a", "A")
+        self.conn("b", "B")
+        self.conn("x", "A")
+        #the dst only counts on the first frame
+        self.assertEqual(self.sent_to(self.frame(9, "M17-TST B"), "x"), ["b"])
+        self.assertEqual(self.sent_to(self.frame(9, "M17-TST A", fn=1), "x"), ["b"])
+        self.assertEqual(self.sent_to(self.frame(9, "M17-TST A", fn=0x8002), "x"), ["b"])
+        #stream's over, so the same streamid can go somewhere else now
+        self.assertEqual(self.sent_to(self.frame(9, "M17-TST A"), "x"), ["a"])
+        self.r.forget("x")
+        self.assertNotIn("x", self.r.streams)
+
+    def test_bad_addresses(self):
+        #broadcast and past 40**9 aren't callsigns, and mustn't take the reflector down
+        self.r.handle(self.sock, b"CONN" + b"\xff"*6 + b"A", "a")
+        self.assertEqual(self.sock.sent, [(b"NACK", "a")])
+        self.conn("b", "A")
+        bad = bytearray(self.frame(1))
+        bad[ipFrameView.lich_offset:ipFrameView.lich_offset + 6] = b"\xff"*6
+        #no module in the dst, so the sender's - and none for a stranger
+        self.assertEqual(self.sent_to(bytes(bad), "c"), [])
+        self.conn("c", "A")
+        self.assertEqual(self.sent_to(bytes(bad), "c"), ["b"])
+
+    def test_unrouted(self):
+        self.assertEqual(self.sent_to(self.frame(1, "SP5WWP"), "nobody"), [])
+        self.assertEqual(self.sent_to(b"M17 short", "nobody"), [])
+        self.assertEqual(self.r.unrouted, 2)
+
+    def test_ping(self):
+        self.conn("a", "A")
+        self.conn("b", "B")
+        self.sock.sent.clear()
+        self.r.ping(self.sock)
+        self.assertEqual(sorted(addr for data,addr in self.sock.sent), ["a", "b"])
+        self.assertTrue(all(data.startswith(b"PING") for data,addr in self.sock.sent))
+        #same tuple every time, until module A changes
+        t = self.r.pinged["A"]
+        self.r.ping(self.sock)
+        self.assertIs(self.r.pinged["A"], t)
+        self.conn("c", "A")
+        self.r.ping(self.sock)
+        self.assertEqual(self.r.pinged["A"], ("a", "c"))
+
+    def test_disc_then_expiry(self):
+        import io
+        import contextlib
+        from .apps import reflector_handlers
+        from .conntable import ConnectionTable
+        from .misc import fake_clock
+        packet_handler, on_expire = reflector_handlers(self.r)
+        c = fake_clock()
+        expired = []
+        conns = ConnectionTable(timeout=30, on_expire=lambda conn: (expired.append(conn), on_expire(self.sock, conn)), clock=c.clock)
+        def receive(bs, conn):
+            conns.seen(conn)
+            packet_handler(self.sock, conns, bs, conn)
+        receive(b"CONN" + bytes(Address(callsign="W2FBI")) + b"A", ("10.0.0.1", 1))
+        receive(b"CONN" + bytes(Address(callsign="SP5WWP")) + b"A", ("10.0.0.2", 2))
+        receive(b"DISC" + bytes(Address(callsign="W2FBI")), ("10.0.0.1", 1))
+        self.assertNotIn(("10.0.0.1", 1), conns)
+        c.now += 31
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            conns.expire()
+        #only the one that went quiet times out
+        self.assertEqual(expired, [("10.0.0.2", 2)])
+        self.assertEqual(out.getvalue(), "10.0.0.2:2 timed out\n")
+        self.assertEqual(self.r.module_of, {})
+
+    def test_must_connect(self):
+        self.conn("a", "A")
+        self.conn("b", "B")
+        #a stranger can't get anything relayed, whatever the dst says
+        self.assertEqual(self.sent_to(self.frame(1, "M17-TST A"), "x"), [])
+        self.assertEqual(self.sent_to(self.frame(2, "M17-TST B"), "x"), [])
+        self.assertEqual(self.r.unrouted, 2)
+        #nor can someone who's left
+        self.conn("x", "A")
+        self.r.handle(self.sock, b"DISC" + bytes(Address(callsign="W2FBI")), "x")
+        self.assertEqual(self.sent_to(self.frame(3, "M17-TST B"), "x"), [])
+
+    def test_other_dst(self):
+        self.conn("a", "A")
+        self.conn("a2", "A")
+        self.conn("d", "D")
+        #not our callsign, so the module letter in it doesn't count
+        self.assertEqual(self.sent_to(self.frame(1, "W2FBI D"), "a"), ["a2"])
+        self.assertEqual(self.sent_to(self.frame(2, "M17-XYZ D"), "a"), ["a2"])
+        self.assertEqual(self.sent_to(self.frame(3, "M17-TST D"), "a"), ["d"])
+
+class test_sharded(unittest.TestCase):
+    def setUp(self):
+        self.sock = test_router.fake_sock()
+        mmsg._senders[self.sock] = mmsg.Sender(self.sock, use_mmsg=False)
+        self.shared = SharedSubscribers(2, slots=2)
+        self.routers = [ShardedRouter("M17-TST", self.shared, w) for w in range(2)]
+
+    def conn(self, w, conn, module):
+        self.sock.sent.clear()
+        self.routers[w].handle(self.sock, b"CONN" + bytes(Address(callsign="W2FBI")) + module.encode("ascii"), conn)
+        return self.sock.sent[-1][0]
+
+    def test_across_workers(self):
+        a, b, c = ("127.0.0.1", 1), ("127.0.0.1", 2), ("10.0.0.3", 3)
+        self.assertEqual(self.conn(0, a, "A"), b"ACKN")
+        self.assertEqual(self.conn(1, b, "A"), b"ACKN")
+        self.assertEqual(self.conn(1, c, "B"), b"ACKN")
+        frame = example_frame(1)
+        self.sock.sent.clear()
+        self.routers[0].handle(self.sock, frame, a)
+        self.assertEqual([addr for data,addr in self.sock.sent], [b])
+        #b moves to B, worker 0 notices
+        self.conn(1, b, "B")
+        self.sock.sent.clear()
+        self.routers[0].handle(self.sock, example_frame(2, "M17-TST B"), a)
+        self.assertEqual(sorted(addr for data,addr in self.sock.sent), sorted([b, c]))
+        #only the owning worker pings
+        self.sock.sent.clear()
+        self.routers[0].ping(self.sock)
+        self.assertEqual([addr for data,addr in self.sock.sent], [a])
+
+    def test_full_shard(self):
+        for port in range(2):
+            self.assertEqual(self.conn(0, ("127.0.0.1", port), "A"), b"ACKN")
+        self.assertEqual(self.conn(0, ("127.0.0.1", 99), "A"), b"NACK")
+        self.routers[0].forget(("127.0.0.1", 0))
+        self.assertEqual(self.conn(0, ("127.0.0.1", 99), "A"), b"ACKN")
+        self.assertEqual(sorted(self.shared.members("A")), [("127.0.0.1", 1), ("127.0.0.1", 99)])
+
+    def test_dead_writer(self):
+        a = ("127.0.0.1", 1)
+        self.conn(1, a, "A")
+        self.assertEqual(self.shared.members("A"), [a])
+        #worker 1 died in the middle of a write
+        self.shared.gens[1] += 1
+        self.shared.slot.pack_into(self.shared.table, self.shared.slots * self.shared.slot.size, bytes(4), 0, b"B")
+        self.assertEqual(self.shared.members("A"), [a])
+
+    def test_bad_dst(self):
+        #every worker routes the same way, so none of them can go down on it
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        self.conn(0, a, "A")
+        self.conn(1, b, "A")
+        bad = bytearray(example_frame(1))
+        bad[ipFrameView.lich_offset:ipFrameView.lich_offset + 6] = b"\xff"*6
+        for w in range(2):
+            self.sock.sent.clear()
+            self.routers[w].handle(self.sock, bytes(bad), (a, b)[w])
+            self.assertEqual([addr for data,addr in self.sock.sent], [(b, a)[w]])
+        self.sock.sent.clear()
+        self.routers[0].handle(self.sock, b"CONN" + b"\xff"*6 + b"A", ("127.0.0.1", 3))
+        self.assertEqual(self.sock.sent, [(b"NACK", ("127.0.0.1", 3))])
+
+    def test_other_process(self):
+        def worker(shared):
+            shard = shared.shard(1)
+            shard.add(("192.168.1.1", 17000), "C")
+        p = multiprocessing.Process(target=worker, args=(self.shared,))
+        p.start()
+        p.join()
+        self.assertEqual(self.shared.members("C"), [("192.168.1.1", 17000)])
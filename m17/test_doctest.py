@@ -1,11 +1,16 @@
 import unittest
 import doctest
 
-from m17 import address, frames, framer, misc
+from m17 import address, frames, framer, misc, crc, batch, jitter, conntable, reflector
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(address))
     tests.addTests(doctest.DocTestSuite(frames))
     tests.addTests(doctest.DocTestSuite(framer))
     tests.addTests(doctest.DocTestSuite(misc))
+    tests.addTests(doctest.DocTestSuite(crc))
+    tests.addTests(doctest.DocTestSuite(batch))
+    tests.addTests(doctest.DocTestSuite(jitter))
+    tests.addTests(doctest.DocTestSuite(conntable))
+    tests.addTests(doctest.DocTestSuite(reflector))
     return tests
 
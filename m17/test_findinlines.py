@@ -1,5 +1,5 @@
 import unittest
-from m17 import address, frames, framer, misc, blocks
+from m17 import address, frames, framer, misc, blocks, crc, batch, pipeline, monitor, jitter, aio, mmsg, conntable, reflector
 
 def load_tests(loader, standard_tests, pattern):
     """
@@ -12,6 +12,15 @@ def load_tests(loader, standard_tests, pattern):
             misc,
             address,
             blocks,
+            crc,
+            batch,
+            pipeline,
+            monitor,
+            jitter,
+            aio,
+            mmsg,
+            conntable,
+            reflector,
             ]
     x = unittest.TestSuite([lm(x) for x in module_list])
     return unittest.TestSuite(x)
@@ -3,11 +3,13 @@ import unittest
 try:
     from address import Address
     from misc import example_bytes
-    from frames import initialLICH, regularFrame, ipFrame
+    from frames import M17_Frametype, initialLICH, regularFrame, ipFrame, ipFrameView, LICHReassembler, FramePool
+    from crc import CRCError, crc_ok_many
 except:
     from .address import Address
     from .misc import example_bytes
-    from .frames import initialLICH, regularFrame, ipFrame
+    from .frames import M17_Frametype, initialLICH, regularFrame, ipFrame, ipFrameView, LICHReassembler, FramePool
+    from .crc import CRCError, crc_ok_many
 
 class test_frame_encodings(unittest.TestCase):
     def test_lich(self):
@@ -52,3 +54,193 @@ class test_frame_encodings(unittest.TestCase):
         y = bytes(x)
         z = ipFrame.from_bytes(y)
         assert z == x
+
+    def test_ip_frame_pack_into_matches_bytes(self):
+        lich = initialLICH(
+                src=Address(callsign="W2FBI"),
+                dst=Address(callsign="SP5WWP"),
+                streamtype=5,
+                nonce=example_bytes(14),
+                )
+        x = ipFrame(
+                streamid=0xf00d,
+                LICH=lich,
+                frame_number=0xfffe,
+                payload=example_bytes(16)
+                );
+        buf = bytearray(3 + ipFrame.sz)
+        x.pack_into(buf, 3)
+        self.assertEqual(bytes(buf[3:]), bytes(x))
+
+    def test_ip_frame_view(self):
+        lich = initialLICH(
+                src=Address(callsign="W2FBI"),
+                dst=Address(callsign="SP5WWP"),
+                streamtype=5,
+                nonce=example_bytes(14),
+                )
+        x = ipFrame(
+                streamid=0xf00d,
+                LICH=lich,
+                frame_number=1234,
+                payload=example_bytes(16)
+                );
+        data = b"junk" + bytes(x)
+        v = ipFrameView(data, 4)
+        self.assertTrue(v.is_m17())
+        self.assertEqual(v.streamid, 0xf00d)
+        self.assertEqual(v.dst, lich.dst)
+        self.assertEqual(v.src, lich.src)
+        self.assertEqual(v.streamtype, 5)
+        self.assertEqual(bytes(v.nonce), bytes(lich.nonce))
+        self.assertEqual(bytes(v.lich), bytes(lich))
+        self.assertEqual(v.frame_number, 1234)
+        self.assertEqual(bytes(v.payload), bytes(x.payload))
+        self.assertEqual(bytes(v), bytes(x))
+        self.assertEqual(v.to_ipFrame(), x)
+
+    def test_ip_frame_crc(self):
+        lich = initialLICH(
+                src=Address(callsign="W2FBI"),
+                dst=Address(callsign="SP5WWP"),
+                streamtype=5,
+                nonce=example_bytes(14),
+                )
+        x = ipFrame(
+                streamid=0xf00d,
+                LICH=lich,
+                frame_number=1,
+                payload=example_bytes(16)
+                );
+        good = bytes(x)
+        self.assertTrue(ipFrameView(good).crc_ok())
+        bad = bytearray(good)
+        bad[40] ^= 0x10
+        self.assertFalse(ipFrameView(bad).crc_ok())
+        with self.assertRaises(CRCError):
+            ipFrame.from_bytes(bad)
+        self.assertEqual(crc_ok_many(good + bytes(bad) + good, ipFrame.sz).tolist(), [True, False, True])
+
+    def test_regular_frame_crc(self):
+        lich = initialLICH(
+                src=Address(callsign="W2FBI"),
+                dst=Address(callsign="SP5WWP"),
+                streamtype=5,
+                nonce=example_bytes(14),
+                )
+        y = bytearray(bytes(regularFrame(LICH=lich, frame_number=2, payload=example_bytes(16))))
+        self.assertEqual(len(y), regularFrame.sz)
+        y[10] ^= 1
+        with self.assertRaises(CRCError):
+            regularFrame.from_bytes(y)
+
+class test_lich_reassembly(unittest.TestCase):
+    def make_frames(self, callsign, first, count):
+        lich = initialLICH(
+                src=Address(callsign=callsign),
+                dst=Address(callsign="SP5WWP"),
+                streamtype=5,
+                nonce=example_bytes(14),
+                )
+        frames = [ bytes(regularFrame(LICH=lich, frame_number=fn, payload=example_bytes(16))) for fn in range(first, first+count)]
+        return lich, frames
+
+    def test_recover_bytes(self):
+        lich, frames = self.make_frames("W2FBI", 7, 5)
+        b = initialLICH.recover_bytes_from_bytes_frames(frames)
+        self.assertEqual(initialLICH.from_bytes(b), lich)
+
+    def test_interleaved_streams(self):
+        r = LICHReassembler()
+        lich_a, frames_a = self.make_frames("W2FBI", 3, 10)
+        lich_b, frames_b = self.make_frames("N0CALL", 0, 10)
+        got = []
+        for fa, fb in zip(frames_a, frames_b):
+            for stream, f in [("a", fa), ("b", fb)]:
+                x = r.add(f, stream)
+                if x:
+                    got.append((stream, x))
+        #each comes out once, as soon as the fifth frame is in
+        self.assertEqual(got, [("a", lich_a), ("b", lich_b)])
+        self.assertEqual(r.get("a"), lich_a)
+
+    def test_out_of_order(self):
+        r = LICHReassembler()
+        lich, frames = self.make_frames("W2FBI", 0, 5)
+        results = [r.add(f) for f in [frames[3], frames[1], frames[4], frames[0], frames[2]]]
+        self.assertEqual(results, [None]*4 + [lich])
+
+    def test_corrupt_chunk(self):
+        r = LICHReassembler()
+        lich, frames = self.make_frames("W2FBI", 0, 10)
+        bad = bytearray(frames[2])
+        bad[3] ^= 0xFF
+        results = [r.add(f) for f in frames[:2] + [bytes(bad)] + frames[3:5]]
+        #the bad one doesn't raise, and takes the two before it down with it
+        self.assertEqual(results, [None]*5)
+        self.assertEqual(r.streams[None].filled, 2)
+        self.assertEqual([r.add(f) for f in frames[5:8]], [None, None, lich])
+
+    def test_bounded(self):
+        r = LICHReassembler(max_streams=3)
+        lich, frames = self.make_frames("W2FBI", 0, 1)
+        for stream in range(10):
+            r.add(frames[0], stream)
+        self.assertEqual(len(r), 3)
+        self.assertEqual(list(r.streams), [7, 8, 9])
+        r.timeout = -1
+        r.expire()
+        self.assertEqual(len(r), 0)
+
+class test_frame_objects(unittest.TestCase):
+    def setUp(self):
+        self.lich = initialLICH(
+                src=Address(callsign="W2FBI"),
+                dst=Address(callsign="SP5WWP"),
+                streamtype=5,
+                nonce=bytes(example_bytes(14)),
+                )
+
+    def test_slots(self):
+        f = ipFrame(streamid=1, LICH=self.lich, frame_number=1, payload=example_bytes(16))
+        for x in [f, self.lich, regularFrame(LICH=self.lich, frame_number=1, payload=example_bytes(16))]:
+            self.assertFalse(hasattr(x, "__dict__"))
+
+    def test_chunk_cache(self):
+        chunks = self.lich.chunks()
+        self.assertIs(self.lich.chunks(), chunks)
+        self.lich.streamtype = 7
+        self.assertIsNot(self.lich.chunks(), chunks)
+        self.assertEqual(initialLICH.from_bytes(b"".join(self.lich.chunks())).streamtype, 7)
+
+    def test_pickle(self):
+        import pickle
+        f = ipFrame(streamid=1, LICH=self.lich, frame_number=1, payload=example_bytes(16))
+        self.assertEqual(pickle.loads(pickle.dumps(f)), f)
+
+    def test_pool(self):
+        pool = FramePool(ipFrame, size=2)
+        frames = [ipFrame(streamid=i, LICH=self.lich, frame_number=i, payload=example_bytes(16)) for i in range(5)]
+        other = initialLICH(src=Address(callsign="N0CALL"), dst=Address(callsign="SP5WWP"), streamtype=5, nonce=bytes(14))
+        frames.append(ipFrame(streamid=9, LICH=other, frame_number=9, payload=example_bytes(16)))
+        seen = set()
+        for f in frames:
+            g = pool.from_bytes(bytes(f))
+            self.assertEqual(g, f)
+            self.assertEqual(g.LICH, f.LICH)
+            seen.add(id(g))
+            pool.release(g)
+        self.assertEqual(len(seen), 1)
+        rf = FramePool(regularFrame)
+        r = regularFrame(LICH=self.lich, frame_number=3, payload=example_bytes(16))
+        self.assertEqual(rf.from_bytes(bytes(r)), r)
+
+class test_frametype(unittest.TestCase):
+    def test_fields(self):
+        self.assertEqual((M17_Frametype(5).is_stream, M17_Frametype(5).has_voice), (1, 1))
+    def test_out_of_range(self):
+        for value in [-1, -65536, 65536, 1 << 20]:
+            with self.assertRaises(ValueError):
+                M17_Frametype(value).has_voice
+            with self.assertRaises(ValueError):
+                M17_Frametype.decode(value)
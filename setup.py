@@ -10,7 +10,7 @@ DESCRIPTION = 'M17 radio (and radio-over-IP) protocol implementation. https://gi
 URL = 'https://git.mmcginty.me/mike/pym17'
 EMAIL = 'pyM17@tarxvf.tech'
 AUTHOR = 'tarxvf'
-REQUIRES_PYTHON = '>=3.5.0'
+REQUIRES_PYTHON = '>=3.7.0'
 VERSION = '0.0.14'
 
 REQUIRED=[